@@ -0,0 +1,166 @@
+###################################
+# @file Fake_Blockbook.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Local Blockbook stand-in serving synthetic transaction graph.
+###################################
+
+# Imports
+import argparse, hashlib, math, random
+from functools import lru_cache
+from datetime import datetime, timezone
+from aiohttp import web
+
+# Const representing value of 1 Wei
+ETH_WEI = 1_000_000_000_000_000_000
+# Call data of contract (token transfer) transaction
+CONTRACT_DATA = "0xa9059cbb"
+
+# Deterministic synthetic graph: exchanges <- deposits (fan-in) <- leafs
+class SyntheticGraph():
+    def __init__(self, exchanges=10, deposits=20, leafs=10, txs=3, contractRatio=0.2, blocks=1_000_000, seed=42):
+        self.exchanges = exchanges
+        # Count of deposits per exchange and leafs per deposit
+        self.deposits = deposits
+        self.leafs    = leafs
+        # Count of transactions on each link
+        self.txs = txs
+        # Part of leaf transactions sent by contracts (ignored by clustering)
+        self.contractRatio = contractRatio
+        self.blocks = blocks
+        self.seed   = seed
+        # Address -> (kind, exchange index, deposit index), only addresses receiving txs
+        self.receivers = {}
+        for exch in range(exchanges):
+            self.receivers[self.address("exchange", exch)] = ("exchange", exch, 0)
+            for depo in range(deposits):
+                self.receivers[self.address("deposit", exch, depo)] = ("deposit", exch, depo)
+
+    def address(self, kind="", *indexes):
+        digest = hashlib.sha1(f"{self.seed}:{kind}:{indexes}".encode()).hexdigest()
+        return "0x" + digest[:40]
+
+    # Exchange list in format of exchanges.json
+    def exchangeNames(self):
+        return {self.address("exchange", exch).upper(): f"Synthetic exchange {exch}" for exch in range(self.exchanges)}
+
+    # Expected count of graph items, used to check benchmark results
+    def summary(self):
+        return {
+            "exchanges"    : self.exchanges,
+            "deposits"     : self.exchanges * self.deposits,
+            "leafs"        : self.exchanges * self.deposits * self.leafs,
+            "transactions" : self.exchanges * self.deposits * (self.txs + self.leafs * self.txs)
+        }
+
+    # All incoming transactions of address, newest first (as Blockbook returns them)
+    @lru_cache(maxsize=4096)
+    def incomingTxs(self, addr=""):
+        if (receiver := self.receivers.get(addr.lower())) is None:
+            return ()
+
+        kind, exch, depo = receiver
+        rand = random.Random(f"{self.seed}:{addr}")
+        if kind == "exchange":
+            senders = [(self.address("deposit", exch, index), False) for index in range(self.deposits)]
+        else:
+            senders = [
+                (self.address("leaf", exch, depo, index), rand.random() < self.contractRatio)
+                for index in range(self.leafs)
+            ]
+
+        txs = []
+        for sender, contract in senders:
+            for _ in range(self.txs):
+                block = rand.randrange(1, self.blocks)
+                txs.append({
+                    "txid"      : "0x" + hashlib.sha256(f"{sender}:{addr}:{len(txs)}".encode()).hexdigest(),
+                    "blockHeight" : block,
+                    # ~12 s per block
+                    "blockTime" : 1_438_269_973 + (block * 12),
+                    "vin"       : [{"addresses": [sender]}],
+                    "vout"      : [{"value": str(rand.randrange(1, 100) * (ETH_WEI // 100)), "addresses": [addr]}],
+                    "ethereumSpecific" : {"data": CONTRACT_DATA if contract else "0x"}
+                })
+        return tuple(sorted(txs, key=lambda tx: tx["blockHeight"], reverse=True))
+# End of SyntheticGraph class
+
+class FakeBlockbook():
+    def __init__(self, graph=None, pageSize=1000):
+        self.graph    = graph if graph else SyntheticGraph()
+        self.pageSize = pageSize
+        self.runner   = None
+        self.requests = 0
+
+    def createApp(self):
+        app = web.Application()
+        app.router.add_get("/api/api/status", self.status)
+        app.router.add_get("/api/v2/address/{addr}", self.address)
+        return app
+
+    async def status(self, request):
+        self.requests += 1
+        return web.json_response({"blockbook": {
+            "bestHeight"    : self.graph.blocks,
+            "lastBlockTime" : datetime.now(timezone.utc).isoformat()
+        }})
+
+    # Paginated transactions of address within <from;to> block range
+    async def address(self, request):
+        self.requests += 1
+        fromBlock = int(request.query.get("from", 0) or 0)
+        toBlock   = int(request.query.get("to", 0) or 0) or self.graph.blocks
+        page      = max(1, int(request.query.get("page", 1)))
+        pageSize  = int(request.query.get("pageSize", self.pageSize))
+
+        txs = [tx for tx in self.graph.incomingTxs(request.match_info["addr"]) if fromBlock <= tx["blockHeight"] <= toBlock]
+        return web.json_response({
+            "address"      : request.match_info["addr"],
+            "page"         : page,
+            "totalPages"   : max(1, math.ceil(len(txs) / pageSize)),
+            "itemsOnPage"  : pageSize,
+            "txs"          : len(txs),
+            "transactions" : txs[((page - 1) * pageSize):(page * pageSize)]
+        })
+
+    # Start serving, URL to use as Blockbook's is "http://host:port/api/"
+    async def start(self, host="127.0.0.1", port=9130):
+        self.runner = web.AppRunner(self.createApp())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        return f"http://{host}:{port}/api/"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+# End of FakeBlockbook class
+
+# Add synthetic graph options to argument parser
+def addGraphArgs(argParser):
+    argParser.add_argument("--exchanges", type=int, default=10, help="count of exchanges")
+    argParser.add_argument("--deposits", type=int, default=20, help="deposits per exchange (fan-in)")
+    argParser.add_argument("--leafs", type=int, default=10, help="leafs per deposit")
+    argParser.add_argument("--txs", type=int, default=3, help="transactions per link")
+    argParser.add_argument("--contract-ratio", type=float, default=0.2, help="part of leafs being contracts")
+    argParser.add_argument("--page-size", type=int, default=1000, help="transactions per page")
+    argParser.add_argument("--seed", type=int, default=42)
+
+def graphFromArgs(args):
+    return SyntheticGraph(
+        exchanges     = args.exchanges,
+        deposits      = args.deposits,
+        leafs         = args.leafs,
+        txs           = args.txs,
+        contractRatio = args.contract_ratio,
+        seed          = args.seed
+    )
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="Serve synthetic transaction graph over Blockbook API")
+    argParser.add_argument("--host", default="127.0.0.1")
+    argParser.add_argument("--port", type=int, default=9130)
+    addGraphArgs(argParser)
+    args = argParser.parse_args()
+
+    fake = FakeBlockbook(graphFromArgs(args), pageSize=args.page_size)
+    web.run_app(fake.createApp(), host=args.host, port=args.port)
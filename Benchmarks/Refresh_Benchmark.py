@@ -0,0 +1,130 @@
+###################################
+# @file Refresh_Benchmark.py
+# @author Tomáš Daniel (xdanie14)
+# @brief End-to-end benchmark of DB refresh against local fake Blockbook.
+###################################
+
+# Imports
+import argparse, asyncio, atexit, json, os, resource, shutil, sys, tempfile, time
+from pathlib import Path
+
+# Make project importable when run as script
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+from Benchmarks.Fake_Blockbook import FakeBlockbook, addGraphArgs, graphFromArgs
+from Helpers import Cache
+
+# Measured values compared against baseline (higher is better)
+COMPARED_METRICS = ("txsPerSec", "verticesPerSec", "edgesPerSec")
+
+# Peak resident memory of this process in MB
+def peakRssMB():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+async def runScope(heuristics, scope=100):
+    dataHandler = heuristics.dataHandler
+    # Start each scope from empty graph without crawled blocks
+    await heuristics.nebula.clearGraph()
+    Cache.clearNamespace("watermark")
+    dataHandler.knownDepos.rebuild()
+    dataHandler.depositIndex.rebuild()
+
+    start = time.perf_counter()
+    await heuristics.updateAddrsDB(scope=scope)
+    wallTime = time.perf_counter() - start
+
+    stats = dataHandler.writeBuffer.stats
+    return {
+        "scope"          : scope,
+        "wallTime"       : round(wallTime, 3),
+        "transactions"   : dataHandler.progress["txsProcessed"],
+        "vertices"       : stats["vertices"],
+        "edges"          : stats["edges"] + stats["transfers"],
+        "txsPerSec"      : round(dataHandler.progress["txsProcessed"] / wallTime, 1),
+        "verticesPerSec" : round(stats["vertices"] / wallTime, 1),
+        "edgesPerSec"    : round((stats["edges"] + stats["transfers"]) / wallTime, 1),
+        "peakRssMB"      : peakRssMB(),
+        "stageTimes"     : dict(dataHandler.progress["stageTimes"]),
+        "blockbook"      : dataHandler.trezor.limiter.getStats()
+    }
+
+# Print relative change of each metric against baseline, returns False when any dropped over tolerance
+def compareResults(results=[], baseline={}, tolerance=0.1):
+    baseScopes = {result["scope"]: result for result in baseline.get("results", [])}
+    passed = True
+    for result in results:
+        if (base := baseScopes.get(result["scope"])) is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if not base.get(metric):
+                continue
+            change = (result[metric] - base[metric]) / base[metric]
+            regression = change < -tolerance
+            passed &= not regression
+            print(f"  scope {result['scope']:>3} {metric:<15} {base[metric]:>12} -> {result[metric]:>12} ({change:+.1%}){'  REGRESSION' if regression else ''}")
+    return passed
+
+async def main(args):
+    graph = graphFromArgs(args)
+    fake  = FakeBlockbook(graph, pageSize=args.page_size)
+    url   = await fake.start(port=args.port)
+
+    # Work in temporary directory, so cache, indexes and exchange list of app stay untouched
+    # App writes exchange list at exit, directory is removed after that
+    workDir = tempfile.mkdtemp(prefix="refresh_benchmark_")
+    atexit.register(shutil.rmtree, workDir, True)
+    with open(os.path.join(workDir, "exchanges.json"), "w", encoding="utf-8") as file:
+        json.dump(graph.exchangeNames(), file)
+    os.chdir(workDir)
+
+    # Import after changing directory, app reads its files relative to it
+    os.environ["GRAPH_BACKEND"]   = args.backend
+    os.environ["REFRESH_WORKERS"] = str(args.workers)
+    from Server import HeuristicsClass
+    heuristics = HeuristicsClass(targetSpace=args.space)
+    heuristics.dataHandler.trezor.url = url
+
+    results = []
+    try:
+        for scope in args.scopes:
+            print(f"Benchmarking scope {scope}%")
+            results.append(await runScope(heuristics, scope))
+            print(json.dumps(results[-1], indent=2))
+    finally:
+        await heuristics.dataHandler.trezor.session.closeSession()
+        await fake.stop()
+
+    report = {
+        "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "graph"     : {**graph.summary(), "pageSize": args.page_size, "contractRatio": args.contract_ratio, "seed": args.seed},
+        "workers"   : args.workers,
+        "results"   : results
+    }
+    output = Path(args.output) if args.output else (ROOT_DIR / "Benchmarks" / "results" / f"refresh_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Results saved to: {output}")
+
+    if args.compare:
+        print(f"Comparison with: {args.compare}")
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        if not compareResults(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="Measure throughput of DB refresh against synthetic Blockbook")
+    argParser.add_argument("--scopes", type=int, nargs="+", default=[25, 50, 100], help="refresh scopes (%%) to run")
+    argParser.add_argument("--space", default="BenchmarkSpace", help="Nebula space used (it gets cleared)")
+    argParser.add_argument("--backend", default="nebula", choices=("nebula", "memory"), help="graph backend")
+    argParser.add_argument("--workers", type=int, default=1, help="refresh worker processes (Nebula backend only)")
+    argParser.add_argument("--port", type=int, default=9130, help="port of fake Blockbook")
+    argParser.add_argument("--output", default="", help="path of JSON results (default Benchmarks/results/)")
+    argParser.add_argument("--compare", default="", help="JSON results of previous run to compare with")
+    argParser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative throughput drop")
+    addGraphArgs(argParser)
+    args = argParser.parse_args()
+    # Paths are relative to directory benchmark was started from
+    args.output  = os.path.abspath(args.output) if args.output else ""
+    args.compare = os.path.abspath(args.compare) if args.compare else ""
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,84 @@
+###################################
+# @file Tx_Decode_Benchmark.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Microbenchmark of per-transaction cost of decoding Blockbook address pages.
+###################################
+
+# Imports
+import argparse, asyncio, json, sys, time
+from datetime import datetime
+from pathlib import Path
+
+# Make project importable when run as script
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+from Benchmarks.Fake_Blockbook import SyntheticGraph
+from Server.API.Response_Recorder import BytesReader
+from Server.API.Tx_Decoder import BACKENDS, BACKEND_NAME, ETH_WEI, decodeTxs, ijson
+
+# Page of address transactions with all fields Blockbook returns (txslight details)
+def buildPage(graph=None, count=1000):
+    depoAddr = graph.address("deposit", 0, 0)
+    txs = []
+    while len(txs) < count:
+        for tx in graph.incomingTxs(depoAddr):
+            txs.append({
+                "txid"          : tx["txid"],
+                "vin"           : [{"n": 0, "addresses": tx["vin"][0]["addresses"], "isAddress": True}],
+                "vout"          : [{"value": tx["vout"][0]["value"], "n": 0, "addresses": tx["vout"][0]["addresses"], "isAddress": True}],
+                "blockHash"     : "0x" + tx["txid"][-64:],
+                "blockHeight"   : tx["blockHeight"],
+                "confirmations" : 100,
+                "blockTime"     : tx["blockTime"],
+                "value"         : tx["vout"][0]["value"],
+                "fees"          : "420000000000000",
+                "ethereumSpecific" : {"status": 1, "nonce": len(txs), "gasLimit": 21000, "gasUsed": 21000, "gasPrice": "20000000000", "data": tx["ethereumSpecific"]["data"]}
+            })
+    txs = txs[:count]
+    return json.dumps({"page": 1, "totalPages": 1, "itemsOnPage": count, "address": depoAddr, "txs": count, "transactions": txs}).encode()
+
+# Previous way: whole tx dicts, Ether as float and formatted time for each tx
+async def decodeDicts(content, backend):
+    async for tx in backend.items_async(content, "transactions.item"):
+        yield (
+            str(tx.get("vin")[0].get("addresses")[0]).upper(),
+            str(tx.get("vout")[0].get("addresses")[0]).upper(),
+            float(tx.get("vout")[0].get("value")) / ETH_WEI,
+            str(tx.get("txid")),
+            datetime.fromtimestamp(int(tx.get("blockTime"))).strftime("%Y-%m-%d | %H:%M:%S"),
+            tx.get("ethereumSpecific").get("data") == "0x"
+        )
+
+async def decodeLean(content, backend):
+    async for tx in decodeTxs(content, backend):
+        yield tx
+
+# Returns microseconds per transaction (best of repeats)
+async def measure(decoder, backend, page=b"", count=0, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        async for _ in decoder(BytesReader(page), backend):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / count * 1_000_000, 2)
+
+async def main(args):
+    page = buildPage(SyntheticGraph(leafs=max(1, args.txs // 3)), args.txs)
+    print(f"Page of {args.txs} transactions ({len(page) / 1024:.0f} KiB), active backend: {BACKEND_NAME}")
+    print(f"{'backend':<12}{'dict us/tx':>12}{'lean us/tx':>12}{'speedup':>10}")
+    for name in BACKENDS:
+        try:
+            backend = ijson.get_backend(name)
+        except ImportError:
+            continue
+        dictCost = await measure(decodeDicts, backend, page, args.txs, args.repeat)
+        leanCost = await measure(decodeLean, backend, page, args.txs, args.repeat)
+        print(f"{name:<12}{dictCost:>12}{leanCost:>12}{(dictCost / leanCost):>9.2f}x")
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser(description="Measure cost of decoding one transaction of Blockbook response")
+    argParser.add_argument("--txs", type=int, default=1000, help="transactions in page")
+    argParser.add_argument("--repeat", type=int, default=5, help="runs per decoder, best one is reported")
+    asyncio.run(main(argParser.parse_args()))
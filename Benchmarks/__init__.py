@@ -0,0 +1,4 @@
+###################################
+# @file __init__.py
+# @author Tomáš Daniel (xdanie14)
+###################################
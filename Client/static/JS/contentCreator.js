@@ -20,15 +20,7 @@ function createResultsTable () {
             { name: "Hidden-Values", hidden: true }, // Helper column to get addrs directly
             "Entity"
         ],
-        data: Object.keys(nodesParams).map(key => {
-            return [
-                key,
-                gridjs.html(
-                    `<span style="display: inline-block; width: 10px; height: 10px; background-color: ${nodesParams[key].style.color}; border-radius: 2px;"></span>
-                    ${key}`
-                )
-            ];
-        }),
+        data: getResultsTableData(),
         pagination: {
             limit: 20
         },
@@ -36,6 +28,18 @@ function createResultsTable () {
     }));
 }
 
+function getResultsTableData () {
+    return Object.keys(nodesParams).map(key => {
+        return [
+            key,
+            gridjs.html(
+                `<span style="display: inline-block; width: 10px; height: 10px; background-color: ${nodesParams[key].style.color}; border-radius: 2px;"></span>
+                ${key}`
+            )
+        ];
+    });
+}
+
 function createExchListTable (loggedIn, exchListData) {
     return (window.exchTable = new gridjs.Grid({
         columns: [
@@ -36,22 +36,62 @@ async function submitRefreshRequest (event) {
         body  : formData
     });
 
-    // Hide spinner
-    hideElement("loadSpinner");
-
     // Implicit success result
     var resultText = "Clustering process finished succesfully";
     if (!response.ok)
         resultText = ((response.status === 401) ? "Invalid password provided, try again please..."
                                                 : "Error happened during the clustering process");
     else {
-        const { clientData, exchLen, addrsCount } = await response.json();
-        // Update menu with new data (no need to refresh entire page)
-        updateMenu(clientData, addrsCount, exchLen);
+        // Refresh runs in background, wait for its job to finish (or cancel it)
+        const { job } = await response.json();
+        const cancelBtn = document.getElementById("cancelRefreshBtn");
+        cancelBtn.onclick = () => cancelRefreshJob(job.id, formData.get("pwd"));
+        showElement("cancelRefreshBtn");
+        const finishedJob = await waitForRefreshJob(job.id);
+        hideElement("cancelRefreshBtn");
+        if (finishedJob.state !== "done")
+            resultText = `Clustering process ${finishedJob.state}${finishedJob.error ? `: ${finishedJob.error}` : ""}`;
+        // Show updated data once user closes result dialog
+        document.getElementById("infoModal").addEventListener("hidden.bs.modal", () => window.location.reload(), { once: true });
     }
+
+    // Hide spinner
+    hideElement("loadSpinner");
     showInfoModal(resultText);
 }
 
+async function waitForRefreshJob (jobId, interval=5000) {
+    while (true) {
+        const response = await fetch(`/refreshStatus/${jobId}`);
+        const job = await response.json();
+        if (!["queued", "running", "cancelling"].includes(job.state))
+            return job;
+
+        // Show progress next to spinner
+        if (job.progress) {
+            const { stage, addrsDone, addrsTotal, txsPerSec, stageEta } = job.progress;
+            document.getElementById("loadSpinner").title =
+                `${stage}: ${addrsDone}/${addrsTotal} addresses, ${txsPerSec} txs/s${(stageEta !== null) ? `, ETA ${stageEta}s` : ""}`;
+        }
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+}
+
+async function cancelRefreshJob (jobId, pwd) {
+    const formData = new FormData();
+    if (pwd)
+        formData.append("pwd", pwd);
+
+    document.getElementById("cancelRefreshBtn").disabled = true;
+    const response = await fetch(`/refreshCancel/${jobId}`, {
+        method: "POST",
+        body  : formData
+    });
+    // Job state is picked by waitForRefreshJob()
+    if (!response.ok)
+        showInfoModal("Unable to cancel refresh");
+}
+
 function updateMenu (clientData, addrsCount, exchLen) {
     // Update values non dependant on blockchain client status first
     document.getElementById("exchCountsItem").innerText  = addrsCount.get("exchanges", 0);
@@ -446,7 +486,8 @@ function handleBlockInput (inputElement) {
 
 function processGraphData (graphData) {
     return {
-        nodes: graphData.nodes.map(node => {
+        // Skip nodes already received with previous page
+        nodes: graphData.nodes.filter(node => !(node.id in nodesParams)).map(node => {
             // Store node params
             nodesParams[node.id] = {
                 amount: 0.0, // Initial value
@@ -464,13 +505,14 @@ function processGraphData (graphData) {
         }),
         links: graphData.edges.map(edge => {
             // Accumulate address Ether amount
-            nodesParams[edge.src].amount += parseFloat(edge.props.amount);
+            if (edge.src in nodesParams)
+                nodesParams[edge.src].amount += parseFloat(edge.props.amount);
 
             return {
                 source: edge.src,
                 target: edge.dst,
                 amount: edge.props.amount,
-                txs   : edge.props.txs
+                count : edge.props.count
             };
         }),
         categories: Object.keys(nodeStyles).map(function (category) {
@@ -480,3 +522,37 @@ function processGraphData (graphData) {
         })
     };
 }
+
+// Load cluster of given address page by page from server
+async function loadClusterPages (addr, limit=1000) {
+    let cursor = "";
+    while (cursor !== null) {
+        const response = await fetch(`/cluster/${addr}?cursor=${encodeURIComponent(cursor)}&limit=${limit}`);
+        if (!response.ok)
+            break;
+
+        const page = await response.json();
+        appendGraphData(page);
+        cursor = page.nextCursor;
+    }
+}
+
+// Add page of nodes and edges to shown graph and results table
+function appendGraphData (graphData) {
+    const page = processGraphData(graphData);
+    graph.nodes.push(...page.nodes);
+    graph.links.push(...page.links);
+
+    addrChart.setOption({
+        series: [{
+            data : graph.nodes,
+            links: graph.links
+        }]
+    });
+    window.resTable.updateConfig({
+        data: getResultsTableData()
+    }).forceRender();
+
+    // Refresh counters, keep user address highlighted unless deselected
+    setHighlightResultsTableItem(userAddr, selectedNodes.has(userAddr));
+}
@@ -0,0 +1,99 @@
+###################################
+# @file Address_Index.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Set-like index for fast address membership checks.
+###################################
+
+# Imports
+import hashlib, math
+
+# Compact probabilistic set, can report false positives, never false negatives
+class BloomFilter:
+    def __init__(self, capacity=1, errorRate=1e-6):
+        self.capacity = max(1, capacity)
+        self.count    = 0
+        # Optimal count of bits and hash functions for given capacity and error rate
+        self.size   = max(64, int(-self.capacity * math.log(errorRate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round((self.size / self.capacity) * math.log(2)))
+        self.bits   = bytearray((self.size + 7) // 8)
+
+    # Split digest(s) into 64-bit chunks, one for each bit position
+    def positions(self, key):
+        key = key.encode()
+        digest = b"".join(
+            hashlib.blake2b(key, digest_size=64, salt=salt.to_bytes(16, "little")).digest()
+            for salt in range((self.hashes + 7) // 8)
+        )
+        return [(int.from_bytes(digest[(index * 8):((index + 1) * 8)], "little") % self.size) for index in range(self.hashes)]
+
+    def add(self, key):
+        self.count += 1
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= (1 << (pos & 7))
+
+    # Error rate is no longer guaranteed above capacity
+    def isFull(self):
+        return self.count >= self.capacity
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+# End of BloomFilter class
+
+# Membership index of (uppercase) addresses with O(1) lookups
+class AddressIndex:
+    def __init__(self, addrs=(), bloomThreshold=0, errorRate=1e-6):
+        # Size from which addresses are kept only in Bloom filter (0 = never)
+        self.bloomThreshold = bloomThreshold
+        self.errorRate      = errorRate
+        self.rebuild(addrs)
+
+    # Replace indexed addresses with given ones
+    def rebuild(self, addrs=()):
+        addrs = frozenset(str(addr).upper() for addr in addrs)
+        # Recently added addresses, merged into frozen set from time to time
+        self.added = set()
+        self.count = len(addrs)
+
+        if self.bloomThreshold and self.count >= self.bloomThreshold:
+            # Leave headroom for addresses added during refresh
+            self.blooms = [BloomFilter(self.count * 2, self.errorRate)]
+            for addr in addrs:
+                self.blooms[-1].add(addr)
+            self.members = frozenset()
+        else:
+            self.blooms  = None
+            self.members = addrs
+
+    # Incrementally add single address
+    def add(self, addr=""):
+        addr = addr.upper()
+        if addr in self:
+            return
+
+        self.count += 1
+        if self.blooms is not None:
+            # Current filter is full, continue with twice as big one
+            if self.blooms[-1].isFull():
+                self.blooms.append(BloomFilter(self.blooms[-1].capacity * 2, self.errorRate))
+            self.blooms[-1].add(addr)
+            return
+
+        self.added.add(addr)
+        # Keep pending set small compared to frozen one
+        if len(self.added) > max(1024, len(self.members) // 4):
+            self.members = self.members.union(self.added)
+            self.added   = set()
+
+    def update(self, addrs=()):
+        for addr in addrs:
+            self.add(addr)
+
+    # Expects already uppercase address
+    def __contains__(self, addr):
+        if addr in self.members or addr in self.added:
+            return True
+        return (self.blooms is not None) and any((addr in bloom) for bloom in self.blooms)
+
+    def __len__(self):
+        return self.count
+# End of AddressIndex class
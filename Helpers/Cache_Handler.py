@@ -1,37 +1,126 @@
 # Imports
-import shelve, atexit
+import sqlite3, pickle, atexit, threading, time, os
+from contextlib import contextmanager
+from .Custom_Output import Out
 
-# Static class for accessing shelve cache
+# Static class for accessing SQLite cache
+# Every write is committed right away, unless grouped by batch()
+# Keys are separated into namespaces, volatile keys (with TTL) are evicted when expired or least recently used
 class Cache:
     db     = None
-    dbPath = "cache.db"
+    dbPath = "cache.sqlite"
+    # Shelve file of previous versions, its content isn't migrated
+    legacyPath = "cache.db"
+    # Max count of stored volatile keys
+    maxVolatile = 10000
+    # Min seconds between recorded accesses of volatile key (LRU order is kept with this precision)
+    accessInterval = 60.0
+    # Process owning current connection (forked processes open their own)
+    pid    = None
+    lock   = threading.RLock()
+    # Depth of nested batch() blocks
+    batchDepth = 0
 
     @classmethod
     def init(cls):
-        if cls.db is None:
-            cls.db = shelve.open(cls.dbPath, writeback=True)
+        if cls.db is None or cls.pid != os.getpid():
+            cls.db  = sqlite3.connect(cls.dbPath, timeout=30, isolation_level=None, check_same_thread=False)
+            cls.pid = os.getpid()
+            cls.batchDepth = 0
+            # WAL lets readers work during writes of other processes
+            # NORMAL sync keeps DB consistent after crash, only last commits can be lost on power failure
+            cls.db.execute("PRAGMA journal_mode=WAL")
+            cls.db.execute("PRAGMA synchronous=NORMAL")
+            # Bound memory used by page cache (in KiB)
+            cls.db.execute("PRAGMA cache_size=-8192")
+            cls.db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "ns TEXT NOT NULL, key TEXT NOT NULL, value BLOB, expires REAL, accessed REAL, "
+                "PRIMARY KEY (ns, key))"
+            )
+            cls.db.execute("CREATE INDEX IF NOT EXISTS cache_volatile ON cache (accessed) WHERE expires IS NOT NULL")
             # Ensure cleanup on end
             atexit.register(cls.close)
+            if any(os.path.exists(cls.legacyPath + suffix) for suffix in ("", ".dat", ".db")):
+                Out.warning(f"Cache: old {cls.legacyPath} is not migrated, watermarks are empty and next refresh crawls all addresses again")
 
+    # Group writes into one transaction (one disk sync)
     @classmethod
-    def set(cls, key, value):
-        cls.init()
-        cls.db[key] = value
+    @contextmanager
+    def batch(cls):
+        with cls.lock:
+            cls.init()
+            if cls.batchDepth == 0:
+                cls.db.execute("BEGIN IMMEDIATE")
+            cls.batchDepth += 1
+            try:
+                yield
+            except BaseException:
+                cls.batchDepth -= 1
+                if cls.batchDepth == 0:
+                    cls.db.execute("ROLLBACK")
+                raise
+            cls.batchDepth -= 1
+            if cls.batchDepth == 0:
+                cls.db.execute("COMMIT")
 
+    # Value with given TTL (seconds) is volatile
     @classmethod
-    def get(cls, key, default=None):
-        cls.init()
-        return cls.db.get(key, default)
+    def set(cls, key, value, namespace="default", ttl=None):
+        now = time.time()
+        with cls.batch():
+            cls.db.execute(
+                "INSERT OR REPLACE INTO cache (ns, key, value, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), (now + ttl) if ttl else None, now)
+            )
+            if ttl:
+                cls.evict()
 
     @classmethod
-    def delete(cls, key):
-        cls.init()
-        if key in cls.db:
-            del cls.db[key]
+    def get(cls, key, default=None, namespace="default"):
+        with cls.lock:
+            cls.init()
+            row = cls.db.execute("SELECT value, expires, accessed FROM cache WHERE ns = ? AND key = ?", (namespace, key)).fetchone()
+            if row is None:
+                return default
+            if row[1] is not None:
+                # Expired volatile key
+                if row[1] <= time.time():
+                    cls.delete(key, namespace)
+                    return default
+                # Track usage for LRU eviction, recent access isn't written again (each write is commit)
+                if (time.time() - row[2]) >= cls.accessInterval:
+                    cls.db.execute("UPDATE cache SET accessed = ? WHERE ns = ? AND key = ?", (time.time(), namespace, key))
+            return pickle.loads(row[0])
+
+    @classmethod
+    def delete(cls, key, namespace="default"):
+        with cls.batch():
+            cls.db.execute("DELETE FROM cache WHERE ns = ? AND key = ?", (namespace, key))
+
+    # Delete whole namespace
+    @classmethod
+    def clearNamespace(cls, namespace="default"):
+        with cls.batch():
+            cls.db.execute("DELETE FROM cache WHERE ns = ?", (namespace,))
+
+    # Remove expired volatile keys and least recently used ones over limit
+    @classmethod
+    def evict(cls):
+        with cls.batch():
+            cls.db.execute("DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+            count = cls.db.execute("SELECT COUNT(*) FROM cache WHERE expires IS NOT NULL").fetchone()[0]
+            if count > cls.maxVolatile:
+                cls.db.execute(
+                    "DELETE FROM cache WHERE rowid IN "
+                    "(SELECT rowid FROM cache WHERE expires IS NOT NULL ORDER BY accessed LIMIT ?)",
+                    (count - cls.maxVolatile,)
+                )
 
     @classmethod
     def close(cls):
-        if cls.db is not None:
-            cls.db.close()
+        with cls.lock:
+            if cls.db is not None and cls.pid == os.getpid():
+                cls.db.close()
             cls.db = None
 # End of Cache class
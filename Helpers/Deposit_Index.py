@@ -0,0 +1,138 @@
+###################################
+# @file Deposit_Index.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Compact reverse index from address to its deposit address(es).
+###################################
+
+# Imports
+import os, pickle
+from array import array
+from bisect import bisect_left
+
+# Size of address in bytes
+ADDR_SIZE = 20
+
+# Convert "0X..." address into its 20 raw bytes, None for invalid ones
+def addrToBytes(addr=""):
+    try:
+        raw = bytes.fromhex(addr[2:])
+    except (ValueError, TypeError):
+        return None
+    return raw if len(raw) == ADDR_SIZE else None
+
+# Sequence-like view of sorted packed addresses, allows bisect over them
+class PackedAddrs():
+    def __init__(self, data=b""):
+        self.data = data
+
+    def __getitem__(self, index):
+        return self.data[(index * ADDR_SIZE):((index + 1) * ADDR_SIZE)]
+
+    def __len__(self):
+        return len(self.data) // ADDR_SIZE
+# End of PackedAddrs class
+
+# Maps address -> integer IDs of deposits it sent to (CSR layout: sorted keys, offsets, targets)
+class DepositIndex():
+    def __init__(self, path="deposit_index.pickle"):
+        self.path = path
+        self.rebuild()
+
+    # Replace index content with given (addr, deposit) pairs
+    def rebuild(self, links=()):
+        # Deposit ID -> address and back (deposits are a small part of addresses)
+        self.deposits   = []
+        self.depositIds = {}
+        grouped = {}
+        for addr, depoAddr in links:
+            if (key := addrToBytes(addr)) is not None:
+                grouped.setdefault(key, set()).add(self.addDeposit(depoAddr))
+
+        keys = sorted(grouped)
+        self.keys    = PackedAddrs(b"".join(keys))
+        self.offsets = array("I", [0])
+        self.targets = array("I")
+        for key in keys:
+            self.targets.extend(sorted(grouped[key]))
+            self.offsets.append(len(self.targets))
+        # Links added after build, merged by compact()
+        self.pending = {}
+
+    # Returns ID of deposit, registers unknown one
+    def addDeposit(self, depoAddr=""):
+        depoAddr = depoAddr.upper()
+        if (depoId := self.depositIds.get(depoAddr)) is None:
+            depoId = self.depositIds[depoAddr] = len(self.deposits)
+            self.deposits.append(depoAddr)
+        return depoId
+
+    # Incrementally add single addr -> deposit link
+    def addLink(self, addr="", depoAddr=""):
+        if (key := addrToBytes(addr)) is None:
+            return
+        self.pending.setdefault(key, set()).add(self.addDeposit(depoAddr))
+        # Keep pending part small compared to packed one
+        if len(self.pending) > max(4096, len(self.keys) // 4):
+            self.compact()
+
+    # Merge pending links into packed arrays
+    def compact(self):
+        if self.pending:
+            self.rebuild(list(self.iterLinks()))
+
+    # All stored (addr, deposit) pairs
+    def iterLinks(self):
+        for index in range(len(self.keys)):
+            addr = "0X" + self.keys[index].hex().upper()
+            for depoId in self.targets[self.offsets[index]:self.offsets[index + 1]]:
+                yield addr, self.deposits[depoId]
+        for key, depoIds in self.pending.items():
+            for depoId in depoIds:
+                yield "0X" + key.hex().upper(), self.deposits[depoId]
+
+    # Deposit address(es) of given address, deposit itself is its own deposit
+    def getDeposits(self, addr=""):
+        addr = addr.upper()
+        if addr in self.depositIds:
+            return [addr]
+        if (key := addrToBytes(addr)) is None:
+            return []
+
+        depoIds = set(self.pending.get(key, ()))
+        index = bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            depoIds.update(self.targets[self.offsets[index]:self.offsets[index + 1]])
+        return [self.deposits[depoId] for depoId in sorted(depoIds)]
+
+    # Persist index, written into temporary file first to never leave broken one
+    def save(self):
+        self.compact()
+        with open(f"{self.path}.tmp", "wb") as file:
+            pickle.dump({
+                "deposits" : self.deposits,
+                "keys"     : self.keys.data,
+                "offsets"  : self.offsets,
+                "targets"  : self.targets
+            }, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    # Load persisted index, returns False when there is none
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                data = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+
+        self.deposits   = data["deposits"]
+        self.depositIds = {depoAddr: depoId for depoId, depoAddr in enumerate(self.deposits)}
+        self.keys       = PackedAddrs(data["keys"])
+        self.offsets    = data["offsets"]
+        self.targets    = data["targets"]
+        self.pending    = {}
+        return True
+
+    # Count of indexed addresses
+    def __len__(self):
+        return len(self.keys) + len(self.pending)
+# End of DepositIndex class
@@ -0,0 +1,58 @@
+###################################
+# @file LRU_Cache.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Bounded in-memory cache evicting least recently used and expired items.
+###################################
+
+# Imports
+import time
+from collections import OrderedDict
+
+class LRUCache():
+    def __init__(self, maxSize=256, ttl=3600):
+        self.maxSize = maxSize
+        # Seconds after which item is no longer served (0 = never expires)
+        self.ttl   = ttl
+        # Key -> (stored time, value), most recently used at end
+        self.items = OrderedDict()
+        self.stats = {
+            "hits"      : 0,
+            "misses"    : 0,
+            "evictions" : 0
+        }
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is None or (self.ttl and (time.monotonic() - item[0]) >= self.ttl):
+            self.stats["misses"] += 1
+            # Drop expired item
+            self.items.pop(key, None)
+            return default
+
+        self.stats["hits"] += 1
+        self.items.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value):
+        self.items[key] = (time.monotonic(), value)
+        self.items.move_to_end(key)
+        # Remove least recently used items over limit
+        while len(self.items) > self.maxSize:
+            self.items.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def getStats(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size"    : len(self.items),
+            "maxSize" : self.maxSize,
+            "hitRate" : round(self.stats["hits"] / lookups, 3) if lookups else None
+        }
+# End of LRUCache class
@@ -0,0 +1,183 @@
+###################################
+# @file Metrics_Registry.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Counters, gauges and histograms exported in Prometheus text format.
+###################################
+
+# Imports
+import threading, time
+from contextlib import contextmanager
+
+# Default histogram buckets (seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escapeLabel(value=""):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def formatLabels(labels=()):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escapeLabel(value)}"' for name, value in labels) + "}"
+
+# Base of all metric types, values are kept per label combination
+class Metric():
+    kind = ""
+
+    def __init__(self, name="", help="", labels=()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock   = threading.Lock()
+
+    # Sorted (name, value) pairs of given labels, all declared labels must be given
+    def labelKey(self, labels={}):
+        return tuple((name, labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{formatLabels(key)} {value}")
+        return lines
+
+    # Copy of values, sent to other process
+    def export(self):
+        with self.lock:
+            return dict(self.values)
+# End of Metric class
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    # Add growth between two exports of same counter in other process
+    def addDelta(self, current={}, previous={}):
+        with self.lock:
+            for key, value in current.items():
+                self.values[key] = self.values.get(key, 0) + value - previous.get(key, 0)
+# End of Counter class
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value=0, **labels):
+        with self.lock:
+            self.values[self.labelKey(labels)] = value
+# End of Gauge class
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name="", help="", labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value=0.0, **labels):
+        key = self.labelKey(labels)
+        with self.lock:
+            # Per label combination: count in each bucket (not cumulative), sum, count
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value, count + 1)
+
+    # Measure duration of block
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def export(self):
+        with self.lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+
+    # Add observations made between two exports of same histogram in other process
+    def addDelta(self, current={}, previous={}):
+        with self.lock:
+            for key, (counts, total, count) in current.items():
+                prevCounts, prevTotal, prevCount = previous.get(key, ([0] * len(self.buckets), 0.0, 0))
+                ownCounts, ownTotal, ownCount = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+                self.values[key] = (
+                    [own + new - prev for own, new, prev in zip(ownCounts, counts, prevCounts)],
+                    ownTotal + total - prevTotal,
+                    ownCount + count - prevCount
+                )
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucketCount in zip(self.buckets, counts):
+                    cumulative += bucketCount
+                    lines.append(f"{self.name}_bucket{formatLabels(key + (('le', bound),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{formatLabels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{formatLabels(key)} {total}")
+                lines.append(f"{self.name}_count{formatLabels(key)} {count}")
+        return lines
+# End of Histogram class
+
+# Static registry of all metrics
+class Metrics:
+    metrics    = {}
+    # Functions updating gauges right before rendering
+    collectors = []
+    lock = threading.Lock()
+
+    @classmethod
+    def register(cls, metricClass, name, help, labels=(), **kwargs):
+        with cls.lock:
+            # Same metric can be requested from multiple places
+            if name not in cls.metrics:
+                cls.metrics[name] = metricClass(name, help, labels, **kwargs)
+            return cls.metrics[name]
+
+    @classmethod
+    def counter(cls, name="", help="", labels=()):
+        return cls.register(Counter, name, help, labels)
+
+    @classmethod
+    def gauge(cls, name="", help="", labels=()):
+        return cls.register(Gauge, name, help, labels)
+
+    @classmethod
+    def histogram(cls, name="", help="", labels=(), buckets=DEFAULT_BUCKETS):
+        return cls.register(Histogram, name, help, labels, buckets=buckets)
+
+    @classmethod
+    def addCollector(cls, collector):
+        cls.collectors.append(collector)
+
+    # Counters and histograms of this process (gauges describe state of process, they aren't merged)
+    @classmethod
+    def export(cls):
+        return {name: metric.export() for name, metric in list(cls.metrics.items()) if metric.kind != "gauge"}
+
+    # Add growth of other process' metrics between its two exports
+    @classmethod
+    def mergeDelta(cls, current={}, previous={}):
+        for name, values in current.items():
+            metric = cls.metrics.get(name)
+            if metric and metric.kind != "gauge":
+                metric.addDelta(values, previous.get(name, {}))
+
+    # All metrics in Prometheus text exposition format
+    @classmethod
+    def render(cls):
+        for collector in cls.collectors:
+            collector()
+        lines = []
+        for metric in list(cls.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+# End of Metrics class
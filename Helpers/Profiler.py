@@ -0,0 +1,166 @@
+###################################
+# @file Profiler.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Opt-in profiling of refresh and search, with time spent awaiting each resource.
+###################################
+
+# Imports
+import os, io, time, pstats, functools, asyncio, cProfile
+from contextlib import contextmanager
+from .Custom_Output import Out
+
+# yappi measures coroutines correctly (wall time across awaits), cProfile is fallback
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+# Count of hot functions listed in summary
+SUMMARY_FUNCS = 30
+
+# Static class toggling and running profiles
+# Enabled by PROFILE env variable (comma separated targets, e.g. "refresh,search" or "all") or at runtime
+class Profiler:
+    # Targets to profile, None = not read from env yet
+    targets   = None
+    outputDir = "profiles"
+    # Name of running profile, only one runs at time (profilers are process wide)
+    active    = None
+    # Resource -> [total seconds, count, max seconds] of awaits within running profile
+    awaitTimes = {}
+
+    @classmethod
+    def init(cls):
+        if cls.targets is None:
+            cls.targets   = {target.strip() for target in os.getenv("PROFILE", "").split(",") if target.strip()}
+            cls.outputDir = os.getenv("PROFILE_DIR", cls.outputDir)
+            cls.checkEngine()
+
+    @classmethod
+    def engine(cls):
+        return "yappi" if yappi else "cProfile"
+
+    # Without yappi time of awaits is attributed to event loop, not to awaiting coroutines
+    @classmethod
+    def checkEngine(cls):
+        if cls.targets and not yappi:
+            Out.warning("Profiler: yappi not installed, cProfile fallback is not async-aware (awaits count as event loop time)")
+
+    @classmethod
+    def setTargets(cls, targets=[]):
+        cls.init()
+        cls.targets = set(targets)
+        cls.checkEngine()
+
+    @classmethod
+    def isEnabled(cls, target=""):
+        cls.init()
+        return bool(cls.targets) and (target in cls.targets or "all" in cls.targets)
+
+    # Measure time spent waiting for resource, no-op without running profile
+    @classmethod
+    @contextmanager
+    def awaiting(cls, resource=""):
+        if cls.active is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.addAwait(resource, time.perf_counter() - start)
+
+    # Record already measured wait for resource
+    @classmethod
+    def addAwait(cls, resource="", elapsed=0.0):
+        if cls.active is None:
+            return
+        stats = cls.awaitTimes.setdefault(resource, [0.0, 0, 0.0])
+        stats[0] += elapsed
+        stats[1] += 1
+        stats[2]  = max(stats[2], elapsed)
+
+    # Decorator profiling async function when its target is enabled
+    @classmethod
+    def profiled(cls, target=""):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if cls.active is not None or not cls.isEnabled(target):
+                    return await func(*args, **kwargs)
+                profiler = cls.start(target)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    await cls.stop(profiler)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def start(cls, target=""):
+        cls.active     = target
+        cls.awaitTimes = {}
+        if yappi:
+            yappi.clear_stats()
+            yappi.set_clock_type("wall")
+            yappi.start()
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    # Stop profiling and write profile with its summary (off event loop), returns path of summary
+    @classmethod
+    async def stop(cls, profiler=None):
+        target, cls.active = cls.active, None
+        try:
+            if yappi:
+                yappi.stop()
+                stats = yappi.convert2pstats(yappi.get_func_stats())
+                yappi.clear_stats()
+            else:
+                profiler.disable()
+                stats = pstats.Stats(profiler)
+
+            path = os.path.join(cls.outputDir, f"{target}_{time.strftime('%Y%m%d-%H%M%S')}")
+            await asyncio.to_thread(cls.write, path, stats, target, dict(cls.awaitTimes))
+            Out.success(f"Profile of {target} written to: {path}.prof, summary: {path}.txt")
+            return f"{path}.txt"
+        except Exception as e:
+            Out.error(f"Profiler.stop(): {e}")
+            return None
+
+    @classmethod
+    def write(cls, path="", stats=None, target="", awaitTimes={}):
+        os.makedirs(cls.outputDir, exist_ok=True)
+        # Raw profile can be inspected by pstats or snakeviz
+        stats.dump_stats(f"{path}.prof")
+        with open(f"{path}.txt", "w", encoding="utf-8") as file:
+            file.write(cls.summary(stats, target, awaitTimes))
+
+    @classmethod
+    def summary(cls, stats=None, target="", awaitTimes={}):
+        output = io.StringIO()
+        output.write(f"Profile of {target} ({cls.engine()}), {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+        # Awaits of concurrent tasks overlap, so totals can exceed wall time
+        output.write("Time awaiting resources (summed over concurrent tasks):\n")
+        output.write(f"{'resource':<24}{'total s':>12}{'count':>10}{'avg ms':>10}{'max ms':>10}\n")
+        for resource, (total, count, maxTime) in sorted(awaitTimes.items(), key=lambda item: -item[1][0]):
+            output.write(f"{resource:<24}{total:>12.3f}{count:>10}{(total / count * 1000):>10.1f}{(maxTime * 1000):>10.1f}\n")
+
+        stats.stream = output
+        output.write(f"\nTop {SUMMARY_FUNCS} functions by own time:\n")
+        stats.sort_stats("tottime").print_stats(SUMMARY_FUNCS)
+        output.write(f"\nTop {SUMMARY_FUNCS} functions by cumulative time:\n")
+        stats.sort_stats("cumulative").print_stats(SUMMARY_FUNCS)
+        return output.getvalue()
+
+    # Recently written summaries, newest first
+    @classmethod
+    def listProfiles(cls):
+        cls.init()
+        if not os.path.isdir(cls.outputDir):
+            return []
+        paths = [os.path.join(cls.outputDir, name) for name in os.listdir(cls.outputDir) if name.endswith(".txt")]
+        return [os.path.basename(path) for path in sorted(paths, key=os.path.getmtime, reverse=True)]
+# End of Profiler class
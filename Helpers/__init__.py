@@ -6,3 +6,8 @@
 # Collect all imports from current folder to allow easier work throught project
 from .Custom_Output import Out
 from .Cache_Handler import Cache
+from .Address_Index import AddressIndex, BloomFilter
+from .LRU_Cache import LRUCache
+from .Deposit_Index import DepositIndex
+from .Metrics_Registry import Metrics
+from .Profiler import Profiler
@@ -0,0 +1,72 @@
+###################################
+# @file Adaptive_Limiter.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Concurrency limit adapting to latency and errors of remote server (AIMD).
+###################################
+
+# Imports
+import asyncio, time
+from Helpers import Profiler
+
+class AdaptiveLimiter():
+    def __init__(self, initial=30, minLimit=4, maxLimit=256, targetLatency=5.0):
+        self.limit    = float(initial)
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        # Requests slower than this (seconds) stop limit from growing
+        self.targetLatency = targetLatency
+        self.inFlight  = 0
+        self.condition = asyncio.Condition()
+        # Exponentially weighted moving average of latency
+        self.latency      = None
+        self.lastDecrease = 0.0
+        self.stats = {
+            "successes" : 0,
+            "overloads" : 0,
+            "retries"   : 0
+        }
+
+    async def __aenter__(self):
+        # Time waiting for free slot shows in profiles
+        with Profiler.awaiting("blockbook_slot"):
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.inFlight < int(self.limit))
+                self.inFlight += 1
+        return self
+
+    async def __aexit__(self, *args):
+        async with self.condition:
+            self.inFlight -= 1
+            # Limit could have grown, wake all waiting
+            self.condition.notify_all()
+
+    # Healthy response, additive increase (by ~1 per window of requests)
+    def onSuccess(self, latency=0.0):
+        self.stats["successes"] += 1
+        self.latency = latency if self.latency is None else (0.8 * self.latency + 0.2 * latency)
+        # Grow only when limit is really used and server keeps up
+        if self.latency <= self.targetLatency and self.inFlight >= int(self.limit) - 1:
+            self.limit = min(self.maxLimit, self.limit + (1 / self.limit))
+
+    # Timeout or 5xx response, multiplicative decrease (at most once per latency period)
+    def onOverload(self):
+        self.stats["overloads"] += 1
+        now = time.monotonic()
+        if (now - self.lastDecrease) >= (self.latency or 1.0):
+            self.lastDecrease = now
+            self.limit = max(self.minLimit, self.limit / 2)
+
+    # Keep only part of limits when same server is queried by several processes
+    def share(self, parts=1):
+        self.minLimit = max(1, self.minLimit // parts)
+        self.maxLimit = max(self.minLimit, self.maxLimit // parts)
+        self.limit    = min(self.maxLimit, max(self.minLimit, self.limit / parts))
+
+    def getStats(self):
+        return {
+            **self.stats,
+            "limit"     : int(self.limit),
+            "inFlight"  : self.inFlight,
+            "latencyMs" : round(self.latency * 1000, 1) if self.latency is not None else None
+        }
+# End of AdaptiveLimiter class
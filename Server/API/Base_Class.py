@@ -7,7 +7,7 @@
 # Imports
 import urllib3, yaml, aiohttp
 from asyncio.exceptions import TimeoutError
-from Helpers import Out
+from Helpers import Out, Metrics, Profiler
 from pathlib import Path
 
 # Suppress InsecureRequestWarning related to session.verify set to False
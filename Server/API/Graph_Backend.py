@@ -0,0 +1,92 @@
+###################################
+# @file Graph_Backend.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Interface of graph storage used by heuristics, implemented by NebulaGraph and in-memory backends.
+###################################
+
+# Imports
+import os, yaml
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+# Operations heuristics need from graph storage
+# Backend missing any of abstract methods fails on instantiation
+# Addresses are vertices (name, type), linked_to edges aggregate amount and count of transactions, transfer edges keep each tx
+class GraphBackend(ABC):
+    # Insert single vertex (and edge to parent address), amount in Wei (stored as Ether)
+    @abstractmethod
+    async def addNodeToGraph(self, addr="", addrName="", parentAddr="", nodeType="", txID="", txTime=0, amount=0):
+        raise NotImplementedError
+
+    # Write batch of rows gathered by NebulaWriteBuffer, returns (round trips, failed writes)
+    @abstractmethod
+    async def writeBatch(self, vertices={}, edges={}, transfers={}, maxRows=1000):
+        raise NotImplementedError
+
+    # Run blocking function (one of getters below) without blocking event loop
+    @abstractmethod
+    async def runAsync(self, func, *args, **kwargs):
+        raise NotImplementedError
+
+    @abstractmethod
+    def getAddrsOfType(self, addrType="", targetParam="id(v)"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def countAddrsOfType(self, addrType=""):
+        raise NotImplementedError
+
+    # Async generator of pages of addresses of given type
+    @abstractmethod
+    async def iterAddrsOfType(self, addrType="", *targetParams, pageSize=None):
+        raise NotImplementedError
+        yield
+
+    # Returns (address, deposit) pairs of all addresses linked to deposit addresses
+    @abstractmethod
+    def getDepositLinks(self):
+        raise NotImplementedError
+
+    # Returns {"nodes", "edges"} of 1 step subgraph around given deposits, None on failure
+    @abstractmethod
+    async def getSubgraph(self, depoAddrs=[]):
+        raise NotImplementedError
+
+    # Returns {"nodes", "edges", "nextCursor"} of one page of cluster around given deposits, None on failure
+    # Pages continue after edge given as (count, amount, src, dst), nextCursor is that of page's last edge (None = last page)
+    @abstractmethod
+    async def getClusterPage(self, depoAddrs=[], after=None, limit=1000):
+        raise NotImplementedError
+
+    # Returns [(txid, time, amount)] of transactions from src to dst, newest first
+    @abstractmethod
+    async def getEdgeTxs(self, srcAddr="", dstAddr=""):
+        raise NotImplementedError
+
+    # Remove all vertices and edges
+    @abstractmethod
+    async def clearGraph(self):
+        raise NotImplementedError
+
+    # Called after refresh, once graph is complete
+    @abstractmethod
+    async def rebuildIndexes(self):
+        raise NotImplementedError
+
+    def closeConnection(self):
+        pass
+# End of GraphBackend class
+
+# Create backend selected by config (or GRAPH_BACKEND env variable)
+# Attach only connects to already prepared storage (used by refresh worker processes)
+def createGraphBackend(targetSpace="EthereumClustering", file="configFile.yaml", attach=False):
+    with open(Path(__file__).parent / file, "r") as configFile:
+        conf = yaml.safe_load(configFile).get("graph", {})
+
+    backend = os.getenv("GRAPH_BACKEND", conf.get("backend", "nebula"))
+    if backend == "memory":
+        from .Memory_Graph import MemoryGraph
+        return MemoryGraph(targetSpace=targetSpace, snapshot=conf.get("snapshot", "memory_graph.pickle"))
+
+    from .Nebula_Class import NebulaAPI
+    return NebulaAPI(file=file, targetSpace=targetSpace, attach=attach)
@@ -0,0 +1,226 @@
+###################################
+# @file Memory_Graph.py
+# @author Tomáš Daniel (xdanie14)
+# @brief In-process graph backend keeping addresses and edges in adjacency arrays.
+###################################
+
+# Imports
+import os, pickle, atexit, heapq
+from array import array
+from .Base_Class import Out
+from .Graph_Backend import GraphBackend
+from .Nebula_Class import txRank
+from .Tx_Decoder import weiToEth
+
+# Vertex types stored as small integers
+NODE_TYPES = ("", "exchange", "deposit", "leaf")
+
+class MemoryGraph(GraphBackend):
+    def __init__(self, targetSpace="EthereumClustering", snapshot="memory_graph.pickle"):
+        self.targetSpace = targetSpace
+        # Graph is persisted to this file after refresh and at exit ("" = never)
+        self.snapshot = snapshot
+        # Read by write buffer, empty = its default batch size and flush interval
+        self.conf = {}
+        self.clear()
+        if snapshot:
+            self.load()
+        # Ensure graph is persisted at exit
+        atexit.register(self.closeConnection)
+
+    def clear(self):
+        # Vertex ID -> address and back, vertex props
+        self.addrs    = []
+        self.addrIds  = {}
+        self.names    = []
+        self.types    = bytearray()
+        # Vertex IDs of each type in order of insertion
+        self.typeMembers = {nodeType: array("I") for nodeType in NODE_TYPES}
+        # linked_to edges: (src ID, dst ID) -> edge ID, edge props in parallel arrays
+        self.edgeIds    = {}
+        self.edgeSrc    = array("I")
+        self.edgeDst    = array("I")
+        self.edgeAmount = array("d")
+        self.edgeCount  = array("I")
+        # Adjacency arrays: vertex ID -> IDs of its outgoing / incoming edges
+        self.outEdges = []
+        self.inEdges  = []
+        # transfer edges: edge ID -> {rank: (txid, time, amount)}
+        self.transfers = {}
+
+    # Vertex ID of address, vertex without props is created when unknown (same as dangling edge in Nebula)
+    def vertexId(self, addr=""):
+        if (vertexId := self.addrIds.get(addr)) is None:
+            vertexId = self.addrIds[addr] = len(self.addrs)
+            self.addrs.append(addr)
+            self.names.append("")
+            self.types.append(0)
+            self.outEdges.append(array("I"))
+            self.inEdges.append(array("I"))
+        return vertexId
+
+    # INSERT VERTEX IF NOT EXISTS, only vertex without props can get them
+    def insertVertex(self, addr="", name="", nodeType=""):
+        vertexId = self.vertexId(addr)
+        if not self.types[vertexId] and nodeType in NODE_TYPES:
+            self.names[vertexId] = name
+            self.types[vertexId] = NODE_TYPES.index(nodeType)
+            self.typeMembers[nodeType].append(vertexId)
+
+    # UPSERT EDGE linked_to, returns its ID
+    def upsertEdge(self, src="", dst="", amount=0.0, count=0):
+        srcId, dstId = self.vertexId(src), self.vertexId(dst)
+        if (edgeId := self.edgeIds.get((srcId, dstId))) is None:
+            edgeId = self.edgeIds[(srcId, dstId)] = len(self.edgeSrc)
+            self.edgeSrc.append(srcId)
+            self.edgeDst.append(dstId)
+            self.edgeAmount.append(0.0)
+            self.edgeCount.append(0)
+            self.outEdges[srcId].append(edgeId)
+            self.inEdges[dstId].append(edgeId)
+        self.edgeAmount[edgeId] += amount
+        self.edgeCount[edgeId]  += count
+        return edgeId
+
+    # INSERT EDGE IF NOT EXISTS transfer
+    def insertTransfer(self, src="", dst="", rank=0, tx=()):
+        edgeId = self.upsertEdge(src, dst)
+        self.transfers.setdefault(edgeId, {}).setdefault(rank, tx)
+
+    # Amounts come in Wei, graph stores Ether
+    async def addNodeToGraph(self, addr="", addrName="", parentAddr="", nodeType="", txID="", txTime=0, amount=0):
+        self.insertVertex(addr, addrName, nodeType)
+        if parentAddr != "":
+            if txID:
+                self.insertTransfer(addr, parentAddr, txRank(txID), (txID, txTime, weiToEth(amount)))
+            self.upsertEdge(addr, parentAddr, weiToEth(amount), 1 if txID else 0)
+
+    # Everything is written at once, so single round trip
+    async def writeBatch(self, vertices={}, edges={}, transfers={}, maxRows=1000):
+        for addr, (name, nodeType) in vertices.items():
+            self.insertVertex(addr, name, nodeType)
+        for (src, dst, rank), (txID, txTime, amount) in transfers.items():
+            self.insertTransfer(src, dst, rank, (txID, txTime, weiToEth(amount)))
+        for (src, dst), (amount, count) in edges.items():
+            self.upsertEdge(src, dst, weiToEth(amount), count)
+        return 1, 0
+
+    # Data are in memory, no need for other thread
+    async def runAsync(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def nodeValue(self, vertexId, targetParam="id(v)"):
+        return self.names[vertexId] if targetParam == "v.address.name" else self.addrs[vertexId]
+
+    def getAddrsOfType(self, addrType="", targetParam="id(v)"):
+        return [self.nodeValue(vertexId, targetParam) for vertexId in self.typeMembers.get(addrType, ())]
+
+    def countAddrsOfType(self, addrType=""):
+        return len(self.typeMembers.get(addrType, ()))
+
+    async def iterAddrsOfType(self, addrType="", *targetParams, pageSize=None):
+        targetParams = targetParams or ("id(v)",)
+        pageSize = pageSize or 10000
+        members  = self.typeMembers.get(addrType, array("I"))
+        for start in range(0, len(members), pageSize):
+            rows = [[self.nodeValue(vertexId, param) for param in targetParams] for vertexId in members[start:(start + pageSize)]]
+            yield [row[0] for row in rows] if len(targetParams) == 1 else [tuple(row) for row in rows]
+
+    def getDepositLinks(self):
+        return [
+            (self.addrs[self.edgeSrc[edgeId]], self.addrs[dstId])
+            for dstId in self.typeMembers["deposit"]
+            for edgeId in self.inEdges[dstId]
+        ]
+
+    def nodeDict(self, vertexId):
+        return {"id": self.addrs[vertexId], "props": {"name": self.names[vertexId], "type": NODE_TYPES[self.types[vertexId]]}}
+
+    def edgeDict(self, edgeId):
+        return {
+            "src"   : self.addrs[self.edgeSrc[edgeId]],
+            "dst"   : self.addrs[self.edgeDst[edgeId]],
+            "props" : {"amount": self.edgeAmount[edgeId], "count": self.edgeCount[edgeId]}
+        }
+
+    def depositIds(self, depoAddrs=[]):
+        return [self.addrIds[depoAddr] for depoAddr in depoAddrs if depoAddr in self.addrIds]
+
+    async def getSubgraph(self, depoAddrs=[]):
+        nodes, edges = {}, {}
+        for depoId in self.depositIds(depoAddrs):
+            nodes.setdefault(depoId, None)
+            for edgeId in [*self.inEdges[depoId], *self.outEdges[depoId]]:
+                edges.setdefault(edgeId, None)
+                nodes.setdefault(self.edgeSrc[edgeId], None)
+                nodes.setdefault(self.edgeDst[edgeId], None)
+        return {
+            "nodes" : [self.nodeDict(vertexId) for vertexId in nodes],
+            "edges" : [self.edgeDict(edgeId) for edgeId in edges]
+        }
+
+    def edgeOrder(self, edgeId):
+        return (-self.edgeCount[edgeId], -self.edgeAmount[edgeId], self.addrs[self.edgeSrc[edgeId]], self.addrs[self.edgeDst[edgeId]])
+
+    async def getClusterPage(self, depoAddrs=[], after=None, limit=1000):
+        depoIds = self.depositIds(depoAddrs)
+        # Strongest links (most txs) first, same order as Nebula backend, only edges after previous page
+        afterKey = (-after[0], -after[1], after[2], after[3]) if after else None
+        linked = heapq.nsmallest(
+            limit + 1,
+            (edgeId for depoId in depoIds for edgeId in self.inEdges[depoId] if not afterKey or self.edgeOrder(edgeId) > afterKey),
+            key = self.edgeOrder
+        )
+        edgeIds = linked[:limit]
+        nextCursor = None
+        if len(linked) > limit:
+            edge = self.edgeDict(edgeIds[-1])
+            nextCursor = (edge["props"]["count"], edge["props"]["amount"], edge["src"], edge["dst"])
+        nodes = {}
+        if not after:
+            nodes = dict.fromkeys(depoIds)
+            edgeIds = [edgeId for depoId in depoIds for edgeId in self.outEdges[depoId]] + edgeIds
+        for edgeId in edgeIds:
+            nodes.setdefault(self.edgeSrc[edgeId], None)
+            nodes.setdefault(self.edgeDst[edgeId], None)
+        return {
+            "nodes"      : [self.nodeDict(vertexId) for vertexId in nodes],
+            "edges"      : [self.edgeDict(edgeId) for edgeId in edgeIds],
+            "nextCursor" : nextCursor
+        }
+
+    async def getEdgeTxs(self, srcAddr="", dstAddr=""):
+        edgeId = self.edgeIds.get((self.addrIds.get(srcAddr), self.addrIds.get(dstAddr)))
+        return sorted(self.transfers.get(edgeId, {}).values(), key=lambda tx: tx[1], reverse=True)
+
+    async def clearGraph(self):
+        self.clear()
+
+    # No indexes to rebuild, graph is complete so persist it
+    async def rebuildIndexes(self):
+        self.save()
+
+    def save(self):
+        if not self.snapshot:
+            return
+        state = {key: value for key, value in vars(self).items() if key not in ("targetSpace", "snapshot", "conf", "addrIds", "edgeIds")}
+        # Write into temporary file first to never leave broken one
+        with open(f"{self.snapshot}.tmp", "wb") as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{self.snapshot}.tmp", self.snapshot)
+
+    def load(self):
+        try:
+            with open(self.snapshot, "rb") as file:
+                vars(self).update(pickle.load(file))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        # Lookup dicts are derived from arrays
+        self.addrIds = {addr: vertexId for vertexId, addr in enumerate(self.addrs)}
+        self.edgeIds = {(src, dst): edgeId for edgeId, (src, dst) in enumerate(zip(self.edgeSrc, self.edgeDst))}
+        Out.blank(f"Loaded in-memory graph: {len(self.addrs)} addresses, {len(self.edgeSrc)} edges")
+        return True
+
+    def closeConnection(self):
+        self.save()
+# End of MemoryGraph class
@@ -5,15 +5,43 @@
 ###################################
 
 # Imports
-import atexit, time
-from .Base_Class import BaseAPI, yaml, Out
+import atexit, time, asyncio, threading, hashlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from .Base_Class import BaseAPI, yaml, Out, Metrics, Profiler
+from .Graph_Backend import GraphBackend
+from .Tx_Decoder import weiToEth
 from nebula3.gclient.net import ConnectionPool
 from nebula3.Config import Config
 
+# Derive edge rank from transaction ID, keeps one transfer edge per tx (re-inserting same tx is no-op)
+def txRank(txID=""):
+    try:
+        # 60 bits of tx hash fit into signed int64 rank
+        return int(txID[2:17], 16)
+    except ValueError:
+        # Built-in hash differs between processes, rank must be same for every run and worker
+        return int.from_bytes(hashlib.blake2b(txID.encode(), digest_size=8).digest(), "big") >> 1
+
+# Query metrics, labeled by statement type (first keyword of command)
+QUERY_SECONDS = Metrics.histogram("nebula_query_seconds", "Duration of Nebula queries", ("statement",))
+QUERY_ERRORS  = Metrics.counter("nebula_query_errors_total", "Failed Nebula queries", ("statement",))
+
+def statementType(command=""):
+    keyword = command.split(None, 1)
+    return keyword[0].upper() if keyword else ""
+
+# Escape value to be safely used inside nGQL string literal
+def escapeStr(value=""):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
 # Class handling interaction with NebulaGraph
-class NebulaAPI(BaseAPI):
-    def __init__(self, file="configFile.yaml", targetSpace="EthereumClustering"):
-        time.sleep(40)
+# Attached instance only uses existing space (no waiting, schema or index work) and raises instead of exiting
+class NebulaAPI(BaseAPI, GraphBackend):
+    def __init__(self, file="configFile.yaml", targetSpace="EthereumClustering", attach=False):
+        self.attached = attach
+        if not attach:
+            time.sleep(40)
         # Open config file
         self.conf = yaml.safe_load(self.openConfigFile(file))["nebula"]
         # Init parent class
@@ -21,14 +49,33 @@ class NebulaAPI(BaseAPI):
         # Create Nebula session
         self.targetSpace    = targetSpace
         self.connectionPool = None
-        self.session        = None
+        # Sessions are owned per thread, keep all of them for cleanup
+        self.threadData   = threading.local()
+        self.sessions     = []
+        self.sessionsLock = threading.Lock()
+        # Bounded pool of workers executing blocking queries off the event loop
+        self.workers  = self.conf.get("workers", 8)
+        self.executor = None
 
         self.getNebulaPool()
-        self.ensureConnect(skipSpaceSelection=True)
-        self.createSpace()
-        # Ensure index is used for querying
-        self.execNebulaCommand('REBUILD TAG INDEX addrs_index')
-        Out.blank("Tag index rebuild done")
+        if attach:
+            # Space was prepared by process creating it, only select it
+            self.ensureConnect(skipSpaceSelection=True)
+            if not self.execNebulaCommand(f'USE {self.targetSpace}'):
+                self.fail(f"space {self.targetSpace} can't be used")
+        else:
+            self.ensureConnect(skipSpaceSelection=True)
+            self.createSpace()
+            # Ensure index is used for querying
+            self.execNebulaCommand('REBUILD TAG INDEX addrs_index')
+            Out.blank("Tag index rebuild done")
+
+        # Each worker creates its own session on start
+        self.executor = ThreadPoolExecutor(
+            max_workers        = self.workers,
+            thread_name_prefix = "nebula",
+            initializer        = self.ensureConnect
+        )
 
         # Ensure cleanup at exit
         atexit.register(self.closeConnection)
@@ -37,6 +84,8 @@ class NebulaAPI(BaseAPI):
     def getNebulaPool(self):
         try:
             config = Config()
+            # Session for every worker plus one for main thread, never less than library default
+            config.max_connection_pool_size = max(config.max_connection_pool_size, self.workers + 1)
             # Init connection pool
             self.connectionPool = ConnectionPool()
             # Check if connection to pool is valid
@@ -44,7 +93,22 @@ class NebulaAPI(BaseAPI):
                 raise Exception("connectionPool.init() returned False")
         except Exception as e:
             Out.error(f"Error while creating Nebula connection pool: {e}")
-            exit(-1)
+            self.fail(e)
+
+    # Session of current thread (main thread or executor worker)
+    @property
+    def session(self):
+        return getattr(self.threadData, "session", None)
+
+    # Replaced session is already released by its thread, so it is forgotten
+    @session.setter
+    def session(self, value):
+        previous, self.threadData.session = self.session, value
+        with self.sessionsLock:
+            if previous in self.sessions:
+                self.sessions.remove(previous)
+            if value:
+                self.sessions.append(value)
 
     def isSessionValid(self):
         try:
@@ -68,21 +132,31 @@ class NebulaAPI(BaseAPI):
                     self.execNebulaCommand(f'USE {self.targetSpace}')
         except Exception as e:
             Out.error(f"Error while creating Nebula connection: {e}")
-            exit(-1)
+            self.fail(e)
 
-    # Closes and release nebula session and pool
+    # App can't run without DB, attached instance lets its owner decide
+    def fail(self, error=None):
+        if self.attached:
+            raise ConnectionError(f"Nebula unavailable: {error}")
+        exit(-1)
+
+    # Closes and release nebula sessions and pool
     def closeConnection(self):
         try:
-            if self.session:
-                self.session.release()
+            if self.executor:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+            with self.sessionsLock:
+                for session in self.sessions:
+                    session.release()
+                self.sessions = []
             if self.connectionPool:
                 self.connectionPool.close()
         except Exception as e:
             Out.error(f"Error while closing connection: {e}")
 
     # Check if given Nebula object (space, index, edge) already exists
-    def objectExists(self, assertName, objName, name="Name"):
-        result = self.execNebulaCommand(f'SHOW {objName}')
+    def objectExists(self, assertName, objName, name="Name", action="SHOW"):
+        result = self.execNebulaCommand(f'{action} {objName}')
         if result and not result.is_empty():
             return assertName in [val.as_string() for val in result.column_values(name)]
         return False
@@ -112,38 +186,106 @@ class NebulaAPI(BaseAPI):
 
         if not (skipChange := self.objectExists("linked_to", "EDGES")):
             Out.warning("Creating needed edge(s)")
-            self.execNebulaCommand('CREATE EDGE linked_to(amount float DEFAULT 0.0, txs string DEFAULT "")')
+            # Aggregated amount and count of all transactions between two addresses
+            self.execNebulaCommand('CREATE EDGE linked_to(amount float DEFAULT 0.0, count int DEFAULT 0)')
+        elif not self.objectExists("count", "EDGE linked_to", name="Field", action="DESCRIBE"):
+            # Space created with older schema (txs string), add counter
+            Out.warning("Adding count to existing edge")
+            self.execNebulaCommand('ALTER EDGE linked_to ADD (count int DEFAULT 0)')
+            skipChange = False
+
+        if not self.objectExists("transfer", "EDGES"):
+            Out.warning("Creating transaction edge(s)")
+            # One edge per transaction, ranked by tx ID
+            self.execNebulaCommand('CREATE EDGE transfer(txid string, time int, amount double)')
+            skipChange = False
 
         # Ensure new objects are properly made
         if not skipChange:
             time.sleep(20)
             Out.success(f"All needed components created succesfully")
 
-    # Handles adding new node to graph
-    async def addNodeToGraph(self, addr="", addrName="", parentAddr="", nodeType="", txParams="", amount=0.0):
+    # Handles adding new node to graph, amount in Wei
+    async def addNodeToGraph(self, addr="", addrName="", parentAddr="", nodeType="", txID="", txTime=0, amount=0):
         print(f"Adding type: {nodeType} ; name: {addrName} ; {addr}")
+        amount = weiToEth(amount)
         # Add node (vertex) to graph
-        self.execNebulaCommand(
+        await self.execAsync(
             f'INSERT VERTEX IF NOT EXISTS address(name, type) VALUES "{addr}": ("{addrName}", "{nodeType}")'
         )
         # Parent address is given so create a path to it
         if parentAddr != "":
-            self.execNebulaCommand(
-                f'UPSERT EDGE on linked_to "{addr}"->"{parentAddr}" SET amount = amount + {amount}, txs = txs + "{txParams}"'
+            # Store transaction itself as separate ranked edge
+            if txID:
+                await self.execAsync(
+                    f'INSERT EDGE IF NOT EXISTS transfer(txid, time, amount) VALUES "{addr}"->"{parentAddr}"@{txRank(txID)}: ("{txID}", {txTime}, {amount})'
+                )
+            await self.execAsync(
+                f'UPSERT EDGE on linked_to "{addr}"->"{parentAddr}" SET amount = amount + {amount}, count = count + {1 if txID else 0}'
             )
 
+    # Construct list of nGQL queries for given rows, each query is one round trip
+    # Amounts come in Wei, graph stores Ether
+    def buildQueries(self, vertices={}, edges={}, transfers={}, maxRows=1000):
+        queries = []
+        vertexRows = [f'"{addr}":("{escapeStr(name)}", "{nodeType}")' for addr, (name, nodeType) in vertices.items()]
+        for start in range(0, len(vertexRows), maxRows):
+            queries.append(
+                'INSERT VERTEX IF NOT EXISTS address(name, type) VALUES ' + ", ".join(vertexRows[start:(start + maxRows)])
+            )
+
+        transferRows = [
+            f'"{src}"->"{dst}"@{rank}:("{txID}", {txTime}, {weiToEth(amount)})'
+            for (src, dst, rank), (txID, txTime, amount) in transfers.items()
+        ]
+        for start in range(0, len(transferRows), maxRows):
+            queries.append(
+                'INSERT EDGE IF NOT EXISTS transfer(txid, time, amount) VALUES ' + ", ".join(transferRows[start:(start + maxRows)])
+            )
+
+        # Aggregates accumulate values, UPSERT has no multi-row form, so send all of them as one multi-statement query
+        edgeRows = [
+            f'UPSERT EDGE on linked_to "{src}"->"{dst}" SET amount = amount + {weiToEth(amount)}, count = count + {count}'
+            for (src, dst), (amount, count) in edges.items()
+        ]
+        for start in range(0, len(edgeRows), maxRows):
+            queries.append("; ".join(edgeRows[start:(start + maxRows)]))
+        return queries
+
+    # Writes rows as multi-row queries, sent concurrently (each runs on its own worker)
+    async def writeBatch(self, vertices={}, edges={}, transfers={}, maxRows=1000):
+        queries = self.buildQueries(vertices, edges, transfers, maxRows)
+        # Statements of failed UPSERT batch could be partly applied, running it again would add their values twice
+        results = await asyncio.gather(*[self.execAsync(query, retry=(statementType(query) != "UPSERT")) for query in queries])
+        return len(queries), results.count(None)
+
+    # Runs given blocking method on worker thread and awaits its result
+    async def runAsync(self, func, *args, **kwargs):
+        # Executor not created yet (still initializing), run directly
+        if not self.executor:
+            return func(*args, **kwargs)
+        with Profiler.awaiting("nebula"):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    # Awaitable variant of execNebulaCommand() not blocking event loop
+    async def execAsync(self, command="", retry=True):
+        return await self.runAsync(self.execNebulaCommand, command, cnt=(1 if retry else 0))
+
     # Helper to catch eventual execution errors
     def execNebulaCommand(self, command="", cnt=1):
+        statement = statementType(command)
         try:
             assert self.session
-            resp = self.session.execute(command)
+            with QUERY_SECONDS.time(statement=statement):
+                resp = self.session.execute(command)
             # Check for execution errors
             assert resp.is_succeeded(), resp.error_msg()
             # Return result (required in some use-cases)
             return resp
         except Exception as e:
             Out.error(f"execNebulaCommand(): {e}")
-            # Tried again with new session, but still fails, return
+            QUERY_ERRORS.inc(statement=statement)
+            # Tried again with new session (or retry not allowed), but still fails, return
             if cnt == 0:
                 return None
             # Ensure we have valid session
@@ -156,6 +298,35 @@ class NebulaAPI(BaseAPI):
         # Create list and return it
         return [val.cast_primitive() for val in result.column_values(pivot)]
 
+    # Transform subgraph result (nodes and links columns) into deduplicated nodes and edges for visualization
+    def toGraphTransform(self, result=None):
+        nodes, edges = {}, {}
+        if not result or result.is_empty():
+            return {"nodes": [], "edges": []}
+
+        for column in ("nodes", "links"):
+            for value in result.column_values(column):
+                for item in value.as_list():
+                    if item.is_vertex():
+                        node   = item.as_node()
+                        nodeID = node.get_id().cast_primitive()
+                        # Subgraphs of multiple deposits share vertices, keep each once
+                        if nodeID not in nodes:
+                            nodes[nodeID] = {
+                                "id"    : nodeID,
+                                "props" : {key: val.cast_primitive() for key, val in node.properties("address").items()}
+                            }
+                    elif item.is_edge():
+                        edge = item.as_relationship()
+                        src, dst = edge.start_vertex_id().cast_primitive(), edge.end_vertex_id().cast_primitive()
+                        if (src, dst, edge.ranking()) not in edges:
+                            edges[(src, dst, edge.ranking())] = {
+                                "src"   : src,
+                                "dst"   : dst,
+                                "props" : {key: val.cast_primitive() for key, val in edge.properties().items()}
+                            }
+        return {"nodes": list(nodes.values()), "edges": list(edges.values())}
+
     def getAddrsOfType(self, addrType="", targetParam="id(v)"):
         # Make query to get all addresses of given type
         result = self.execNebulaCommand(
@@ -163,4 +334,110 @@ class NebulaAPI(BaseAPI):
         )
         # Handle result
         return self.toArrayTransform(result, targetParam)
+
+    # Count addresses of given type without transferring them (uses type index)
+    def countAddrsOfType(self, addrType=""):
+        result = self.execNebulaCommand(
+            f'LOOKUP ON address WHERE address.type == "{addrType}" YIELD id(vertex) AS id | YIELD COUNT(*) AS cnt'
+        )
+        return (self.toArrayTransform(result, "cnt") or [0])[0]
+
+    # Yields pages of addresses of given type, page is list of values (or tuples of values for multiple params)
+    # Each page continues after highest ID of previous one, so no rows are skipped over
+    async def iterAddrsOfType(self, addrType="", *targetParams, pageSize=None):
+        targetParams = targetParams or ("id(v)",)
+        pageSize = pageSize or self.conf.get("pageSize", 10000)
+        columns  = ", ".join(f"{param} AS c{index}" for index, param in enumerate(targetParams))
+        lastId = ""
+        while True:
+            result = await self.execAsync(
+                f'MATCH (v:address) WHERE v.address.type == "{addrType}" AND id(v) > "{escapeStr(lastId)}" '
+                f'RETURN id(v) AS vid, {columns} ORDER BY vid LIMIT {pageSize}'
+            )
+            values = [self.toArrayTransform(result, f"c{index}") for index in range(len(targetParams))]
+            page   = values[0] if len(targetParams) == 1 else list(zip(*values))
+            if page:
+                yield page
+            if len(page) < pageSize:
+                break
+            lastId = self.toArrayTransform(result, "vid")[-1]
+
+    async def getSubgraph(self, depoAddrs=[]):
+        depoList = ", ".join(f'"{depoAddr}"' for depoAddr in depoAddrs)
+        result = await self.execAsync(
+            f'GET SUBGRAPH WITH PROP 1 STEPS FROM {depoList} BOTH linked_to YIELD VERTICES AS nodes, EDGES AS links'
+        )
+        return self.toGraphTransform(result) if result is not None else None
+
+    # First page contains deposit(s) with their exchanges, then linked addresses follow, strongest links (most txs) first
+    # Page continues after given (count, amount, src, dst) of last edge of previous page, filter is evaluated by storage
+    async def getClusterPage(self, depoAddrs=[], after=None, limit=1000):
+        depoList = ", ".join(f'"{depoAddr}"' for depoAddr in depoAddrs)
+        yieldCols = (
+            'YIELD src(edge) AS src, dst(edge) AS dst, properties(edge).amount AS amount, properties(edge).count AS count, '
+            'id($$) AS id, properties($$).name AS name, properties($$).type AS type'
+        )
+        afterFilter = ""
+        if after:
+            count, amount, src, dst = int(after[0]), float(after[1]), escapeStr(after[2]), escapeStr(after[3])
+            afterFilter = (
+                f'WHERE properties(edge).count < {count} OR (properties(edge).count == {count} AND '
+                f'(properties(edge).amount < {amount!r} OR (properties(edge).amount == {amount!r} AND '
+                f'(src(edge) > "{src}" OR (src(edge) == "{src}" AND dst(edge) > "{dst}"))))) '
+            )
+        # Fetch one extra row to know if there is next page
+        queries = [
+            f'GO FROM {depoList} OVER linked_to REVERSELY {afterFilter}{yieldCols} '
+            f'| ORDER BY $-.count DESC, $-.amount DESC, $-.src, $-.dst | LIMIT {limit + 1}'
+        ]
+        if not after:
+            queries.append(f'GO FROM {depoList} OVER linked_to {yieldCols}')
+            queries.append(f'FETCH PROP ON address {depoList} YIELD id(vertex) AS id, properties(vertex).name AS name, properties(vertex).type AS type')
+        results = await asyncio.gather(*[self.execAsync(query) for query in queries])
+        if None in results:
+            return None
+
+        rows = lambda result, *cols: list(zip(*[self.toArrayTransform(result, col) for col in cols]))
+        edgeCols = ("src", "dst", "amount", "count", "id", "name", "type")
+        linkedRows = rows(results[0], *edgeCols)
+        edgeRows   = linkedRows[:limit]
+        nextCursor = None
+        if len(linkedRows) > limit:
+            src, dst, amount, count = edgeRows[-1][:4]
+            nextCursor = (count, amount, src, dst)
+        nodes = {}
+        if not after:
+            edgeRows = rows(results[1], *edgeCols) + edgeRows
+            nodes = {nodeID: {"id": nodeID, "props": {"name": name, "type": nodeType}} for nodeID, name, nodeType in rows(results[2], "id", "name", "type")}
+
+        edges = []
+        for src, dst, amount, count, nodeID, name, nodeType in edgeRows:
+            nodes.setdefault(nodeID, {"id": nodeID, "props": {"name": name, "type": nodeType}})
+            edges.append({"src": src, "dst": dst, "props": {"amount": amount, "count": count}})
+        return {"nodes": list(nodes.values()), "edges": edges, "nextCursor": nextCursor}
+
+    async def getEdgeTxs(self, srcAddr="", dstAddr=""):
+        result = await self.execAsync(
+            f'GO FROM "{escapeStr(srcAddr)}" OVER transfer WHERE dst(edge) == "{escapeStr(dstAddr)}" '
+            f'YIELD properties(edge).txid AS txid, properties(edge).time AS time, properties(edge).amount AS amount '
+            f'| ORDER BY $-.time DESC'
+        )
+        return list(zip(
+            self.toArrayTransform(result, "txid"),
+            self.toArrayTransform(result, "time"),
+            self.toArrayTransform(result, "amount")
+        ))
+
+    async def clearGraph(self):
+        await self.execAsync(f'CLEAR SPACE IF EXISTS {self.targetSpace}')
+
+    async def rebuildIndexes(self):
+        await self.execAsync('REBUILD TAG INDEX addrs_index')
+
+    # Returns (address, deposit) pairs of all addresses linked to deposit addresses
+    def getDepositLinks(self):
+        result = self.execNebulaCommand(
+            'MATCH (v:address)-[:linked_to]->(d:address) WHERE d.address.type == "deposit" RETURN id(v) AS addr, id(d) AS deposit'
+        )
+        return list(zip(self.toArrayTransform(result, "addr"), self.toArrayTransform(result, "deposit")))
 # NebulaAPI class end
@@ -0,0 +1,107 @@
+###################################
+# @file Response_Recorder.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Records Blockbook responses to compressed NDJSON and replays them without network.
+###################################
+
+# Imports
+import asyncio, gzip, json, os, random
+from .Base_Class import Out
+
+# Recorded responses are flushed to file after this count, so crash loses only the rest
+FLUSH_EVERY = 100
+
+# Async file-like reader over bytes, accepted by ijson's async parsers
+class BytesReader():
+    def __init__(self, data=b""):
+        self.data   = data
+        self.offset = 0
+
+    async def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.data) - self.offset
+        chunk = self.data[self.offset:(self.offset + size)]
+        self.offset += len(chunk)
+        return chunk
+# End of BytesReader class
+
+class ResponseRecorder():
+    def __init__(self, mode="off", path="blockbook_responses.ndjson.gz", latency=0.0, jitter=0.0):
+        # One of: "off", "record", "replay"
+        self.mode = mode
+        self.path = path
+        # Seconds each replayed response waits (plus random part up to jitter) to mimic network
+        self.latency = latency
+        self.jitter  = jitter
+        self.file      = None
+        self.responses = {}
+        self.stats = {
+            "recorded" : 0,
+            "replayed" : 0,
+            "missing"  : 0
+        }
+        if mode == "replay":
+            self.load()
+
+    def isReplaying(self):
+        return self.mode == "replay"
+
+    def isRecording(self):
+        return self.mode == "record"
+
+    # Identifies response by endpoint and params (independent of their order)
+    # Params include block ranges, which depend on watermarks, pinned highest block and pageSize,
+    # so replayed refresh must start from same state as recorded one (cleared graph and watermarks, same config)
+    def responseKey(self, endpoint="", params=None):
+        return f"{endpoint}?{json.dumps(params or {}, sort_keys=True)}"
+
+    # Store response body, returns reader to parse it
+    def record(self, endpoint="", params=None, body=b""):
+        # Append new gzip member, older recordings are kept
+        if not self.file:
+            self.file = gzip.open(self.path, "at", encoding="utf-8")
+        self.file.write(json.dumps({"key": self.responseKey(endpoint, params), "body": body.decode("utf-8")}) + "\n")
+        self.stats["recorded"] += 1
+        if self.stats["recorded"] % FLUSH_EVERY == 0:
+            self.file.flush()
+        return BytesReader(body)
+
+    # Read all recorded responses, latest recording of same request wins
+    def load(self):
+        if not os.path.exists(self.path):
+            Out.warning(f"No recorded responses found: {self.path}")
+            return
+
+        with gzip.open(self.path, "rt", encoding="utf-8") as file:
+            try:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line could be cut by crash, ignore it
+                        continue
+                    self.responses[record["key"]] = record["body"].encode("utf-8")
+            except EOFError:
+                # Recording not closed (crash), responses till last flush are kept
+                Out.warning(f"Recorded responses end unexpectedly: {self.path}")
+        Out.blank(f"Loaded {len(self.responses)} recorded responses")
+
+    # Returns reader of recorded response, None when request wasn't recorded
+    async def replay(self, endpoint="", params=None):
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        body = self.responses.get(self.responseKey(endpoint, params))
+        if body is None:
+            self.stats["missing"] += 1
+            if self.stats["missing"] == 1:
+                Out.warning("Request not recorded, replay needs same initial state as recording (cleared graph and watermarks, same config)")
+            return None
+
+        self.stats["replayed"] += 1
+        return BytesReader(body)
+
+    # Finish gzip member, called after each refresh, next recording appends new one
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+# End of ResponseRecorder class
@@ -5,11 +5,25 @@
 ###################################
 
 # Imports
-import ijson, asyncio
+import ijson, asyncio, random, time, atexit
 from .Base_Class import *
+from .Adaptive_Limiter import AdaptiveLimiter
+from .Response_Recorder import ResponseRecorder
+from .Tx_Decoder import decodePage
 from ..Session import SessionManager
 from dateutil import parser
 
+# Request metrics, labeled by endpoint ("status", "address")
+REQUEST_SECONDS = Metrics.histogram("blockbook_request_seconds", "Time until Blockbook response headers arrive", ("endpoint",))
+REQUEST_RETRIES = Metrics.counter("blockbook_retries_total", "Retried Blockbook requests", ("endpoint",))
+REQUEST_ERRORS  = Metrics.counter("blockbook_errors_total", "Failed Blockbook request attempts", ("endpoint", "kind"))
+REQUEST_FAILED  = Metrics.counter("blockbook_failed_total", "Blockbook requests failing all attempts", ("endpoint",))
+
+def endpointLabel(endpoint=""):
+    # Drop address from path to keep count of label values low
+    parts = endpoint.split("/")
+    return parts[1] if len(parts) > 1 else endpoint
+
 # Class handling interaction with Trezor Blockbook API
 class TrezorAPI(BaseAPI):
     def __init__(self, file="configFile.yaml"):
@@ -17,67 +31,193 @@ class TrezorAPI(BaseAPI):
         conf = yaml.safe_load(self.openConfigFile(file))["trezor"]
         # Init parent class
         super().__init__(conf["url"])
-        self.semaphore = asyncio.Semaphore(30)
-        # Block sending GET() when session is being re-creating
-        self.sessionCreating = asyncio.Event()
-        self.sessionCreating.set()
+        # Count of concurrent requests adapts to server's condition
+        limits = conf.get("concurrency", {})
+        self.limiter = AdaptiveLimiter(
+            initial       = limits.get("initial", 30),
+            minLimit      = limits.get("min", 4),
+            maxLimit      = limits.get("max", 256),
+            targetLatency = limits.get("targetLatency", 5.0)
+        )
+        # Requests of page renders (status) have own slots, so they never wait behind running refresh
+        interactive = limits.get("interactive", 4)
+        self.interactiveLimiter = AdaptiveLimiter(
+            initial       = interactive,
+            minLimit      = interactive,
+            maxLimit      = interactive,
+            targetLatency = limits.get("targetLatency", 5.0)
+        )
+        # HTTP client shared by all requests for whole app's lifetime
+        self.session = SessionManager(connection=conf.get("connection", {}))
+        # Responses can be recorded to file and later replayed instead of contacting server
+        recorder = conf.get("recorder", {})
+        self.recorder = ResponseRecorder(
+            mode    = recorder.get("mode", "off"),
+            path    = recorder.get("path", "blockbook_responses.ndjson.gz"),
+            latency = recorder.get("latency", 0.0),
+            jitter  = recorder.get("jitter", 0.0)
+        )
+        atexit.register(self.recorder.close)
+        # Max transactions per requested page (Blockbook allows up to 1000)
+        self.pageSize = conf.get("pageSize", 1000)
         # Store latest blockbook status value(s)
         self.heighestBlock = 0
         self.lastBlockTime = None
+        # Cached status: fresh for statusTTL seconds, served while refreshed in background up to statusMaxAge
+        self.statusTTL    = conf.get("statusTTL", 10)
+        self.statusMaxAge = conf.get("statusMaxAge", 300)
+        self.status       = None
+        self.statusTime   = 0.0
+        # Only one status request at time
+        self.statusTask   = None
 
     # Returns latest sync date among with best block
-    async def getCurrentClientData(self):
-        async with SessionManager() as session:
-            # Extract needed items
-            self.heighestBlock = await anext(self.get(session, "api/status", key="blockbook.bestHeight"))
-            self.lastBlockTime = await anext(self.get(session, "api/status", key="blockbook.lastBlockTime"))
-            # Check if valid server response
-            if not self.heighestBlock or not self.lastBlockTime:
-                return None
-
-            return {
-                "maxBlock" : self.heighestBlock, # Get heighest block available by blockchain client
-                "syncTime" : parser.isoparse(self.lastBlockTime).strftime("%Y-%m-%d, %H:%M")
-            }
-
-    async def get(self, session=None, endpoint="", params=None, key=None):
+    async def getCurrentClientData(self, fresh=False):
+        age = time.monotonic() - self.statusTime
+        if not fresh and self.statusTime and age < self.statusTTL:
+            return self.status
+
+        # Join already running request or start new one
+        if not self.statusTask or self.statusTask.done():
+            self.statusTask = asyncio.create_task(self.fetchClientData())
+            # Nobody awaits task refreshing status in background, report its failure
+            self.statusTask.add_done_callback(self.onStatusFetched)
+        # Recent value exists, don't wait for Blockbook
+        if not fresh and self.statusTime and age < self.statusMaxAge:
+            return self.status
+        return await asyncio.shield(self.statusTask)
+
+    def onStatusFetched(self, task):
+        if not task.cancelled() and task.exception():
+            Out.error(f"fetchClientData(): {task.exception()}")
+
+    # Failed request keeps last good status (and its age), None is returned to its awaiters
+    async def fetchClientData(self):
+        # Extract needed items from single response
+        stream = self.get(endpoint="api/status", key=("blockbook.bestHeight", "blockbook.lastBlockTime"), limiter=self.interactiveLimiter)
+        try:
+            values = await anext(stream) or {}
+        finally:
+            await stream.aclose()
+
+        # Check if valid server response
+        if not values.get("blockbook.bestHeight") or not values.get("blockbook.lastBlockTime"):
+            return None
+
+        self.heighestBlock = values["blockbook.bestHeight"]
+        self.lastBlockTime = values["blockbook.lastBlockTime"]
+        self.status = {
+            "maxBlock" : self.heighestBlock, # Get heighest block available by blockchain client
+            "syncTime" : parser.isoparse(self.lastBlockTime).strftime("%Y-%m-%d, %H:%M")
+        }
+        self.statusTime = time.monotonic()
+        return self.status
+
+    # Parse key's value (or dict of values for multiple keys) or page of transactions (header dict, then Tx tuples) from given content stream
+    async def parseContent(self, content, key=None):
+        if key:
+            keys  = key if isinstance(key, tuple) else (key,)
+            found = {}
+            async for prefix, _, value in ijson.parse_async(content):
+                if prefix in keys:
+                    found[prefix] = value
+                    # Stop parsing once all are found
+                    if len(found) == len(keys):
+                        break
+            yield found if isinstance(key, tuple) else found.get(key)
+        else: # Return header and decoded transactions of response content stream
+            async for item in decodePage(content):
+                yield item
+
+    # Variant of get() serving recorded responses
+    async def replay(self, endpoint="", params=None, key=None, raiseOnFail=False, limiter=None):
+        limiter = limiter if limiter else self.limiter
+        async with limiter:
+            start   = time.monotonic()
+            content = await self.recorder.replay(endpoint, params)
+            Profiler.addAwait("blockbook_response", time.monotonic() - start)
+            if content is None:
+                Out.error(f"replay(): no recorded response for {endpoint} {params}")
+                if raiseOnFail:
+                    raise aiohttp.ClientError(f"replay(): no recorded response for {endpoint}")
+            else:
+                limiter.onSuccess(time.monotonic() - start)
+                async for item in self.parseContent(content, key):
+                    yield item
+        # End of stream
+        yield None
+
+    # Requests are limited by refresh's limiter unless other is given
+    async def get(self, session=None, endpoint="", params=None, key=None, raiseOnFail=False, limiter=None):
+        limiter = limiter if limiter else self.limiter
+        if self.recorder.isReplaying():
+            async for item in self.replay(endpoint, params, key, raiseOnFail, limiter):
+                yield item
+            return
+
+        # Use shared session unless other is given
+        session = session if session else self.session
         # Construct target URL
         url = self.url + endpoint
+        label = endpointLabel(endpoint)
+        # Yielded items can't be taken back, stream broken after them isn't requested again
+        yielded = False
         for attempt in range(1, 4):
-            async with self.semaphore:
+            # Wait before retrying, random part spreads retries of concurrent requests
+            if attempt > 1:
+                limiter.stats["retries"] += 1
+                REQUEST_RETRIES.inc(endpoint=label)
+                await asyncio.sleep(random.uniform(0, min(30, 2 ** attempt)))
+
+            async with limiter:
                 try:
-                    await self.sessionCreating.wait()
                     currentSession = await session.getSession()
+                    start = time.monotonic()
                     async with currentSession.get(url, headers=self.headers, params=params, timeout=self.timeout, ssl=False) as response:
+                        REQUEST_SECONDS.observe(time.monotonic() - start, endpoint=label)
+                        Profiler.addAwait("blockbook_response", time.monotonic() - start)
+                        # Server is overloaded
+                        if response.status >= 500:
+                            limiter.onOverload()
                         # Check response status
                         response.raise_for_status()
+                        limiter.onSuccess(time.monotonic() - start)
+                        session.onSuccess()
                         # Check for invalid response type
                         if response.content_type != "application/json":
+                            REQUEST_ERRORS.inc(endpoint=label, kind="content_type")
                             continue
 
-                        # Try to get key's value
-                        if key:
-                            async for prefix, _, value in ijson.parse_async(response.content):
-                                if prefix == key:
-                                    yield value
-                                    break
-                        else: # Return response content stream
-                            async for tx in ijson.items_async(response.content, "transactions.item"):
-                                yield tx
+                        content = response.content
+                        # Whole body is needed to store it
+                        if self.recorder.isRecording():
+                            content = self.recorder.record(endpoint, params, await response.read())
+                        async for item in self.parseContent(content, key):
+                            yielded = True
+                            yield item
                         break
                 except aiohttp.ClientConnectorError as e:
                     Out.error(f"get(): Connector error: {e}, remaining attemps {3 - attempt}")
-                    # Other coroutine already re-creating session, skip
-                    if not session.creatingSession.is_set():
-                        continue
-                    # Block other coroutines from sending GET()
-                    self.sessionCreating.clear()
-                    # Re-create session
-                    await session.createSession()
-                    self.sessionCreating.set()
-                except (Exception, asyncio.TimeoutError, asyncio.CancelledError) as e:
+                    REQUEST_ERRORS.inc(endpoint=label, kind="connector")
+                    # Re-create session if connection keeps failing
+                    await session.onConnectorError()
+                except asyncio.TimeoutError:
+                    limiter.onOverload()
+                    Out.error(f"get(): Timeout for {endpoint}, remaining attemps {3 - attempt}")
+                    REQUEST_ERRORS.inc(endpoint=label, kind="timeout")
+                except Exception as e:
                     # Output exception
                     Out.error(f"get(): {e}, remaining attemps {3 - attempt}")
+                    REQUEST_ERRORS.inc(endpoint=label, kind="http" if isinstance(e, aiohttp.ClientResponseError) else "other")
+            # Retry would start stream again in middle of already yielded items
+            if yielded:
+                REQUEST_FAILED.inc(endpoint=label)
+                raise aiohttp.ClientPayloadError(f"get(): response of {endpoint} broken after part of it was received")
+        else:
+            REQUEST_FAILED.inc(endpoint=label)
+            # Let caller know stream is incomplete (otherwise indistinguishable from empty one)
+            if raiseOnFail:
+                raise aiohttp.ClientError(f"get(): all attempts for {endpoint} failed")
         # End of stream
         yield None
 # TrezorAPI class end
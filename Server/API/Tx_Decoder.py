@@ -0,0 +1,104 @@
+###################################
+# @file Tx_Decoder.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Decodes Blockbook transactions into compact tuples of fields used by clustering.
+###################################
+
+# Imports
+import ijson
+from collections import namedtuple
+from .Base_Class import Out, Metrics
+
+# Const representing value of 1 Wei
+ETH_WEI = 1_000_000_000_000_000_000
+# ijson backends from fastest, C one builds items without creating Python objects for every event
+BACKENDS = ("yajl2_c", "yajl2_cffi", "yajl2", "python")
+# Values of address response read before its transactions
+PAGE_KEYS  = ("totalPages",)
+# Bytes of response fed to parsers at once
+CHUNK_SIZE = 64 * 1024
+
+TX_DECODE_ERRORS = Metrics.counter("tx_decode_errors_total", "Transactions skipped as malformed")
+TX_DECODER_INFO  = Metrics.gauge("tx_decoder_backend_info", "ijson backend used to decode transactions", ("backend",))
+
+def selectBackend():
+    for name in BACKENDS:
+        try:
+            return name, ijson.get_backend(name)
+        except ImportError:
+            continue
+    return ijson.backend, ijson
+
+BACKEND_NAME, BACKEND = selectBackend()
+TX_DECODER_INFO.set(1, backend=BACKEND_NAME)
+if BACKEND_NAME != BACKENDS[0]:
+    Out.warning(f"ijson C backend unavailable, decoding transactions by: {BACKEND_NAME}")
+
+# Fields of transaction needed by clustering, value in Wei (int), times left as epoch until displayed
+Tx = namedtuple("Tx", ("txid", "fromAddr", "toAddr", "value", "blockTime", "blockHeight", "data"))
+
+# Conversion at boundary of graph storage, amounts are summed as exact integers till then
+def weiToEth(wei=0):
+    return wei / ETH_WEI
+
+# Raises KeyError, IndexError, TypeError or ValueError for malformed transaction
+def decodeTx(item={}):
+    vout = item["vout"][0]
+    return Tx(
+        txid        = item["txid"],
+        fromAddr    = item["vin"][0]["addresses"][0],
+        toAddr      = vout["addresses"][0],
+        value       = int(vout["value"]),
+        blockTime   = int(item["blockTime"]),
+        blockHeight = int(item.get("blockHeight", 0)),
+        data        = item["ethereumSpecific"]["data"]
+    )
+
+# Tx tuples of given items, malformed ones are skipped
+def decodeItems(items=[]):
+    for item in items:
+        try:
+            yield decodeTx(item)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            Out.error(f"decodeItems(): malformed transaction {item.get('txid') if isinstance(item, dict) else ''}: {e!r}, skipping")
+            TX_DECODE_ERRORS.inc()
+
+# Async generator of Tx tuples from "transactions" of address response stream
+async def decodeTxs(content, backend=BACKEND):
+    async for item in backend.items_async(content, "transactions.item"):
+        for tx in decodeItems((item,)):
+            yield tx
+
+# Async generator of address response page: dict of header values (PAGE_KEYS) first, then Tx tuples
+# Both are read from single pass over stream, header parser is dropped once header is read
+async def decodePage(content, keys=PAGE_KEYS, backend=BACKEND):
+    header, events, items = {}, ijson.sendable_list(), ijson.sendable_list()
+    headerParser = backend.parse_coro(events)
+    itemsParser  = backend.items_coro(items, "transactions.item")
+    headerSent   = False
+    while chunk := await content.read(CHUNK_SIZE):
+        if not headerSent:
+            headerParser.send(chunk)
+            for prefix, _, value in events:
+                if prefix in keys:
+                    header[prefix] = value
+                # Header values precede transactions
+                elif prefix == "transactions":
+                    headerSent = True
+            del events[:]
+            if headerSent or len(header) == len(keys):
+                headerSent = True
+                yield header
+
+        itemsParser.send(chunk)
+        for tx in decodeItems(items):
+            yield tx
+        del items[:]
+
+    # Response without transactions
+    if not headerSent:
+        yield header
+    # Raises for truncated response
+    itemsParser.close()
+    for tx in decodeItems(items):
+        yield tx
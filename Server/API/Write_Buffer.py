@@ -0,0 +1,132 @@
+###################################
+# @file Write_Buffer.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Buffers graph writes and flushes them as multi-row queries.
+###################################
+
+# Imports
+import asyncio, time
+from .Base_Class import Out
+from Helpers import Cache, Profiler
+from .Nebula_Class import txRank
+
+# Class gathering vertices and edges and writing them to graph backend in batches
+class NebulaWriteBuffer():
+    def __init__(self, nebulaAPI, maxRows=None, maxDelay=None):
+        # Store graph backend (Nebula class) instance
+        self.nebula = nebulaAPI
+        # Flush thresholds (rows pending, seconds since last flush)
+        self.maxRows  = maxRows  if maxRows  else nebulaAPI.conf.get("batchSize", 1000)
+        self.maxDelay = maxDelay if maxDelay else nebulaAPI.conf.get("flushInterval", 5)
+        # Pending vertices: addr -> (name, type)
+        self.vertices = {}
+        # Pending aggregated edges: (src, dst) -> [amount, count]
+        self.edges = {}
+        # Pending transaction edges: (src, dst, rank) -> (txid, time, amount)
+        self.transfers = {}
+        # Functions to call once currently pending rows are written: (owner address, callback)
+        self.callbacks = []
+        # Addresses (parents of pending rows) whose rows are pending
+        self.owners = set()
+        self.lastFlush = time.monotonic()
+        # Only one flush at time
+        self.flushLock = asyncio.Lock()
+        self.resetStats()
+
+    def resetStats(self):
+        self.stats = {
+            "flushes"    : 0,
+            "roundTrips" : 0,
+            "vertices"   : 0,
+            "edges"      : 0,
+            "transfers"  : 0,
+            "failed"     : 0,
+            "flushTime"  : 0.0
+        }
+        # Addresses having rows in failed flush, their progress is never confirmed (till next refresh)
+        self.failedOwners = set()
+
+    # Count of rows waiting for flush
+    def pendingRows(self):
+        return len(self.vertices) + len(self.edges) + len(self.transfers)
+
+    # Buffered variant of NebulaAPI.addNodeToGraph()
+    # Amounts are kept in Wei, so sums stay exact till written
+    async def addNode(self, addr="", addrName="", parentAddr="", nodeType="", txID="", txTime=0, amount=0):
+        # First inserted vertex wins (same as INSERT VERTEX IF NOT EXISTS)
+        self.vertices.setdefault(addr, (addrName, nodeType))
+        # Rows belong to crawled (parent) address, exchange vertex to itself
+        self.owners.add(parentAddr or addr)
+        # Parent address is given so create a path to it, merge with already pending one
+        if parentAddr != "":
+            edge = self.edges.setdefault((addr, parentAddr), [0, 0])
+            edge[0] += amount
+            if txID:
+                edge[1] += 1
+                self.transfers[(addr, parentAddr, txRank(txID))] = (txID, txTime, amount)
+
+        # Flush when enough rows gathered or when buffer waits too long
+        if self.pendingRows() >= self.maxRows or (time.monotonic() - self.lastFlush) >= self.maxDelay:
+            # Includes waiting for flush of other task
+            with Profiler.awaiting("write_buffer"):
+                await self.flush()
+
+    # Register function called after next successful flush (e.g. to persist progress of written rows)
+    # Callback of owner address is dropped once any of its rows failed to be written
+    def afterFlush(self, callback, owner=""):
+        self.callbacks.append((owner, callback))
+
+    # Writes all pending rows to database
+    async def flush(self):
+        async with self.flushLock:
+            # Swap pending rows so others can continue filling buffer
+            vertices, self.vertices = self.vertices, {}
+            edges, self.edges       = self.edges, {}
+            transfers, self.transfers = self.transfers, {}
+            callbacks, self.callbacks = self.callbacks, []
+            owners, self.owners       = self.owners, set()
+            self.lastFlush = time.monotonic()
+            if not vertices and not edges:
+                self.runCallbacks(callbacks)
+                return
+
+            start = time.perf_counter()
+            try:
+                roundTrips, failed = await self.nebula.writeBatch(vertices, edges, transfers, self.maxRows)
+            except Exception as e:
+                Out.error(f"flush(): {e}")
+                roundTrips, failed = 0, 1
+            self.stats["roundTrips"] += roundTrips
+            self.stats["failed"]     += failed
+            self.stats["flushes"]   += 1
+            self.stats["vertices"]  += len(vertices)
+            self.stats["edges"]     += len(edges)
+            self.stats["transfers"] += len(transfers)
+            self.stats["flushTime"] += (time.perf_counter() - start)
+
+            # Rows of these addresses are lost, their watermarks and checkpoints must not advance
+            if failed:
+                Out.error(f"flush(): {failed} queries failed, progress of {len(owners)} addresses won't be saved")
+                self.failedOwners |= owners
+            # Confirm written rows to waiting callbacks (unowned ones only after successful flush)
+            self.runCallbacks(callbacks, failed)
+
+    def runCallbacks(self, callbacks, failed=0):
+        # Callbacks mostly persist progress, commit all their cache writes at once
+        with Cache.batch():
+            for owner, callback in callbacks:
+                if (owner and owner in self.failedOwners) or (not owner and failed):
+                    continue
+                try:
+                    callback()
+                except Exception as e:
+                    Out.error(f"runCallbacks(): {e}")
+
+    # Output flush statistics
+    def report(self):
+        Out.blank(
+            f"Write buffer: {self.stats['flushes']} flushes, {self.stats['roundTrips']} round trips, "
+            f"{self.stats['vertices']} vertices, {self.stats['edges']} edges, {self.stats['transfers']} transactions, "
+            f"{self.stats['failed']} failed queries, {self.stats['flushTime']:.2f}s spent flushing"
+        )
+# NebulaWriteBuffer class end
@@ -5,4 +5,9 @@
 
 # Import all module properties
 from .Trezor_Class import TrezorAPI
+from .Tx_Decoder import Tx, decodeTxs, decodePage, weiToEth, ETH_WEI
 from .Nebula_Class import NebulaAPI
+from .Write_Buffer import NebulaWriteBuffer
+from .Response_Recorder import ResponseRecorder
+from .Graph_Backend import GraphBackend, createGraphBackend
+from .Memory_Graph import MemoryGraph
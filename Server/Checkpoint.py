@@ -0,0 +1,117 @@
+###################################
+# @file Checkpoint.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Durable log of finished refresh units allowing to resume interrupted refresh.
+###################################
+
+# Imports
+import json, os, time
+from Helpers import Out
+
+class CheckpointLog():
+    def __init__(self, path="refresh_checkpoint.jsonl"):
+        self.path = path
+        self.file = None
+        # Header of current run (params, pinned block height)
+        self.run  = None
+        self.done = set()
+        self.finished = False
+
+    # Starts new run or resumes unfinished one with same params, returns True when resuming
+    def start(self, params={}, toBlock=0):
+        self.close()
+        self.load()
+        if self.run and not self.finished and self.run.get("params") == params:
+            Out.warning(f"Resuming refresh run {self.run['id']}, {len(self.done)} units already done")
+            self.file = open(self.path, "a", encoding="utf-8")
+            return True
+
+        # Begin new run, previous log is no longer needed
+        self.run = {
+            "id"      : time.strftime("%Y%m%d-%H%M%S"),
+            "params"  : params,
+            # Keep same block range when resuming, so pages contain same txs
+            "toBlock" : toBlock
+        }
+        self.done     = set()
+        self.finished = False
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.write({"run": self.run}, sync=True)
+        return False
+
+    # Continue writing log of run started by other process (refresh worker), only given units are known as done
+    def attach(self, done=()):
+        self.done = set(tuple(unit) for unit in done)
+        if not self.file:
+            self.file = open(self.path, "a", encoding="utf-8")
+
+    # Read existing log (if any)
+    def load(self):
+        self.run, self.done, self.finished = None, set(), False
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line could be cut by crash, ignore it
+                    continue
+                if "run" in record:
+                    self.run = record["run"]
+                elif "unit" in record:
+                    self.done.add(tuple(record["unit"]))
+                elif record.get("finished"):
+                    self.finished = True
+
+    # Append record to log, OS keeps it even when process gets killed
+    def write(self, record, sync=False):
+        if not self.file:
+            return
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        # Survive also system crash
+        if sync:
+            os.fsync(self.file.fileno())
+
+    # Unit is tuple, e.g. ("stage", "exchanges"), ("addr", nodeType, addr) or ("range", nodeType, addr, fromBlock, toBlock, page)
+    def isDone(self, *unit):
+        return unit in self.done
+
+    def markDone(self, *unit, sync=False):
+        if unit in self.done:
+            return
+        self.done.add(unit)
+        self.write({"unit": list(unit)}, sync=sync)
+
+    def finish(self):
+        self.finished = True
+        self.write({"finished": True}, sync=True)
+        self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    # Overview of how much of current (or last) run is done
+    def summary(self):
+        if self.run is None:
+            self.load()
+        if self.run is None:
+            return {}
+
+        summary = {
+            **self.run,
+            "finished"   : self.finished,
+            "stagesDone" : [unit[1] for unit in self.done if unit[0] == "stage"],
+            "addrsDone"  : {},
+            "rangesDone" : {}
+        }
+        for unit in self.done:
+            if unit[0] in ("addr", "range"):
+                counter = summary[f"{unit[0]}sDone"]
+                counter[unit[1]] = counter.get(unit[1], 0) + 1
+        return summary
+# End of CheckpointLog class
@@ -5,14 +5,24 @@
 ###################################
 
 # Imports
-import asyncio
+import asyncio, math, time
 from functools import partial
-from Helpers import Out, Cache
+from Helpers import Out, Cache, AddressIndex, DepositIndex, Metrics
 from .API import *
-from datetime import datetime
+from .Checkpoint import CheckpointLog
 
-# Const representing value of 1 Wei
-ETH_WEI = 1_000_000_000_000_000_000
+# Count of known addresses from which they are kept only in Bloom filter (0 = never)
+BLOOM_THRESHOLD = 0
+
+# Transactions by refresh stage and result ("processed", "skipped", "inserted", "invalid")
+TXS_TOTAL = Metrics.counter("refresh_transactions_total", "Transactions handled by refresh", ("stage", "result"))
+RANGE_SPLITS = Metrics.counter("refresh_range_splits_total", "Block ranges split for holding more than one page", ("stage",))
+
+# Split block range <fromBlock;toBlock> into given count of consecutive ranges of (nearly) same width
+def splitRange(fromBlock=0, toBlock=0, parts=1):
+    width  = toBlock - fromBlock + 1
+    bounds = [fromBlock + ((width * part) // parts) for part in range(parts + 1)]
+    return [(bounds[part], bounds[part + 1] - 1) for part in range(parts)]
 
 class DataHandler():
     def __init__(self, nebulaAPI:NebulaAPI):
@@ -21,108 +31,245 @@ class DataHandler():
             self.trezor = TrezorAPI()
             # Store Nebula class instance
             self.nebula = nebulaAPI
-            # Lists of addresses
-            self.knownDepos = []
-            self.knownExchs = []
+            # Gather graph writes and flush them in batches
+            self.writeBuffer = NebulaWriteBuffer(nebulaAPI)
+            # Log of finished work allowing to resume refresh
+            self.checkpoint = CheckpointLog()
+            # Indexes of known addresses
+            self.knownDepos = AddressIndex(bloomThreshold=BLOOM_THRESHOLD)
+            self.knownExchs = AddressIndex(bloomThreshold=BLOOM_THRESHOLD)
+            # Reverse index address -> deposit(s), used by search
+            self.depositIndex = DepositIndex()
             # Block limits (set by Heuristics class and by user)
             self.minBlock = 0
             self.maxBlock = 0
+            # Highest block of current refresh run (kept same when resuming)
+            self.toBlock = 0
+            self.resetProgress()
         except Exception as e:
             Out.error(e)
             # Exit on API error
             exit(-1)
 
+    # Start counting progress of new refresh run
+    def resetProgress(self):
+        self.progress = {
+            "stage"        : "",
+            "stageStarted" : time.time(),
+            "addrsTotal"   : 0,
+            "addrsDone"    : 0,
+            # Addresses whose transactions weren't all received
+            "addrsIncomplete" : 0,
+            "pagesDone"    : 0,
+            "txsProcessed" : 0,
+            # Wall time (s) of each finished stage
+            "stageTimes"   : {}
+        }
+
+    # Addresses are counted per refresh stage
+    def setStage(self, stage="", addrsTotal=0):
+        self.progress.update({
+            "stage"        : stage,
+            "stageStarted" : time.time(),
+            "addrsTotal"   : addrsTotal,
+            "addrsDone"    : 0,
+            "addrsIncomplete" : 0
+        })
+
     # Submits tasks to the executor making them asynchronous
     async def runParalel(self, funcsList):
         tasks = [asyncio.create_task(func()) for func in funcsList]
         return await asyncio.gather(*tasks)
 
-    # From given transactions, extract addresses
-    # Store opposite address to found one in transaction
-    async def getTxAddrs(self, session=None, addr="", addrName="", parentAddr="", nodeType="", page=1):
-        # To ensure address consistency, capitalize them
-        addr = addr.upper()
+    # Cache key (in "watermark" namespace) of last crawled block for given address and type of searched addresses
+    def watermarkKey(self, addr="", nodeType=""):
+        return f"{nodeType}:{addr.upper()}"
+
+    # Get page of address's transactions within block range <fromBlock;toBlock> (toBlock 0 = up to newest)
+    # Returns (totalPages, [Tx]) with only confirmed transactions, None when page couldn't be received
+    async def fetchRange(self, session=None, addr="", fromBlock=0, toBlock=0, page=1):
         params = {
-            "page"    : page,
-            # Skip already processed blocks (otherwise start from initial (0) block (or value set by user))
-            "from"    : self.minBlock if self.minBlock else Cache.get(addr, 0),
-            # if set use user's max block limit, else stop and client's heighest parsed block
-            "to"      : self.maxBlock if self.maxBlock else self.trezor.heighestBlock,
-            "details" : "txslight"
+            "page"     : page,
+            "pageSize" : self.trezor.pageSize,
+            "from"     : fromBlock,
+            "to"       : toBlock,
+            "details"  : "txslight"
         }
 
-        firstTx = True
-        # Iterate over received transaction records
-        async for tx in self.trezor.get(session, f"v2/address/{addr}", params=params):
-            try:
-                # None tx indicates end of list, break loop
-                if tx is None:
+        header, txs = None, []
+        try:
+            async for item in self.trezor.get(session, f"v2/address/{addr}", params=params, raiseOnFail=True):
+                # None indicates end of list, break loop
+                if item is None:
                     break
+                # First item is header of page
+                if header is None:
+                    header = item
+                # Unconfirmed transactions have no block, they are picked once included in one
+                elif item.blockHeight > 0:
+                    txs.append(item)
+        except Exception as e:
+            Out.error(f"fetchRange(): {e}")
+            return None
+        if header is None:
+            return None
 
-                txFROMAddr = str(tx.get("vin")[0].get("addresses")[0]).upper()
-                txTOAddr   = str(tx.get("vout")[0].get("addresses")[0]).upper()
-                # Convert from Wei -> Ether
-                txAmount = float(tx.get("vout")[0].get("value")) / ETH_WEI
-                # Also extract transaction ID and epoch time
-                txID   = str(tx.get("txid"))
-                txTime = datetime.fromtimestamp(float(tx.get("blockTime"))).strftime("%Y-%m-%d | %H:%M:%S")
-                # Determine if EOA transaction
-                eoaTx = (tx.get("ethereumSpecific").get("data") == "0x")
-
-                # Get first valid exchange tx and store block height to skip it next refresh
-                # Returned txs are sorted by block height in descending order (first tx is highest)
-                if nodeType == "exchange" and firstTx:
-                    firstTx = False
-                    # Get block height of newest tx
-                    blockHeight = int(tx.get("blockHeight"))
-                    Cache.set(addr, (blockHeight + 1))
-
-                # Transaction contain target address with direction is TO target address and having send Ether > 0
-                if addr in [txFROMAddr, txTOAddr] and addr == txTOAddr and txAmount > 0.0:
-                    # Exclude known exchange addresses
-                    if txFROMAddr in self.knownExchs:
-                        continue
-                    if nodeType == "leaf":
-                        # Exclude non-EOA leaf addresses
-                        # Exclude deposit addresses as leaf ones (if happens deposits transfer between each other, not valid)
-                        if not eoaTx or txFROMAddr in self.knownDepos:
-                            continue
-
-                    # Add address to graph
-                    await self.nebula.addNodeToGraph(
-                        addr       = txFROMAddr,
-                        addrName   = addrName,
-                        parentAddr = parentAddr,
-                        nodeType   = nodeType,
-                        # Don't waste other edge's params, use separators
-                        txParams   = f";{txID},{txTime},{txAmount}",
-                        amount     = txAmount
-                    )
-            except TypeError:
-                Out.error("getTxAddrs(): given tx object contains unexpected None values, skipping")
-            except Exception as e:
-                Out.error(f"getTxAddrs(): {e}")
+        self.progress["pagesDone"] += 1
+        return (header.get("totalPages") or 0), txs
 
-    # Collects all addresses targetAddr has any transactions with
-    async def getLinkedAddrs(self, session=None, targetAddr="", targetName="", parentAddr="", nodeType=""):
-        # Get total number of pages of transaction for target address
-        totalPages = await anext(self.trezor.get(session, f"v2/address/{targetAddr}", key="totalPages", params={
-            "details" : "txslight"
-        }))
-        # Check if valid server response
-        if not totalPages:
+    # From given transactions, extract addresses
+    # Store opposite address to found one in transaction
+    async def processTxs(self, txs=[], addr="", addrName="", parentAddr="", nodeType="", unit=()):
+        # Already written by interrupted run
+        if self.checkpoint.isDone(*unit):
             return
+        for tx in txs:
+            await self.processTx(tx, addr, addrName, parentAddr, nodeType)
+            self.progress["txsProcessed"] += 1
+            TXS_TOTAL.inc(stage=nodeType, result="processed")
+        # Unit is done once its addresses are written
+        self.writeBuffer.afterFlush(partial(self.checkpoint.markDone, *unit), owner=parentAddr)
+
+    # Crawl address's transactions within block range <fromBlock;toBlock>, returns False when not fully received
+    # Only first page of any range is requested (deep pages are slow), range holding more txs is split by blocks into ranges of ~1 page
+    # Ranges end at fixed block, so new blocks can't shift their content
+    async def crawlRange(self, session=None, addr="", addrName="", parentAddr="", nodeType="", fromBlock=0, toBlock=0):
+        if (result := await self.fetchRange(session, addr, fromBlock, toBlock)) is None:
+            return False
+        totalPages, txs = result
+        unit = ("range", nodeType, addr, fromBlock, toBlock, 1)
+        # Whole range fits into one page
+        if totalPages <= 1:
+            await self.processTxs(txs, addr, addrName, parentAddr, nodeType, unit)
+            return True
+        # Page filled by unconfirmed transactions only, range can't be split
+        if not txs:
+            return False
+
+        # Single block can't be split, its pages never change
+        if toBlock and fromBlock == toBlock:
+            return await self.crawlBlockPages(session, addr, addrName, parentAddr, nodeType, fromBlock, totalPages, txs)
+
+        RANGE_SPLITS.inc(stage=nodeType)
+        # Transactions are newest first, blocks above lowest one on page are complete
+        lowest   = min(tx.blockHeight for tx in txs)
+        complete = [tx for tx in txs if tx.blockHeight > lowest]
+        await self.processTxs(complete, addr, addrName, parentAddr, nodeType, unit)
+
+        if not complete:
+            # Page is filled by single block, crawl it separately from blocks below
+            ranges = [(lowest, lowest)] + ([(fromBlock, lowest - 1)] if fromBlock < lowest else [])
+        else:
+            # Rest of range (including lowest block) split into ranges of about one page, assuming even density
+            remaining = (len(txs) - len(complete)) + ((totalPages - 1) * self.trezor.pageSize)
+            parts = min(math.ceil(remaining / self.trezor.pageSize), lowest - fromBlock + 1)
+            ranges = splitRange(fromBlock, lowest, parts)
 
-        # Execute address collecting
-        await self.runParalel([
+        results = await self.runParalel([
             partial(
-                self.getTxAddrs,
+                self.crawlRange,
                 session    = session,
-                addr       = targetAddr,
-                addrName   = targetName,
+                addr       = addr,
+                addrName   = addrName,
                 parentAddr = parentAddr,
                 nodeType   = nodeType,
-                page       = page
-            ) for page in range(1, (totalPages + 1))
+                fromBlock  = rangeFrom,
+                toBlock    = rangeTo
+            ) for rangeFrom, rangeTo in ranges
         ])
+        return all(results)
+
+    # Crawl all pages of single block with more transactions than one page, first one is already received
+    async def crawlBlockPages(self, session=None, addr="", addrName="", parentAddr="", nodeType="", block=0, totalPages=1, firstTxs=[]):
+        await self.processTxs(firstTxs, addr, addrName, parentAddr, nodeType, ("range", nodeType, addr, block, block, 1))
+
+        async def crawlPage(page):
+            unit = ("range", nodeType, addr, block, block, page)
+            # Skip pages finished by interrupted run
+            if self.checkpoint.isDone(*unit):
+                return True
+            if (result := await self.fetchRange(session, addr, block, block, page)) is None:
+                return False
+            await self.processTxs(result[1], addr, addrName, parentAddr, nodeType, unit)
+            return True
+
+        results = await self.runParalel([partial(crawlPage, page) for page in range(2, (totalPages + 1))])
+        return all(results)
+
+    # Adds opposite address of given transaction (decoded Tx) to graph, if it qualifies
+    async def processTx(self, tx, addr="", addrName="", parentAddr="", nodeType=""):
+        try:
+            txFROMAddr = tx.fromAddr.upper()
+            # Determine if EOA transaction
+            eoaTx = (tx.data == "0x")
+
+            # Transaction direction is TO target address and having send Ether > 0 (amount stays in Wei)
+            if addr == tx.toAddr.upper() and tx.value > 0:
+                # Exclude known exchange addresses
+                if txFROMAddr in self.knownExchs:
+                    TXS_TOTAL.inc(stage=nodeType, result="skipped")
+                    return
+                if nodeType == "leaf":
+                    # Exclude non-EOA leaf addresses
+                    # Exclude deposit addresses as leaf ones (if happens deposits transfer between each other, not valid)
+                    if not eoaTx or txFROMAddr in self.knownDepos:
+                        TXS_TOTAL.inc(stage=nodeType, result="skipped")
+                        return
+
+                # Newly found deposit, ensure it is excluded from leafs
+                if nodeType == "deposit":
+                    self.knownDepos.add(txFROMAddr)
+                    self.depositIndex.addDeposit(txFROMAddr)
+                elif nodeType == "leaf":
+                    self.depositIndex.addLink(txFROMAddr, parentAddr)
+
+                # Add address to graph
+                await self.writeBuffer.addNode(
+                    addr       = txFROMAddr,
+                    addrName   = addrName,
+                    parentAddr = parentAddr,
+                    nodeType   = nodeType,
+                    txID       = tx.txid,
+                    txTime     = tx.blockTime,
+                    amount     = tx.value
+                )
+                TXS_TOTAL.inc(stage=nodeType, result="inserted")
+            else:
+                TXS_TOTAL.inc(stage=nodeType, result="skipped")
+        except TypeError:
+            Out.error("processTx(): given tx object contains unexpected None values, skipping")
+            TXS_TOTAL.inc(stage=nodeType, result="invalid")
+        except Exception as e:
+            Out.error(f"processTx(): {e}")
+            TXS_TOTAL.inc(stage=nodeType, result="invalid")
+
+    # Collects all addresses targetAddr has any transactions with
+    async def getLinkedAddrs(self, session=None, targetAddr="", targetName="", parentAddr="", nodeType=""):
+        targetAddr = targetAddr.upper()
+        # Already processed by interrupted run
+        if self.checkpoint.isDone("addr", nodeType, targetAddr):
+            self.progress["addrsDone"] += 1
+            return
+
+        watermarkKey = self.watermarkKey(targetAddr, nodeType)
+        # Skip blocks processed by previous refresh (otherwise start from initial (0) block (or value set by user))
+        fromBlock = max(self.minBlock, Cache.get(watermarkKey, 0, namespace="watermark"))
+        # If set use user's max block limit, else stop at refresh's (or client's) heighest block
+        toBlock = self.maxBlock or self.toBlock or self.trezor.heighestBlock
+        # Nothing new since last refresh
+        if toBlock and fromBlock > toBlock:
+            self.progress["addrsDone"] += 1
+            return
+
+        # Execute address collecting, range by range
+        complete = await self.crawlRange(session, targetAddr, targetName, parentAddr, nodeType, fromBlock, toBlock)
+
+        self.progress["addrsDone"] += 1
+        # All ranges received, next refresh continues after toBlock once found addresses are written
+        if complete:
+            if toBlock:
+                self.writeBuffer.afterFlush(partial(Cache.set, watermarkKey, (toBlock + 1), namespace="watermark"), owner=parentAddr)
+            self.writeBuffer.afterFlush(partial(self.checkpoint.markDone, "addr", nodeType, targetAddr), owner=parentAddr)
+        else:
+            self.progress["addrsIncomplete"] += 1
 # End of DataHandler class
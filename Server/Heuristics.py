@@ -5,33 +5,51 @@
 ###################################
 
 # Imports
-import json, atexit
-from Helpers import Out, Cache
+import json, atexit, asyncio, time, re, base64
+from datetime import datetime
+from Helpers import Out, Cache, LRUCache, DepositIndex, Metrics, Profiler
 from .Data_Handler import DataHandler, partial
-from .API import NebulaAPI
-from .Session import SessionManager
+from .API import createGraphBackend
+from .Refresh_Shards import ShardPool
+
+# Count of cached search results and seconds for which they are served
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL  = 3600
+# Max count of clusters fetched concurrently by bulk search
+BULK_PARALLEL = 8
+# Default and max count of linked addresses in one cluster page
+CLUSTER_PAGE_LIMIT = 1000
+CLUSTER_PAGE_MAX   = 5000
+# Valid (uppercased) Ethereum address
+ADDR_PATTERN = re.compile(r"0X[0-9A-F]{40}")
+
+# Refresh stages take minutes to hours
+STAGE_SECONDS   = Metrics.histogram("refresh_stage_seconds", "Duration of refresh stages", ("stage",), buckets=(1, 10, 60, 300, 900, 1800, 3600, 7200, 21600, 86400))
+STAGE_ADDRESSES = Metrics.gauge("refresh_stage_addresses", "Addresses processed by last run of refresh stage", ("stage",))
+# Search split into deposit lookup, graph fetch and rendering of result
+SEARCH_SECONDS  = Metrics.histogram("search_phase_seconds", "Duration of search phases", ("phase",))
+SEARCH_CACHE    = Metrics.counter("search_cache_requests_total", "Lookups of search results cache", ("result",))
 
 class HeuristicsClass():
-    def __init__(self, targetSpace="EthereumClustering"):
+    def __init__(self, targetSpace="EthereumClustering", graphBackend=None):
         # Load list of all known exchange addresses
         with open("exchanges.json", "r", encoding="utf-8") as file:
             self.exchAddrs = json.load(file)
 
-        # Init Nebula to interact with database
-        self.nebula = NebulaAPI(targetSpace=targetSpace)
+        # Init graph backend (Nebula by default) to interact with database
+        self.nebula = graphBackend if graphBackend else createGraphBackend(targetSpace=targetSpace)
         # Init ServerData_Handler for communicating with blockchain client
         self.dataHandler = DataHandler(self.nebula)
+        # Serialized search results, keyed by address and graph generation
+        self.resultCache = LRUCache(maxSize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+        # Worker processes of running refresh (None = crawling in this process)
+        self.shardPool = None
 
         # Initialize cache
         Out.blank("Initializing cache")
-        if not Cache.get("exchanges_cnt"):
-            Cache.set("exchanges_cnt", len(self.nebula.getAddrsOfType("exchange")))
-        if not Cache.get("deposits_list"):
-            Cache.set("deposits_list", self.nebula.getAddrsOfType("deposit"))
-        if not Cache.get("deposits_cnt"):
-            Cache.set("deposits_cnt", len(Cache.get("deposits_list")))
-        if not Cache.get("leafs_cnt"):
-            Cache.set("leafs_cnt", len(self.nebula.getAddrsOfType("leaf")))
+        for addrType, cacheKey in (("exchange", "exchanges_cnt"), ("deposit", "deposits_cnt"), ("leaf", "leafs_cnt")):
+            if not Cache.get(cacheKey):
+                Cache.set(cacheKey, self.nebula.countAddrsOfType(addrType))
         Out.blank("Cache initialized")
 
         # At exit, write updated JSON exch list back to file
@@ -42,124 +60,319 @@ class HeuristicsClass():
     async def addExchanges(self, scope):
         # Limit amount of processed exchange addrs by given scope
         exchAddrs = list(self.exchAddrs.items())[:int(len(self.exchAddrs) * (scope / 100))]
+        self.dataHandler.setStage("exchanges", len(exchAddrs))
 
         # Add all exchanges to graph
         await self.dataHandler.runParalel([
             partial(
-                self.dataHandler.nebula.addNodeToGraph,
+                self.dataHandler.writeBuffer.addNode,
                 addr     = dexAddr,
                 addrName = dexName,
                 nodeType = "exchange"
             ) for dexAddr, dexName in exchAddrs
         ])
+        # Next stage reads exchanges from DB, make sure all are written
+        await self.dataHandler.writeBuffer.flush()
         Out.success("Adding exchanges done")
 
     async def addDepositAddrs(self):
-        # Get all found deposit addresses
-        exchAddrs = self.nebula.getAddrsOfType("exchange")
-        # Update check-against list before searching for deposit addrs
-        self.dataHandler.knownExchs = self.exchAddrs.keys()
+        # Count all found exchange addresses
+        exchCnt = await self.nebula.runAsync(self.nebula.countAddrsOfType, "exchange")
+        self.dataHandler.setStage("deposits", exchCnt)
+        # Update check-against index before searching for deposit addrs
+        self.dataHandler.knownExchs.rebuild(self.exchAddrs.keys())
 
         # Exchanges won't change till next clustering, cache them
-        Cache.set("exchanges_cnt", len(exchAddrs))
-
-        # Create session for async requests
-        async with SessionManager() as trezor_session:
-            # Add all addresses interacting with known exchanges -> deposit addresses
-            await self.dataHandler.runParalel([
-                partial(
-                    self.dataHandler.getLinkedAddrs,
-                    session    = trezor_session,
-                    targetAddr = dexAddr,
-                    targetName = self.exchAddrs.get(dexAddr, ""), # Get name of (parent) exchange
-                    parentAddr = dexAddr,
-                    nodeType   = "deposit"
-                ) for dexAddr in exchAddrs
-            ])
+        Cache.set("exchanges_cnt", exchCnt)
+
+        # Add all addresses interacting with known exchanges -> deposit addresses, page by page
+        if self.shardPool:
+            self.shardPool.startStage("deposit", self.exchAddrs.keys())
+        async for exchAddrs in self.nebula.iterAddrsOfType("exchange"):
+            # Get name of (parent) exchange
+            await self.crawlLinkedAddrs("deposit", [(dexAddr, self.exchAddrs.get(dexAddr, "")) for dexAddr in exchAddrs])
+        if self.shardPool:
+            await self.shardPool.join()
+        await self.dataHandler.writeBuffer.flush()
         Out.success("Adding deposits done")
 
     async def addClusteredAddrs(self):
-        # Get all found deposit addresses
-        exchDepos = self.nebula.getAddrsOfType("deposit")
-        # Update check-against list before searching for leaf addrs
-        self.dataHandler.knownDepos = exchDepos
-        # Store (parent) names of deposit addresses
-        deposNames = self.nebula.getAddrsOfType("deposit", "v.address.name")
+        # Count all found deposit addresses
+        deposCnt = await self.nebula.runAsync(self.nebula.countAddrsOfType, "deposit")
+        self.dataHandler.setStage("leafs", deposCnt)
+        # Update check-against index before searching for leaf addrs (new deposits were already added during crawl)
+        async for exchDepos in self.nebula.iterAddrsOfType("deposit"):
+            self.dataHandler.knownDepos.update(exchDepos)
 
         # Deposits won't change till next clustering, cache them
-        Cache.set("deposits_list", exchDepos)
-        Cache.set("deposits_cnt", len(exchDepos))
-
-        # Create session for async requests
-        async with SessionManager() as trezor_session:
-            # Add all addresses interacting with deposit addresss -> leaf addresses
-            await self.dataHandler.runParalel([
-                partial(
-                    self.dataHandler.getLinkedAddrs,
-                    session    = trezor_session,
-                    targetAddr = depoAddr,
-                    targetName = deposNames[index], # Get name of (parent) exchange
-                    parentAddr = depoAddr,
-                    nodeType   = "leaf"
-                ) for index, depoAddr in enumerate(exchDepos)
-            ])
+        Cache.set("deposits_cnt", deposCnt)
+
+        # Add all addresses interacting with deposit addresss -> leaf addresses, page by page with (parent) names of deposits
+        if self.shardPool:
+            self.shardPool.startStage("leaf", self.exchAddrs.keys())
+        async for exchDepos in self.nebula.iterAddrsOfType("deposit", "id(v)", "v.address.name"):
+            await self.crawlLinkedAddrs("leaf", exchDepos)
+        if self.shardPool:
+            await self.shardPool.join()
+        await self.dataHandler.writeBuffer.flush()
 
         # Leafs won't change till next clustering, cache them
-        Cache.set("leafs_cnt", len(self.nebula.getAddrsOfType("leaf")))
+        Cache.set("leafs_cnt", await self.nebula.runAsync(self.nebula.countAddrsOfType, "leaf"))
 
         Out.success("Adding leafs done")
 
+    # Find addresses linked to given (address, name) pairs, in worker processes when sharding is enabled
+    async def crawlLinkedAddrs(self, nodeType="", targets=[]):
+        if self.shardPool:
+            # Workers run independently, results are awaited at end of stage
+            self.shardPool.submit(targets)
+            return
+
+        await self.dataHandler.runParalel([
+            partial(
+                self.dataHandler.getLinkedAddrs,
+                targetAddr = addr,
+                targetName = name, # Get name of (parent) exchange
+                parentAddr = addr,
+                nodeType   = nodeType
+            ) for addr, name in targets
+        ])
+
     # Performs update of addresses connected to known exchanges
     # Scope in interval <0, 100> percentage
+    @Profiler.profiled("refresh")
     async def updateAddrsDB(self, scope=100, minHeight=0, maxHeight=0):
         Out.warning(f"Beginning refresh of DB with scope: {scope}")
+        checkpoint = self.dataHandler.checkpoint
 
-        # If user selected custom scope, we are forced to clear DB and start again to match requested block scope
-        if (self.dataHandler.minBlock != minHeight) or (self.dataHandler.maxBlock != maxHeight):
-            # Update block limits
-            self.dataHandler.minBlock = minHeight
-            self.dataHandler.maxBlock = maxHeight
+        # Get current highest block, crawling stops there
+        await self.dataHandler.trezor.getCurrentClientData(fresh=True)
+        # Continue unfinished run with same params, it keeps its original highest block
+        resumed = checkpoint.start(
+            params  = {"scope": scope, "minHeight": minHeight, "maxHeight": maxHeight},
+            toBlock = self.dataHandler.trezor.heighestBlock
+        )
+        self.dataHandler.toBlock = checkpoint.run["toBlock"]
 
+        # If user selected custom scope, we are forced to clear DB and start again to match requested block scope
+        if not resumed and ((self.dataHandler.minBlock != minHeight) or (self.dataHandler.maxBlock != maxHeight)):
             Out.warning(f"Custom refresh scope: erasing current DB; selected block scope: <{minHeight};{maxHeight}>")
-            self.nebula.execNebulaCommand('CLEAR SPACE IF EXISTS EthereumClustering')
+            await self.nebula.clearGraph()
+            # Known deposits and crawled blocks are gone with cleared DB
+            self.dataHandler.knownDepos.rebuild()
+            Cache.clearNamespace("watermark")
+            self.dataHandler.depositIndex.rebuild()
+            self.bumpGraphGeneration()
+
+        # Update block limits
+        self.dataHandler.minBlock = minHeight
+        self.dataHandler.maxBlock = maxHeight
 
         # Execute pipeline to construct graph
-        await self.addExchanges(scope)
-        await self.addDepositAddrs()
-        await self.addClusteredAddrs()
+        self.dataHandler.writeBuffer.resetStats()
+        self.dataHandler.resetProgress()
+        self.shardPool = ShardPool.create(self.dataHandler, self.nebula.targetSpace)
+        incompleteStages = []
+        try:
+            for stage, stageFunc in (
+                ("exchanges", partial(self.addExchanges, scope)),
+                ("deposits" , self.addDepositAddrs),
+                ("leafs"    , self.addClusteredAddrs)
+            ):
+                if checkpoint.isDone("stage", stage):
+                    Out.blank(f"Skipping stage finished by previous run: {stage}")
+                    continue
+                start = time.perf_counter()
+                failedBefore = self.dataHandler.writeBuffer.stats["failed"]
+                await stageFunc()
+                self.dataHandler.progress["stageTimes"][stage] = round(time.perf_counter() - start, 3)
+                STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+                STAGE_ADDRESSES.set(self.dataHandler.progress["addrsDone"], stage=stage)
+                # Stage with missing rows is crawled again by resumed run (its finished units are skipped)
+                failedWrites = self.dataHandler.writeBuffer.stats["failed"] - failedBefore
+                if failedWrites or self.dataHandler.progress["addrsIncomplete"]:
+                    Out.warning(
+                        f"Stage {stage} not complete: {failedWrites} failed writes, "
+                        f"{self.dataHandler.progress['addrsIncomplete']} incomplete addresses"
+                    )
+                    incompleteStages.append(stage)
+                    continue
+                checkpoint.markDone("stage", stage, sync=True)
+        finally:
+            if self.shardPool:
+                await self.shardPool.close()
+                self.shardPool = None
+            # Keep responses recorded so far even if app crashes later
+            self.dataHandler.trezor.recorder.close()
 
-        # When done, rebuild index with new data
-        self.nebula.execNebulaCommand('REBUILD TAG INDEX addrs_index')
+        # When done, rebuild indexes with new data
+        await self.nebula.rebuildIndexes()
+        await self.rebuildDepositIndex()
 
+        # Keep run open, so next refresh with same params resumes missing parts
+        if incompleteStages:
+            checkpoint.close()
+            Out.warning(f"Refresh incomplete in stages: {', '.join(incompleteStages)}, next refresh with same scope resumes them")
+        else:
+            checkpoint.finish()
+        # Graph changed, previously cached search results are outdated
+        self.bumpGraphGeneration()
+        self.dataHandler.writeBuffer.report()
         Out.success("Refresh of DB was succesful")
 
+    # Load reverse deposit index, build it from DB when not persisted yet (called once app starts)
+    async def loadDepositIndex(self):
+        if not self.dataHandler.depositIndex.load():
+            await self.rebuildDepositIndex()
+
+    # Fill reverse deposit index from DB and persist it
+    # Searches keep using current index till new one is complete, then it is replaced at once
+    async def rebuildDepositIndex(self):
+        depositIndex = DepositIndex(self.dataHandler.depositIndex.path)
+        await self.nebula.runAsync(lambda: depositIndex.rebuild(self.nebula.getDepositLinks()))
+        # Deposits without any linked address are searchable too
+        async for depoAddrs in self.nebula.iterAddrsOfType("deposit"):
+            for depoAddr in depoAddrs:
+                depositIndex.addDeposit(depoAddr)
+        await self.nebula.runAsync(depositIndex.save)
+        self.dataHandler.depositIndex = depositIndex
+        Out.blank(f"Deposit index built: {len(depositIndex)} addresses, {len(depositIndex.deposits)} deposits")
+
+    # State of Blockbook limiter, while refresh is sharded requests are limited by workers' limiters
+    def blockbookStats(self):
+        stats = self.dataHandler.trezor.limiter.getStats()
+        workers = self.shardPool.limiterStats() if self.shardPool else []
+        if workers:
+            stats["limit"]     = sum(worker["limit"] for worker in workers)
+            stats["inFlight"] += sum(worker["inFlight"] for worker in workers)
+            stats["workers"]   = workers
+        return stats
+
+    # Increase graph generation, invalidates all cached search results
+    def bumpGraphGeneration(self):
+        Cache.set("graph_generation", Cache.get("graph_generation", 0) + 1)
+        self.resultCache.clear()
+
     # Performs clustering around target address
+    @Profiler.profiled("search")
     async def clusterAddrs(self, targetAddr=""):
         targetAddr = targetAddr.upper()
+        # Serve cached result of same graph state
+        cacheKey = (targetAddr, Cache.get("graph_generation", 0))
+        if (cached := self.resultCache.get(cacheKey)) is not None:
+            SEARCH_CACHE.inc(result="hit")
+            return cached
+        SEARCH_CACHE.inc(result="miss")
 
-        try: # Find deposit address(es) of target address
-            # If already deposit address, skip and return graph
-            if targetAddr in Cache.get("deposits_list"):
-                targetAddrDepo = [targetAddr]
-            else:
-                targetAddrDepo = self.nebula.toArrayTransform(self.nebula.execNebulaCommand(
-                    f'MATCH (leaf:address)-->(deposit:address) WHERE id(leaf) == "{targetAddr}" AND deposit.address.type == "deposit" RETURN id(deposit)'
-                ), "id(deposit)")
-
-            # Check if found anything
-            assert len(targetAddrDepo)
-        except Exception:
+        # Find deposit address(es) of target address (deposit address is returned itself)
+        with SEARCH_SECONDS.time(phase="lookup"):
+            targetAddrDepo = self.dataHandler.depositIndex.getDeposits(targetAddr)
+        # Check if found anything
+        if not targetAddrDepo:
             Out.error(f"Provided address is unknown or not leaf or deposit: {targetAddr}")
             return ""
 
-        subGraphdata = ""
-        # Iterate over all found deposit addresses
-        for depoAddr in targetAddrDepo:
-            # Construct data for subgraph containing these addresses
-            subGraphdata += json.dumps(self.nebula.execNebulaCommand(
-                f'GET SUBGRAPH WITH PROP 1 STEPS FROM "{depoAddr}" YIELD VERTICES AS nodes, EDGES AS links'
-            ).dict_for_vis(), indent=2, sort_keys=True)
+        # Construct data for subgraph containing all found deposit addresses in one query
+        with SEARCH_SECONDS.time(phase="subgraph"):
+            subGraph = await self.nebula.getSubgraph(targetAddrDepo)
+        if subGraph is None:
+            return ""
+        # Compact JSON
+        subGraphdata = json.dumps(subGraph, separators=(",", ":"))
 
+        self.resultCache.set(cacheKey, subGraphdata)
         # Return prepared data
         return subGraphdata
+
+    # Opaque cursor of next cluster page, holds (count, amount, src, dst) of last edge of previous page
+    def encodeCursor(self, after=None):
+        if after is None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(list(after), separators=(",", ":")).encode()).decode()
+
+    # Raises ValueError for malformed cursor
+    def decodeCursor(self, cursor=""):
+        if not cursor:
+            return None
+        try:
+            count, amount, src, dst = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            after = (int(count), float(amount), str(src).upper(), str(dst).upper())
+        except Exception as e:
+            raise ValueError(f"Invalid cursor: {e}")
+        if not (ADDR_PATTERN.fullmatch(after[2]) and ADDR_PATTERN.fullmatch(after[3])):
+            raise ValueError("Invalid cursor: malformed address")
+        return after
+
+    # Returns one page of target address's cluster, raises ValueError for malformed cursor
+    # First page contains deposit(s) with their exchanges, then linked addresses follow, strongest links (most txs) first
+    @Profiler.profiled("search")
+    async def getClusterPage(self, targetAddr="", cursor="", limit=CLUSTER_PAGE_LIMIT):
+        after = self.decodeCursor(cursor)
+        with SEARCH_SECONDS.time(phase="lookup"):
+            depoAddrs = self.dataHandler.depositIndex.getDeposits(targetAddr)
+        if not depoAddrs:
+            return None
+
+        with SEARCH_SECONDS.time(phase="subgraph"):
+            page = await self.nebula.getClusterPage(depoAddrs, after, limit)
+        if page is None:
+            Out.error(f"getClusterPage(): failed to get cluster of: {targetAddr}")
+            return None
+        return {
+            "address"    : targetAddr,
+            "deposits"   : depoAddrs,
+            "nodes"      : page["nodes"],
+            "edges"      : page["edges"],
+            "nextCursor" : self.encodeCursor(page["nextCursor"])
+        }
+
+    # Compact JSON of cluster page (page is bounded by limit, so it is serialized at once)
+    def serializeClusterPage(self, page={}):
+        with SEARCH_SECONDS.time(phase="render"):
+            return json.dumps(page, separators=(",", ":"))
+
+    # Clusters given addresses concurrently, yields NDJSON line for each address as soon as its cluster is known
+    async def bulkClusterAddrs(self, targetAddrs=[], parallel=BULK_PARALLEL):
+        # Addresses sharing same deposit(s) have same cluster, fetch it only once
+        groups = {}
+        for targetAddr in dict.fromkeys(str(addr).upper() for addr in targetAddrs):
+            depoAddrs = tuple(self.dataHandler.depositIndex.getDeposits(targetAddr))
+            if not depoAddrs:
+                yield json.dumps({"address": targetAddr, "deposits": [], "cluster": None}) + "\n"
+                continue
+            groups.setdefault(depoAddrs, []).append(targetAddr)
+
+        semaphore = asyncio.Semaphore(parallel)
+        # Failure of one cluster is reported in its lines, others are still streamed
+        async def clusterGroup(depoAddrs, addrs):
+            async with semaphore:
+                try:
+                    return depoAddrs, addrs, await self.clusterAddrs(targetAddr=addrs[0]), None
+                except Exception as e:
+                    Out.error(f"bulkClusterAddrs(): {e}")
+                    return depoAddrs, addrs, None, str(e)
+
+        tasks = [asyncio.create_task(clusterGroup(depoAddrs, addrs)) for depoAddrs, addrs in groups.items()]
+        try:
+            for task in asyncio.as_completed(tasks):
+                depoAddrs, addrs, cluster, error = await task
+                for addr in addrs:
+                    line = f'{{"address":{json.dumps(addr)},"deposits":{json.dumps(list(depoAddrs))},"cluster":{cluster or "null"}'
+                    # Cluster is already serialized JSON, embed it as is
+                    yield line + (f',"error":{json.dumps(error)}}}\n' if error else "}\n")
+        finally:
+            # Client disconnected, stop remaining lookups
+            for task in tasks:
+                task.cancel()
+
+    # Returns transactions stored between two addresses (not part of cluster data, loaded on demand), None for invalid address
+    async def getEdgeTxs(self, srcAddr="", dstAddr=""):
+        srcAddr, dstAddr = srcAddr.upper(), dstAddr.upper()
+        if not (ADDR_PATTERN.fullmatch(srcAddr) and ADDR_PATTERN.fullmatch(dstAddr)):
+            return None
+        # Format time only for displaying
+        return [
+            [txID, datetime.fromtimestamp(txTime).strftime("%Y-%m-%d | %H:%M:%S"), amount]
+            for txID, txTime, amount in await self.nebula.getEdgeTxs(srcAddr, dstAddr)
+        ]
 # End of HeuristicsClass class
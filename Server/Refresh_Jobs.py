@@ -0,0 +1,123 @@
+###################################
+# @file Refresh_Jobs.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Runs database refreshes as queued background jobs.
+###################################
+
+# Imports
+import asyncio, time, uuid
+from Helpers import Out
+
+# Count of finished jobs kept for status queries, older ones are forgotten
+MAX_FINISHED_JOBS = 100
+
+class RefreshJobManager():
+    def __init__(self, heuristics):
+        self.heuristics = heuristics
+        # All submitted jobs: ID -> job record
+        self.jobs  = {}
+        self.queue = asyncio.Queue()
+        # Task processing queue and task of currently running refresh
+        self.worker      = None
+        self.currentJob  = None
+        self.currentTask = None
+
+    # Enqueue new refresh, returns its job record
+    def submit(self, scope=100, minHeight=0, maxHeight=0):
+        job = {
+            "id"        : uuid.uuid4().hex[:12],
+            "state"     : "queued",
+            "params"    : {"scope": scope, "minHeight": minHeight, "maxHeight": maxHeight},
+            "submitted" : time.time(),
+            "started"   : None,
+            "finished"  : None,
+            "error"     : None
+        }
+        self.jobs[job["id"]] = job
+        self.queue.put_nowait(job["id"])
+        self.pruneJobs()
+
+        # Start processing jobs when not running yet
+        if not self.worker or self.worker.done():
+            self.worker = asyncio.create_task(self.processJobs())
+        return self.status(job["id"])
+
+    # Forget oldest finished jobs over limit (jobs are kept in order of submission)
+    def pruneJobs(self):
+        finished = [jobId for jobId, job in self.jobs.items() if job["finished"] is not None]
+        for jobId in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[jobId]
+
+    async def processJobs(self):
+        while True:
+            job = self.jobs.get(await self.queue.get())
+            # Cancelled while waiting in queue
+            if not job or job["state"] != "queued":
+                continue
+
+            job["state"]   = "running"
+            job["started"] = time.time()
+            self.currentJob  = job
+            self.currentTask = asyncio.create_task(self.heuristics.updateAddrsDB(**job["params"]))
+            try:
+                await self.currentTask
+                job["state"] = "done"
+            except asyncio.CancelledError:
+                # Worker itself is being stopped
+                if job["state"] != "cancelling":
+                    self.currentTask.cancel()
+                    raise
+                job["state"] = "cancelled"
+                Out.warning(f"Refresh job {job['id']} cancelled, it can be resumed by submitting it again")
+            except Exception as e:
+                job["state"] = "failed"
+                job["error"] = str(e)
+                Out.error(f"Refresh job {job['id']} failed: {e}")
+            finally:
+                job["finished"]  = time.time()
+                self.currentJob  = None
+                self.currentTask = None
+
+    # Cancel queued or running job, returns False for unknown/finished ones
+    def cancel(self, jobId=""):
+        job = self.jobs.get(jobId)
+        if not job or job["state"] not in ("queued", "running"):
+            return False
+
+        if job["state"] == "queued":
+            job["state"]    = "cancelled"
+            job["finished"] = time.time()
+        else:
+            job["state"] = "cancelling"
+            self.currentTask.cancel()
+        return True
+
+    def isRunning(self):
+        return self.currentJob is not None
+
+    # Job record extended by refresh progress when running
+    def status(self, jobId=""):
+        job = self.jobs.get(jobId)
+        if not job:
+            return None
+
+        status = dict(job)
+        if job is self.currentJob:
+            progress = dict(self.heuristics.dataHandler.progress)
+            now = time.time()
+            # Throughput over whole run, ETA of current stage based on its address rate
+            progress["txsPerSec"] = round(progress["txsProcessed"] / max(now - job["started"], 1e-6), 2)
+            stageTime = now - progress["stageStarted"]
+            progress["stageEta"] = None
+            if progress["addrsDone"] and progress["addrsTotal"]:
+                progress["stageEta"] = round((progress["addrsTotal"] - progress["addrsDone"]) * (stageTime / progress["addrsDone"]))
+            status["progress"]  = progress
+            status["blockbook"] = self.heuristics.blockbookStats()
+            # Units done by this and resumed runs
+            status["checkpoint"] = self.heuristics.dataHandler.checkpoint.summary()
+        return status
+
+    # Status of all jobs, newest first
+    def allStatuses(self):
+        return [self.status(jobId) for jobId in reversed(self.jobs)]
+# End of RefreshJobManager class
@@ -0,0 +1,236 @@
+###################################
+# @file Refresh_Shards.py
+# @author Tomáš Daniel (xdanie14)
+# @brief Spreads crawling of refresh stages over pool of worker processes.
+###################################
+
+# Imports
+import asyncio, multiprocessing, os, queue, time, yaml
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from Helpers import Out, Metrics
+from .API import createGraphBackend, MemoryGraph
+from .Data_Handler import DataHandler
+
+# Progress counters summed over workers
+PROGRESS_KEYS = ("addrsDone", "addrsIncomplete", "pagesDone", "txsProcessed")
+# Write buffer counters summed over workers
+WRITE_KEYS = ("flushes", "roundTrips", "vertices", "edges", "transfers", "failed", "flushTime")
+# Min seconds between progress reports of one worker
+REPORT_INTERVAL = 0.5
+
+# State of worker process, each has its own Blockbook client and graph session
+class ShardWorker():
+    def __init__(self, targetSpace="", progressQueue=None, stopEvent=None, workers=1):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # Space is prepared by coordinator, worker only connects to it
+        self.dataHandler   = DataHandler(createGraphBackend(targetSpace=targetSpace, attach=True))
+        self.progressQueue = progressQueue
+        self.stopEvent     = stopEvent
+        # Blockbook concurrency budget is split among workers
+        self.dataHandler.trezor.limiter.share(workers)
+        # Stage currently crawled, counters are kept per stage
+        self.stageId    = None
+        self.seq        = 0
+        self.lastReport = 0.0
+        # Reports over whole life of process, orders its metrics
+        self.reports    = 0
+
+    async def startStage(self, settings={}):
+        dataHandler = self.dataHandler
+        self.stageId = settings["stageId"]
+        self.seq     = 0
+        dataHandler.resetProgress()
+        dataHandler.writeBuffer.resetStats()
+        dataHandler.minBlock = settings["minBlock"]
+        dataHandler.maxBlock = settings["maxBlock"]
+        dataHandler.toBlock  = settings["toBlock"]
+        # Use same Blockbook as coordinator
+        dataHandler.trezor.url = settings["blockbookUrl"]
+        dataHandler.knownExchs.rebuild(settings["exchAddrs"])
+        # Leafs are checked against deposits found by previous stage
+        dataHandler.knownDepos.rebuild()
+        if settings["nodeType"] == "leaf":
+            async for depoAddrs in dataHandler.nebula.iterAddrsOfType("deposit"):
+                dataHandler.knownDepos.update(depoAddrs)
+
+    # Cumulative counters of current stage (newer snapshot has higher seq) and of whole process (ordered by report)
+    def snapshot(self):
+        self.seq     += 1
+        self.reports += 1
+        return {
+            "pid"       : os.getpid(),
+            "stageId"   : self.stageId,
+            "seq"       : self.seq,
+            "report"    : self.reports,
+            "progress"  : {key: self.dataHandler.progress[key] for key in PROGRESS_KEYS},
+            "writes"    : {key: self.dataHandler.writeBuffer.stats[key] for key in WRITE_KEYS},
+            "metrics"   : Metrics.export(),
+            "blockbook" : self.dataHandler.trezor.limiter.getStats()
+        }
+
+    def report(self, force=False):
+        if force or (time.monotonic() - self.lastReport) >= REPORT_INTERVAL:
+            self.lastReport = time.monotonic()
+            self.progressQueue.put(self.snapshot())
+
+    async def crawl(self, settings={}, targets=[], doneUnits=[]):
+        if settings["stageId"] != self.stageId:
+            await self.startStage(settings)
+        dataHandler = self.dataHandler
+        # Continue checkpoint log of coordinator
+        dataHandler.checkpoint.attach(doneUnits)
+
+        async def crawlAddr(addr, name):
+            # Refresh was cancelled, rest of shard is left for next run
+            if self.stopEvent.is_set():
+                return
+            await dataHandler.getLinkedAddrs(targetAddr=addr, targetName=name, parentAddr=addr, nodeType=settings["nodeType"])
+            self.report()
+
+        await dataHandler.runParalel([partial(crawlAddr, addr, name) for addr, name in targets])
+        # Shard is done once its addresses are written
+        await dataHandler.writeBuffer.flush()
+        dataHandler.trezor.recorder.close()
+        return self.snapshot()
+# End of ShardWorker class
+
+# Worker process instance, created by pool initializer
+worker = None
+
+def initWorker(targetSpace="", progressQueue=None, stopEvent=None, workers=1):
+    global worker
+    worker = ShardWorker(targetSpace, progressQueue, stopEvent, workers)
+
+def crawlShard(settings={}, targets=[], doneUnits=[]):
+    return worker.loop.run_until_complete(worker.crawl(settings, targets, doneUnits))
+
+# Coordinator side, submits shards of addresses to workers and merges their progress
+class ShardPool():
+    def __init__(self, dataHandler=None, targetSpace="", workers=2, shardSize=200):
+        self.dataHandler = dataHandler
+        self.shardSize   = shardSize
+        # Fresh interpreters, forked one would inherit event loop and DB connections
+        context = multiprocessing.get_context("spawn")
+        self.progressQueue = context.Queue()
+        # Set when refresh ends early, workers skip addresses not started yet
+        self.stopEvent = context.Event()
+        self.executor = ProcessPoolExecutor(
+            max_workers = workers,
+            mp_context  = context,
+            initializer = initWorker,
+            initargs    = (targetSpace, self.progressQueue, self.stopEvent, workers)
+        )
+        self.stageId   = 0
+        self.settings  = {}
+        self.futures   = []
+        self.snapshots = {}
+        self.base      = {}
+        self.doneUnits = {}
+        # Latest snapshot of each worker process, kept over stages
+        self.workerStats = {}
+
+    # Returns pool when enabled by config (or REFRESH_WORKERS env variable), None = refresh runs in this process
+    @classmethod
+    def create(cls, dataHandler=None, targetSpace="", file="configFile.yaml"):
+        with open(Path(__file__).parent / "API" / file, "r") as configFile:
+            conf = yaml.safe_load(configFile).get("refresh", {})
+
+        workers = int(os.getenv("REFRESH_WORKERS", conf.get("workers", 1)))
+        if workers <= 1:
+            return None
+        # In-memory graph can't be shared by processes
+        if isinstance(dataHandler.nebula, MemoryGraph):
+            Out.warning("In-memory graph backend used, refresh runs in single process")
+            return None
+        Out.blank(f"Refresh sharded over {workers} worker processes")
+        return cls(dataHandler, targetSpace, workers, conf.get("shardSize", 200))
+
+    def startStage(self, nodeType="", exchAddrs=[]):
+        dataHandler = self.dataHandler
+        self.stageId  += 1
+        self.futures   = []
+        self.snapshots = {}
+        self.base      = {key: dataHandler.progress[key] for key in PROGRESS_KEYS}
+        self.settings  = {
+            "stageId"   : self.stageId,
+            "nodeType"  : nodeType,
+            "exchAddrs" : list(exchAddrs),
+            "minBlock"  : dataHandler.minBlock,
+            "maxBlock"  : dataHandler.maxBlock,
+            "toBlock"   : dataHandler.toBlock,
+            "blockbookUrl" : dataHandler.trezor.url
+        }
+        # Units finished by interrupted run, grouped by address (workers get only those of their shard)
+        self.doneUnits = {}
+        for unit in dataHandler.checkpoint.done:
+            if unit[0] in ("addr", "range") and unit[1] == nodeType:
+                self.doneUnits.setdefault(unit[2], []).append(unit)
+
+    # Split (address, name) pairs into shards and queue them
+    def submit(self, targets=[]):
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(targets), self.shardSize):
+            shard = targets[start:(start + self.shardSize)]
+            doneUnits = [unit for addr, _ in shard for unit in self.doneUnits.get(addr.upper(), ())]
+            self.futures.append(asyncio.wrap_future(
+                self.executor.submit(crawlShard, self.settings, shard, doneUnits), loop=loop
+            ))
+
+    def merge(self, snapshot={}):
+        self.mergeProcessStats(snapshot)
+        if snapshot["stageId"] != self.stageId:
+            return
+        current = self.snapshots.get(snapshot["pid"])
+        if not current or current["seq"] < snapshot["seq"]:
+            self.snapshots[snapshot["pid"]] = snapshot
+        for key in PROGRESS_KEYS:
+            self.dataHandler.progress[key] = self.base[key] + sum(snap["progress"][key] for snap in self.snapshots.values())
+
+    # Metrics and Blockbook counters of worker cover its whole life, coordinator adds only their growth
+    def mergeProcessStats(self, snapshot={}):
+        previous = self.workerStats.get(snapshot["pid"])
+        if previous and previous["report"] >= snapshot["report"]:
+            return
+        self.workerStats[snapshot["pid"]] = snapshot
+        Metrics.mergeDelta(snapshot["metrics"], previous["metrics"] if previous else {})
+        limiterStats = self.dataHandler.trezor.limiter.stats
+        for key in limiterStats:
+            limiterStats[key] += snapshot["blockbook"][key] - (previous["blockbook"][key] if previous else 0)
+
+    # Latest state of Blockbook limiter of each worker
+    def limiterStats(self):
+        return [snap["blockbook"] for snap in self.workerStats.values()]
+
+    def drainProgress(self):
+        while True:
+            try:
+                self.merge(self.progressQueue.get_nowait())
+            except queue.Empty:
+                return
+
+    # Wait for all submitted shards, keeps progress of coordinator updated meanwhile
+    async def join(self):
+        pending = set(self.futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=REPORT_INTERVAL)
+            for future in done:
+                self.merge(future.result())
+            self.drainProgress()
+
+        writeStats = self.dataHandler.writeBuffer.stats
+        for snap in self.snapshots.values():
+            for key in WRITE_KEYS:
+                writeStats[key] += snap["writes"][key]
+
+    # Queued shards are dropped and running ones stop after their current addresses, nothing is written once this returns
+    async def close(self):
+        self.stopEvent.set()
+        await asyncio.get_running_loop().run_in_executor(
+            None, partial(self.executor.shutdown, wait=True, cancel_futures=True)
+        )
+        # Last reports of stopped workers
+        self.drainProgress()
+# End of ShardPool class
@@ -7,16 +7,20 @@
 # Imports
 from asyncio import Event
 from Helpers import Out
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector
 
 class SessionManager:
-    def __init__(self, timeout=None):
+    def __init__(self, timeout=None, connection={}):
         self.timeout = timeout
+        # Connection pool settings
+        self.connection = connection
         # Init session to None
         self.session = None
         # Flag if session is being created
         self.creatingSession = Event()
         self.creatingSession.set()
+        # Connector errors in row, session is re-created when too many
+        self.connectorErrors = 0
 
     # Method trigger by entering context manager
     async def __aenter__(self):
@@ -42,11 +46,33 @@ class SessionManager:
         self.creatingSession.clear()
         # Ensure current session is closed
         await self.closeSession()
-        # Create new one
-        self.session = ClientSession(timeout=self.timeout)
+        # Create new one, with connection pool reused by all requests
+        self.session = ClientSession(
+            timeout   = self.timeout,
+            connector = TCPConnector(
+                limit             = self.connection.get("limit", 300),
+                limit_per_host    = self.connection.get("limitPerHost", 300),
+                keepalive_timeout = self.connection.get("keepalive", 60),
+                ttl_dns_cache     = self.connection.get("dnsCache", 300)
+            )
+        )
+        self.connectorErrors = 0
         self.creatingSession.set()
         Out.blank("Created new ClientSession")
 
+    # Handles connector error, only repeated ones mean session (its pool or DNS cache) is broken
+    async def onConnectorError(self, maxErrors=3):
+        self.connectorErrors += 1
+        # Other coroutine already re-creating session, skip
+        if self.connectorErrors < maxErrors or not self.creatingSession.is_set():
+            return
+        Out.warning(f"{self.connectorErrors} connector errors in row, re-creating ClientSession")
+        await self.createSession()
+
+    # Request succeeded, connection works
+    def onSuccess(self):
+        self.connectorErrors = 0
+
     async def closeSession(self):
         try:
             assert self.session
@@ -5,22 +5,34 @@
 ###################################
 
 # Imports
-import pytest, os, io, json
+import pytest, os, io, json, math, asyncio, importlib, socket, time, yaml, aiohttp
+from pathlib import Path
 from .Heuristics import HeuristicsClass
+from .API import NebulaAPI, TrezorAPI, NebulaWriteBuffer, ResponseRecorder, GraphBackend, MemoryGraph, ETH_WEI, Tx, decodeTxs, decodePage
+from .API.Response_Recorder import BytesReader
+from .API.Nebula_Class import txRank
+from .Checkpoint import CheckpointLog
+from .Data_Handler import DataHandler
+from .Refresh_Shards import ShardPool
+from Helpers import AddressIndex, LRUCache, DepositIndex, Cache, Metrics, Profiler
 from Server.Web_Server import app
 from fastapi.testclient import TestClient
 from dotenv import load_dotenv
 
 class HelperClass():
-    def __init__(self):
-        self.heuristics = HeuristicsClass(targetSpace="MockSpace")
-        # Set Nebula to interact with database
+    def __init__(self, graphBackend=None):
+        # Graph is kept in memory by default, pass NebulaAPI(targetSpace="MockSpace") to test against NebulaGraph
+        self.heuristics = HeuristicsClass(
+            targetSpace  = "MockSpace",
+            graphBackend = graphBackend if graphBackend else MemoryGraph(targetSpace="MockSpace", snapshot="")
+        )
+        # Set graph backend to interact with database
         self.nebula = self.heuristics.nebula
 
     # Performs clearance of address database
-    def clearMockDB(self):
+    async def clearMockDB(self):
         # Clear existing data
-        self.nebula.execNebulaCommand('CLEAR SPACE IF EXISTS MockSpace')
+        await self.nebula.clearGraph()
 
     # Fill database with test data
     async def fillDB(self):
@@ -70,14 +82,46 @@ class HelperClass():
         )
 # End of HelperClass class
 
+# Stand-in for NebulaAPI (without connecting), only records executed queries
+class RecordingNebula(NebulaAPI):
+    def __init__(self):
+        self.conf    = {}
+        self.queries = []
+        # Queries which must not be executed again when failed
+        self.unretried = []
+
+    def execNebulaCommand(self, command=""):
+        self.queries.append(command)
+        return command
+
+    async def execAsync(self, command="", retry=True):
+        if not retry:
+            self.unretried.append(command)
+        return self.execNebulaCommand(command)
+# End of RecordingNebula class
+
+# Schema tests need running NebulaGraph from config file
+def nebulaReachable():
+    if os.getenv("GRAPH_BACKEND", "").lower() == "memory":
+        return False
+    with open(Path(__file__).parent / "API" / "configFile.yaml", "r") as configFile:
+        conf = yaml.safe_load(configFile)["nebula"]
+    try:
+        socket.create_connection((conf["addr"], conf["port"]), timeout=2).close()
+        return True
+    except OSError:
+        return False
+
 #################### Tests ####################
 @pytest.mark.asyncio
 async def test_Search():
     testHelper = HelperClass()
-    # Clear test space on NebulaGraph
-    testHelper.clearMockDB()
+    # Clear test space on graph backend
+    await testHelper.clearMockDB()
     # Fill test space with test data
     await testHelper.fillDB()
+    # Search resolves deposits by index built from graph
+    await testHelper.heuristics.rebuildDepositIndex()
 
     assert (response := await testHelper.heuristics.clusterAddrs(
         targetAddr="0X0000000000000000000000000000000000000003"
@@ -85,9 +129,445 @@ async def test_Search():
     assert "0X0000000000000000000000000000000000000003" in response
     assert "0X0000000000000000000000000000000000000004" in response
     assert "0X0000000000000000000000000000000000000005" not in response
+    # Repeated search is served from cache and counted
+    hits = Metrics.metrics["search_cache_requests_total"].values.get((("result", "hit"),), 0)
+    assert await testHelper.heuristics.clusterAddrs(targetAddr="0X0000000000000000000000000000000000000003") == response
+    assert Metrics.metrics["search_cache_requests_total"].values[(("result", "hit"),)] == hits + 1
 
     # Cleanup
-    testHelper.clearMockDB()
+    await testHelper.clearMockDB()
+
+@pytest.mark.asyncio
+async def test_WriteBufferBatches():
+    nebula = RecordingNebula()
+    buffer = NebulaWriteBuffer(nebula, maxRows=100, maxDelay=3600)
+    # Two txs of same leaf -> deposit pair plus one other leaf
+    await buffer.addNode("0X03", "mock", parentAddr="0X01", nodeType="leaf", txID="0xa1", txTime=1, amount=1 * ETH_WEI)
+    await buffer.addNode("0X03", "mock", parentAddr="0X01", nodeType="leaf", txID="0xb2", txTime=2, amount=2 * ETH_WEI)
+    await buffer.addNode("0X04", "mock", parentAddr="0X01", nodeType="leaf", txID="0xc3", txTime=3, amount=1 * ETH_WEI)
+    # Nothing written till flush
+    assert not nebula.queries
+    await buffer.flush()
+
+    # One multi-row vertex insert, one multi-row transaction insert and one multi-statement edge upsert
+    assert len(nebula.queries) == 3
+    assert '"0X03":("mock", "leaf"), "0X04":("mock", "leaf")' in nebula.queries[0]
+    assert '"0X03"->"0X01"@161:("0xa1", 1, 1.0), "0X03"->"0X01"@178:("0xb2", 2, 2.0)' in nebula.queries[1]
+    assert 'amount = amount + 3.0, count = count + 2' in nebula.queries[2]
+    # Partly applied upserts would be added twice by retry
+    assert nebula.unretried == [nebula.queries[2]]
+    assert buffer.stats["roundTrips"] == 3 and buffer.stats["transfers"] == 3
+    # Non-hex tx ID still gets same rank in every process
+    assert txRank("0xzz") == 6661987984174195769
+
+@pytest.mark.asyncio
+async def test_WriteBufferFailure():
+    graph  = MemoryGraph(snapshot="")
+    buffer = NebulaWriteBuffer(graph, maxRows=100, maxDelay=3600)
+    confirmed = []
+    # First write fails, later ones succeed
+    writeBatch = graph.writeBatch
+    async def failOnce(*args):
+        graph.writeBatch = writeBatch
+        return 1, 1
+    graph.writeBatch = failOnce
+
+    await buffer.addNode("0X03", "mock", parentAddr="0X01", nodeType="leaf", txID="0xa1", txTime=1, amount=1)
+    await buffer.flush()
+    # Watermark of address queued after its failed rows, rows of other address follow
+    buffer.afterFlush(lambda: confirmed.append("0X01"), owner="0X01")
+    await buffer.addNode("0X04", "mock", parentAddr="0X02", nodeType="leaf", txID="0xb2", txTime=2, amount=1)
+    buffer.afterFlush(lambda: confirmed.append("0X02"), owner="0X02")
+    await buffer.flush()
+    # Later successful rows of failed address don't confirm it either
+    await buffer.addNode("0X05", "mock", parentAddr="0X01", nodeType="leaf", txID="0xc3", txTime=3, amount=1)
+    buffer.afterFlush(lambda: confirmed.append("0X01"), owner="0X01")
+    await buffer.flush()
+
+    assert confirmed == ["0X02"]
+    assert buffer.failedOwners == {"0X01"} and buffer.stats["failed"] == 1
+    assert graph.countAddrsOfType("leaf") == 2
+
+@pytest.mark.asyncio
+async def test_TrezorStatusCache():
+    trezor = TrezorAPI()
+    trezor.statusTTL, trezor.statusMaxAge = 60, 300
+    requests, responses = [], [{"blockbook.bestHeight": 100, "blockbook.lastBlockTime": "2024-01-01T00:00:00Z"}, {}]
+
+    # Blockbook stand-in, second response is invalid
+    async def get(session=None, endpoint="", params=None, key=None, raiseOnFail=False, limiter=None):
+        requests.append(endpoint)
+        await asyncio.sleep(0.01)
+        yield responses[len(requests) - 1]
+
+    trezor.get = get
+    # Concurrent callers share one request
+    statuses = await asyncio.gather(*[trezor.getCurrentClientData() for _ in range(5)])
+    assert len(requests) == 1 and all(status["maxBlock"] == 100 for status in statuses)
+    # Fresh within TTL
+    assert (await trezor.getCurrentClientData())["maxBlock"] == 100 and len(requests) == 1
+
+    # Failed refresh keeps last good status and its age
+    statusTime = trezor.statusTime
+    assert await trezor.getCurrentClientData(fresh=True) is None
+    assert trezor.status["maxBlock"] == 100 and trezor.statusTime == statusTime
+    assert (await trezor.getCurrentClientData())["maxBlock"] == 100 and len(requests) == 2
+
+@pytest.mark.asyncio
+async def test_TrezorBrokenStream():
+    trezor = TrezorAPI()
+    tx = {
+        "txid" : "0xa1", "blockHeight": 7, "blockTime": 1, "fees": "1",
+        "vin"  : [{"n": 0, "addresses": ["0xAb01"]}],
+        "vout" : [{"n": 0, "value": "1", "addresses": ["0xcd02"]}],
+        "ethereumSpecific" : {"status": 1, "data": "0x"}
+    }
+    page = json.dumps({"page": 1, "totalPages": 1, "transactions": [tx]}).encode()
+    requests = []
+
+    # Connection breaks after first chunk of body
+    class BrokenReader(BytesReader):
+        async def read(self, size=-1):
+            if self.offset:
+                raise aiohttp.ClientPayloadError("connection reset")
+            return await super().read(size)
+
+    class Response():
+        status, content_type = 200, "application/json"
+        async def __aenter__(self):
+            self.content = BrokenReader(page)
+            return self
+        async def __aexit__(self, *args):
+            pass
+        def raise_for_status(self):
+            pass
+
+    class Session():
+        async def getSession(self):
+            return self
+        def get(self, url, **kwargs):
+            requests.append(url)
+            return Response()
+        def onSuccess(self):
+            pass
+
+    items = []
+    with pytest.raises(aiohttp.ClientPayloadError):
+        async for item in trezor.get(Session(), "v2/address/0x01", raiseOnFail=True):
+            items.append(item)
+    # Header and transaction are not repeated by retried request
+    assert len(requests) == 1 and items[0] == {"totalPages": 1} and len(items) == 2
+
+def test_AddressIndex():
+    addrs = [f"0X{index:040X}" for index in range(5000)]
+    # Plain frozen set and Bloom filter variant must both find all added addresses
+    for index in (AddressIndex(addrs[:100]), AddressIndex(addrs[:100], bloomThreshold=50)):
+        index.update(addrs[100:])
+        assert all(addr in index for addr in addrs)
+        assert len(index) == len(addrs)
+    # Lowercase input is normalized
+    assert "0X0000000000000000000000000000000000000001" in AddressIndex(["0x0000000000000000000000000000000000000001"])
+    assert "0X1111111111111111111111111111111111111111" not in AddressIndex(addrs)
+
+def test_LRUCache():
+    cache = LRUCache(maxSize=2, ttl=0)
+    cache.set(("0X01", 0), "a")
+    cache.set(("0X02", 0), "b")
+    # Touch first item, second one becomes least recently used
+    assert cache.get(("0X01", 0)) == "a"
+    cache.set(("0X03", 0), "c")
+    assert cache.get(("0X02", 0)) is None
+    # Same address from other graph generation is a miss
+    assert cache.get(("0X01", 1)) is None
+    stats = cache.getStats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["size"]) == (1, 2, 1, 2)
+
+def test_DepositIndex(tmp_path):
+    leaf, depo1, depo2 = "0X" + "03" * 20, "0X" + "01" * 20, "0X" + "02" * 20
+    index = DepositIndex(str(tmp_path / "index.pickle"))
+    index.rebuild([(leaf, depo1), ("0X" + "04" * 20, depo1)])
+    # Leaf found later during refresh
+    index.addLink(leaf.lower(), depo2)
+    assert index.getDeposits(leaf) == [depo1, depo2]
+    assert index.getDeposits(depo2) == [depo2]
+    assert index.getDeposits("0X" + "05" * 20) == []
+
+    # Persisted index is same after load
+    index.save()
+    loaded = DepositIndex(str(tmp_path / "index.pickle"))
+    assert loaded.load()
+    assert loaded.getDeposits(leaf) == [depo1, depo2] and len(loaded) == 2
+
+@pytest.mark.asyncio
+async def test_BulkSearchGroups(tmp_path):
+    leaf1, leaf2, depo1 = "0X" + "03" * 20, "0X" + "04" * 20, "0X" + "01" * 20
+    leaf3, depo2 = "0X" + "06" * 20, "0X" + "02" * 20
+    # Heuristics stand-in counting cluster fetches, cluster of second deposit fails
+    class StubHeuristics():
+        def __init__(self):
+            self.dataHandler = DataHandler(MemoryGraph(snapshot=""))
+            self.dataHandler.depositIndex = DepositIndex(str(tmp_path / "index.pickle"))
+            self.dataHandler.depositIndex.rebuild([(leaf1, depo1), (leaf2, depo1), (leaf3, depo2)])
+            self.fetched = []
+        async def clusterAddrs(self, targetAddr=""):
+            self.fetched.append(targetAddr)
+            if targetAddr == leaf3:
+                raise RuntimeError("graph unavailable")
+            return '{"nodes":[],"edges":[]}'
+
+    stub  = StubHeuristics()
+    lines = {line["address"]: line for line in [json.loads(line) async for line in HeuristicsClass.bulkClusterAddrs(stub, [leaf1, leaf2.lower(), leaf3, "0X05"])]}
+    # Both leafs share deposit, so its cluster is fetched once
+    assert len(stub.fetched) == 2
+    assert set(lines) == {leaf1, leaf2, leaf3, "0X05"}
+    assert lines[leaf1]["cluster"] == lines[leaf2]["cluster"] == {"nodes": [], "edges": []}
+    # Failed cluster is reported only in lines of its addresses
+    assert lines[leaf3]["cluster"] is None and lines[leaf3]["error"] == "graph unavailable"
+    assert "error" not in lines[leaf1] and lines["0X05"]["deposits"] == []
+
+def test_CacheStore(tmp_path, monkeypatch):
+    Cache.close()
+    monkeypatch.setattr(Cache, "dbPath", str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(Cache, "maxVolatile", 2)
+    # Record every access, so LRU order follows gets below
+    monkeypatch.setattr(Cache, "accessInterval", 0)
+    # Batched writes are visible after commit, namespaces are separated
+    with Cache.batch():
+        Cache.set("leaf:0X01", 10, namespace="watermark")
+        Cache.set("leaf:0X01", 20)
+    assert Cache.get("leaf:0X01", namespace="watermark") == 10 and Cache.get("leaf:0X01") == 20
+    Cache.clearNamespace("watermark")
+    assert Cache.get("leaf:0X01", 0, namespace="watermark") == 0 and Cache.get("leaf:0X01") == 20
+
+    # Least recently used volatile key is evicted over limit, expired one is gone
+    Cache.set("a", 1, ttl=3600)
+    Cache.set("b", 2, ttl=3600)
+    Cache.get("a")
+    Cache.set("c", 3, ttl=3600)
+    assert Cache.get("b") is None and Cache.get("a") == 1
+    Cache.set("d", 4, ttl=-1)
+    assert Cache.get("d") is None
+
+    # Values survive reopening
+    Cache.close()
+    assert Cache.get("leaf:0X01") == 20
+    Cache.close()
+
+@pytest.mark.asyncio
+async def test_RecorderReplay(tmp_path):
+    path = str(tmp_path / "responses.ndjson.gz")
+    recorder = ResponseRecorder("record", path)
+    recorder.record("v2/address/0X01", {"page": 1, "to": 10}, b'{"totalPages": 3}')
+    recorder.close()
+
+    # Params order doesn't matter, unknown request is reported as missing
+    replay = ResponseRecorder("replay", path)
+    content = await replay.replay("v2/address/0X01", {"to": 10, "page": 1})
+    assert json.loads(await content.read()) == {"totalPages": 3}
+    assert await replay.replay("v2/address/0X02", {"page": 1}) is None
+    assert replay.stats == {"recorded": 0, "replayed": 1, "missing": 1}
+
+@pytest.mark.asyncio
+async def test_TxDecoder():
+    tx = {
+        "txid" : "0xa1", "blockHeight": 7, "blockTime": 1700000000, "fees": "1",
+        "vin"  : [{"n": 0, "addresses": ["0xAb01"]}],
+        "vout" : [{"n": 0, "value": "1000000000000000001", "addresses": ["0xcd02"]}],
+        "ethereumSpecific" : {"status": 1, "data": "0x"}
+    }
+    page = json.dumps({"page": 1, "totalPages": 2, "transactions": [tx, {"txid": "0xb2", "vin": []}]}).encode()
+    # Malformed transaction is skipped
+    decoded = [item async for item in decodeTxs(BytesReader(page))]
+    assert len(decoded) == 1
+    assert (decoded[0].fromAddr, decoded[0].toAddr, decoded[0].blockTime, decoded[0].data) == ("0xAb01", "0xcd02", 1700000000, "0x")
+    # Block height is used in range arithmetic, so it is always int
+    assert [tx.blockHeight async for tx in decodeTxs(BytesReader(page.replace(b'"blockHeight": 7', b'"blockHeight": "7"')))] == [7]
+    # Wei amount is kept exact
+    assert decoded[0].value == ETH_WEI + 1
+    # Page header comes first, read from same pass
+    assert [item async for item in decodePage(BytesReader(page))] == [{"totalPages": 2}, decoded[0]]
+
+@pytest.mark.asyncio
+async def test_MemoryGraph():
+    graph  = MemoryGraph(snapshot="")
+    buffer = NebulaWriteBuffer(graph, maxRows=100, maxDelay=3600)
+    exch, depo, leaf = "0X00", "0X01", "0X03"
+    await buffer.addNode(exch, "mock exchange", nodeType="exchange")
+    await buffer.addNode(depo, "mock exchange", parentAddr=exch, nodeType="deposit", txID="0xa1", txTime=1, amount=1 * ETH_WEI)
+    await buffer.addNode(leaf, "mock exchange", parentAddr=depo, nodeType="leaf", txID="0xb2", txTime=2, amount=2 * ETH_WEI)
+    await buffer.addNode(leaf, "mock exchange", parentAddr=depo, nodeType="leaf", txID="0xc3", txTime=3, amount=1 * ETH_WEI)
+    await buffer.flush()
+
+    assert graph.countAddrsOfType("leaf") == 1 and graph.getDepositLinks() == [(leaf, depo)]
+    subGraph = await graph.getSubgraph([depo])
+    assert {node["id"] for node in subGraph["nodes"]} == {exch, depo, leaf}
+    assert {"src": leaf, "dst": depo, "props": {"amount": 3.0, "count": 2}} in subGraph["edges"]
+    # Newest transaction first
+    assert [tx[0] for tx in await graph.getEdgeTxs(leaf, depo)] == ["0xc3", "0xb2"]
+    page = await graph.getClusterPage([depo], limit=1)
+    assert len(page["edges"]) == 2 and page["nextCursor"] is None
+
+    # Pages continue after last edge of previous one, strongest links first
+    for index in range(4, 7):
+        await buffer.addNode(f"0X{index:02}", "mock", parentAddr=depo, nodeType="leaf", txID=f"0x{index}", txTime=index, amount=index * ETH_WEI)
+    await buffer.flush()
+    pages = [await graph.getClusterPage([depo], limit=2)]
+    while pages[-1]["nextCursor"]:
+        pages.append(await graph.getClusterPage([depo], after=pages[-1]["nextCursor"], limit=2))
+    linked = [edge["src"] for page in pages for edge in page["edges"] if edge["dst"] == depo]
+    assert linked == [leaf, "0X06", "0X05", "0X04"] and len(pages) == 2
+
+@pytest.mark.asyncio
+async def test_BlockRangeCrawl():
+    dataHandler = DataHandler(MemoryGraph(snapshot=""))
+    dataHandler.trezor.pageSize = 10
+    # 3 transactions in each of blocks 1-40, block 30 holds more than two pages
+    txs = [
+        Tx(f"0x{block:04x}{index:02x}", "0xa", "0xb", 1, block, block, "0x")
+        for block in range(1, 41) for index in range(25 if block == 30 else 3)
+    ]
+    requests, processed = [], []
+
+    # Blockbook stand-in, newest transactions first
+    async def get(session=None, endpoint="", params=None, key=None, raiseOnFail=False):
+        requests.append(params)
+        inRange = sorted([tx for tx in txs if params["from"] <= tx.blockHeight <= (params["to"] or math.inf)], key=lambda tx: -tx.blockHeight)
+        pageSize = params["pageSize"]
+        yield {"totalPages": math.ceil(len(inRange) / pageSize)}
+        for tx in inRange[((params["page"] - 1) * pageSize):(params["page"] * pageSize)]:
+            yield tx
+        yield None
+
+    async def processTx(tx, *args):
+        processed.append(tx.txid)
+
+    dataHandler.trezor.get = get
+    dataHandler.processTx  = processTx
+    assert await dataHandler.crawlRange(addr="0XB", nodeType="leaf", fromBlock=0, toBlock=0)
+    # Each transaction processed exactly once
+    assert sorted(processed) == sorted(tx.txid for tx in txs)
+    # Deeper pages are requested only for single block
+    assert all(params["page"] == 1 or params["from"] == params["to"] == 30 for params in requests)
+
+def test_CheckpointResume(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    log = CheckpointLog(path)
+    assert not log.start({"scope": 1}, toBlock=100)
+    log.markDone("stage", "exchanges")
+    # Block range unit of refresh: (type, address, from block, to block, page)
+    log.markDone("range", "deposit", "0X01", 0, 50, 1)
+    # Simulate crash (no finish)
+    log.close()
+
+    # Same params resume with original block range
+    log = CheckpointLog(path)
+    assert log.start({"scope": 1}, toBlock=200)
+    assert log.run["toBlock"] == 100
+    assert log.isDone("range", "deposit", "0X01", 0, 50, 1)
+    assert not log.isDone("range", "deposit", "0X01", 51, 100, 1)
+    assert log.summary()["stagesDone"] == ["exchanges"]
+    assert log.summary()["rangesDone"] == {"deposit": 1}
+    log.finish()
+
+    # Finished run is not resumed
+    assert not CheckpointLog(path).start({"scope": 1}, toBlock=200)
+
+def test_ShardPoolFallback(monkeypatch):
+    dataHandler = DataHandler(MemoryGraph(snapshot=""))
+    monkeypatch.setenv("REFRESH_WORKERS", "1")
+    assert ShardPool.create(dataHandler, "MockSpace") is None
+    # Workers would each have own copy of in-memory graph, so refresh stays in this process
+    monkeypatch.setenv("REFRESH_WORKERS", "4")
+    assert ShardPool.create(dataHandler, "MockSpace") is None
+
+def test_ShardStatsMerge():
+    dataHandler = DataHandler(MemoryGraph(snapshot=""))
+    shardPool = ShardPool(dataHandler, "MockSpace", workers=4)
+    counter   = Metrics.counter("test_worker_total", "Test worker counter")
+    histogram = Metrics.histogram("test_worker_seconds", "Test worker latency", buckets=(0.1, 1.0))
+    successes = dataHandler.trezor.limiter.stats["successes"]
+
+    # Worker counters cover its whole life, report orders them
+    def snapshot(report=0, count=0):
+        return {
+            "pid"       : 1,
+            "stageId"   : None,
+            "report"    : report,
+            "metrics"   : {"test_worker_total": {(): count}, "test_worker_seconds": {(): ([count, 0], count * 0.05, count)}},
+            "blockbook" : {"successes": count, "overloads": 0, "retries": 0, "limit": 7, "inFlight": 1, "latencyMs": None}
+        }
+
+    shardPool.merge(snapshot(report=1, count=2))
+    shardPool.merge(snapshot(report=3, count=5))
+    # Older report arriving late is ignored
+    shardPool.merge(snapshot(report=2, count=3))
+    assert counter.values[()] == 5
+    assert histogram.values[()][0] == [5, 0] and histogram.values[()][2] == 5
+    assert dataHandler.trezor.limiter.stats["successes"] == successes + 5
+    assert shardPool.limiterStats()[0]["limit"] == 7
+    shardPool.executor.shutdown()
+
+    # Each worker gets its part of Blockbook concurrency budget
+    limiter = dataHandler.trezor.limiter
+    limiter.share(4)
+    assert (limiter.minLimit, limiter.maxLimit, limiter.limit) == (1, 64, 7.5)
+
+def test_MetricsFormat():
+    counter = Metrics.counter("test_requests_total", "Test requests", ("endpoint",))
+    counter.inc(endpoint="status")
+    counter.inc(2, endpoint='a"b')
+    histogram = Metrics.histogram("test_latency_seconds", "Test latency", ("phase",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, phase="lookup")
+    histogram.observe(0.5, phase="lookup")
+    histogram.observe(5.0, phase="lookup")
+    lines = Metrics.render().splitlines()
+
+    assert "# TYPE test_requests_total counter" in lines
+    assert 'test_requests_total{endpoint="status"} 1' in lines
+    # Label values are escaped
+    assert 'test_requests_total{endpoint="a\\"b"} 2' in lines
+    # Buckets are cumulative
+    assert "# TYPE test_latency_seconds histogram" in lines
+    assert 'test_latency_seconds_bucket{phase="lookup",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{phase="lookup",le="1.0"} 2' in lines
+    assert 'test_latency_seconds_bucket{phase="lookup",le="+Inf"} 3' in lines
+    assert 'test_latency_seconds_count{phase="lookup"} 3' in lines
+    assert 'test_latency_seconds_sum{phase="lookup"} 5.55' in lines
+
+@pytest.mark.asyncio
+async def test_Profiler(tmp_path, monkeypatch):
+    # Use cProfile even when yappi is installed
+    monkeypatch.setattr(importlib.import_module("Helpers.Profiler"), "yappi", None)
+    monkeypatch.setattr(Profiler, "outputDir", str(tmp_path))
+    monkeypatch.setattr(Profiler, "targets", {"search"})
+
+    @Profiler.profiled("search")
+    async def search():
+        with Profiler.awaiting("nebula"):
+            await asyncio.sleep(0.01)
+        Profiler.addAwait("nebula", 0.5)
+        return Profiler.active
+
+    @Profiler.profiled("refresh")
+    async def refresh():
+        return Profiler.active
+
+    # Only enabled target is profiled, awaits outside of profile aren't recorded
+    assert await refresh() is None
+    with Profiler.awaiting("blockbook_slot"):
+        pass
+    assert await search() == "search" and Profiler.active is None
+    assert list(Profiler.awaitTimes) == ["nebula"]
+    total, count, maxTime = Profiler.awaitTimes["nebula"]
+    assert count == 2 and 0.51 <= total and maxTime == 0.5
+
+    # Raw profile and its summary are written
+    assert len(profiles := Profiler.listProfiles()) == 1 and profiles[0].startswith("search_")
+    assert (tmp_path / profiles[0].replace(".txt", ".prof")).exists()
+    summary = (tmp_path / profiles[0]).read_text(encoding="utf-8")
+    assert "Profile of search (cProfile)" in summary
+    assert any(line.split()[:1] == ["nebula"] and line.split()[2] == "2" for line in summary.splitlines())
+    assert "functions by cumulative time" in summary
 
 def test_InvalidPwd():
     with TestClient(app) as mc:
@@ -99,17 +579,47 @@ def test_InvalidPwd():
         # Check correct response for invalid password
         assert response.status_code == 401
 
+@pytest.mark.asyncio
+async def test_GraphBackendInit():
+    # Trigger creation of mock space on graph backend
+    testHelper = HelperClass()
+    await testHelper.clearMockDB()
+    nebula = testHelper.nebula
+
+    # Backend is ready to use: empty after clearing, indexes can be rebuilt
+    assert all(nebula.countAddrsOfType(addrType) == 0 for addrType in ("exchange", "deposit", "leaf"))
+    await nebula.rebuildIndexes()
+    assert await nebula.getSubgraph(["0X0000000000000000000000000000000000000001"]) == {"nodes": [], "edges": []}
+    assert [page async for page in nebula.iterAddrsOfType("deposit")] == []
+
+    # Backend missing part of interface can't be created
+    class PartialBackend(GraphBackend):
+        async def runAsync(self, func, *args, **kwargs):
+            return func(*args, **kwargs)
+    with pytest.raises(TypeError):
+        PartialBackend()
+
+@pytest.mark.skipif(not nebulaReachable(), reason="NebulaGraph not available")
 def test_NebulaInit():
     targetSpace="MockSpace"
     # Trigger creation of Nebula mock space
-    nebula = (HelperClass()).nebula
+    nebula = NebulaAPI(targetSpace=targetSpace)
 
     # Check all DB objects exists
     assert nebula.objectExists(targetSpace, "SPACES")
     assert nebula.objectExists("address", "TAGS")
     assert nebula.objectExists("linked_to", "EDGES")
+    assert nebula.objectExists("count", "EDGE linked_to", name="Field", action="DESCRIBE")
+    assert nebula.objectExists("transfer", "EDGES")
+    assert nebula.objectExists("txid", "EDGE transfer", name="Field", action="DESCRIBE")
     assert nebula.objectExists("addrs_index", "TAG INDEXES", name="Index Name")
 
+    # Space of older schema (aggregated edge without count) gets the column added
+    assert nebula.execNebulaCommand('ALTER EDGE linked_to DROP (count)')
+    time.sleep(20)
+    nebula.createSpace()
+    assert nebula.objectExists("count", "EDGE linked_to", name="Field", action="DESCRIBE")
+
 @pytest.mark.asyncio
 async def test_TrezorSyncDate():
     clientData = await HelperClass().heuristics.api.trezor.getCurrentClientData()
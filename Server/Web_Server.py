@@ -6,25 +6,37 @@
 
 # Imports
 import os, hashlib, secrets, json
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Form, HTTPException, File, UploadFile
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import Response, HTMLResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 from jsonschema import validate, ValidationError
 from pathlib import Path
 from dotenv import load_dotenv
 from Server import HeuristicsClass
-from .API import TrezorAPI
-from Helpers import Cache
+from .Heuristics import CLUSTER_PAGE_LIMIT, CLUSTER_PAGE_MAX, SEARCH_SECONDS
+from .Refresh_Jobs import RefreshJobManager
+from Helpers import Cache, Metrics, Profiler
 
 # Load env variables
 load_dotenv()
 # Load stored password for DB refresh
 DB_REFRESH_PWD = os.getenv("DB_REFRESH_PWD", "")
+# Max count of addresses in one bulk search request
+BULK_MAX_ADDRS = 10000
+
+# Keep one HTTP client to Blockbook open for app's lifetime
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await trezor.session.createSession()
+    await heuristics.loadDepositIndex()
+    yield
+    await trezor.session.closeSession()
 
 # Init FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 # Add middleware for sessions
 app.add_middleware(SessionMiddleware, secret_key=secrets.token_urlsafe(32))
 # Absolute path to current file parent
@@ -37,12 +49,24 @@ templates = Jinja2Templates(directory="Client/templates")
 
 # Create Heuristics class instance
 heuristics = HeuristicsClass()
-# Create Trezor class instance
-trezor = TrezorAPI()
+# Share Trezor class instance (and its HTTP client) with refresh pipeline
+trezor = heuristics.dataHandler.trezor
 # Create NebulaGraph class instance
 nebula = heuristics.nebula
-# Flag to determine if refresh is on/off
-ongoingRefresh = False
+# Runs refreshes in background, one at time
+refreshJobs = RefreshJobManager(heuristics)
+
+# Current state of components exported with metrics
+BLOCKBOOK_LIMIT    = Metrics.gauge("blockbook_concurrency_limit", "Current limit of concurrent Blockbook requests")
+BLOCKBOOK_INFLIGHT = Metrics.gauge("blockbook_in_flight", "Blockbook requests in progress")
+REFRESH_RUNNING    = Metrics.gauge("refresh_running", "Whether DB refresh is running")
+
+def collectMetrics():
+    limiterStats = heuristics.blockbookStats()
+    BLOCKBOOK_LIMIT.set(limiterStats["limit"])
+    BLOCKBOOK_INFLIGHT.set(limiterStats["inFlight"])
+    REFRESH_RUNNING.set(int(refreshJobs.isRunning()))
+Metrics.addCollector(collectMetrics)
 
 # Schema for valid JSON exch list: "str : str, ..." and no nested objects
 schema = {
@@ -57,11 +81,10 @@ schema = {
 
 # Return context dict based on refresh status
 async def getContext():
-    global ongoingRefresh
     return {
         "clientData"     : await trezor.getCurrentClientData(),
         "exchLen"        : len(heuristics.exchAddrs),
-        "ongoingRefresh" : ongoingRefresh,
+        "ongoingRefresh" : refreshJobs.isRunning(),
         "addrsCount"     : {
             "exchanges" : Cache.get("exchanges_cnt"),
             "deposits"  : Cache.get("deposits_cnt"),
@@ -82,6 +105,15 @@ def requireLogIn(request):
 def checkPwd(pwd):
     return (hashlib.sha512(DB_REFRESH_PWD.encode("utf-8")).hexdigest() == pwd)
 
+# Raises HTTP exception when user neither logged in nor provided valid refresh password
+def requireRefreshAuth(request, pwd):
+    # Omit pwd checks when already loggedIn
+    if not request.session.get("loggedIn", False):
+        # Check for valid refresh password
+        # Raise exception to notify client
+        if not checkPwd(pwd):
+            raise HTTPException(status_code=401, detail="Invalid password")
+
 # Home page
 @app.get("/", response_class=HTMLResponse)
 async def showHome(request: Request):
@@ -97,43 +129,139 @@ async def showHome(request: Request):
 # Refresh database
 @app.post("/refreshDB", response_class=JSONResponse)
 async def refreshDB(request: Request, minHeight: int = Form(...), maxHeight: int = Form(...), scope: int = Form(...), pwd: str = Form(default="")):
-    global ongoingRefresh
+    requireRefreshAuth(request, pwd)
+    # Queue refresh with given scope and block limits, it runs in background
+    job = refreshJobs.submit(scope=scope, minHeight=minHeight, maxHeight=maxHeight)
 
-    # Omit pwd checks when already loggedIn
-    if not request.session.get("loggedIn", False):
-        # Check for valid refresh password
-        # Raise exception to notify client
-        if not checkPwd(pwd):
-            raise HTTPException(status_code=401, detail="Invalid password")
+    # Return current data and job to poll
+    return {
+        **(await getContext()),
+        "job" : job
+    }
 
-    if not ongoingRefresh:
-        ongoingRefresh = True
-        # Trigger refresh with given scope and block limits
-        await heuristics.updateAddrsDB(scope=scope, minHeight=minHeight, maxHeight=maxHeight)
-        ongoingRefresh = False
+# Get status of all refresh jobs
+@app.get("/refreshStatus", response_class=JSONResponse)
+async def getRefreshStatuses():
+    return refreshJobs.allStatuses()
 
-    # Return new data
-    return (await getContext())
+# Get status and progress of given refresh job
+@app.get("/refreshStatus/{jobId}", response_class=JSONResponse)
+async def getRefreshStatus(jobId: str):
+    if not (status := refreshJobs.status(jobId)):
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return status
+
+# Cancel queued or running refresh job
+@app.post("/refreshCancel/{jobId}", response_class=JSONResponse)
+async def cancelRefresh(request: Request, jobId: str, pwd: str = Form(default="")):
+    requireRefreshAuth(request, pwd)
+    return {
+        "result" : "success" if refreshJobs.cancel(jobId) else "Job not found or already finished"
+    }
+
+# Get state of Blockbook requests limiter used by refresh
+@app.get("/blockbookStats", response_class=JSONResponse)
+async def getBlockbookStats():
+    return heuristics.blockbookStats()
+
+# Get hit/miss counters of search results cache
+@app.get("/searchCacheStats", response_class=JSONResponse)
+async def getSearchCacheStats():
+    return heuristics.resultCache.getStats()
+
+# Metrics in Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+async def getMetrics():
+    return PlainTextResponse(Metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Get profiled targets and written profile summaries
+@app.get("/profiling", response_class=JSONResponse)
+async def getProfiling():
+    Profiler.init()
+    return {
+        "engine"   : Profiler.engine(),
+        "targets"  : sorted(Profiler.targets),
+        "active"   : Profiler.active,
+        "profiles" : Profiler.listProfiles()
+    }
+
+# Set targets to profile ("refresh", "search" or "all"), empty list disables profiling
+@app.post("/profiling", response_class=JSONResponse)
+async def setProfiling(request: Request):
+    try:
+        requireLogIn(request)
+        body = await request.json()
+        targets = body.get("targets", [])
+        if not isinstance(targets, list) or not set(targets) <= {"refresh", "search", "all"}:
+            raise ValueError("Targets must be list of: refresh, search, all")
+
+        Profiler.setTargets(targets)
+    except Exception as e:
+        return {
+            "result" : str(e)
+        }
+    else:
+        return {
+            "result" : "success"
+        }
 
 # Init search
 @app.post("/search", response_class=HTMLResponse)
 async def searchAddr(request: Request, targetAddr: str = Form(...)):
     # Ensure capitalized search address before processing
     targetAddr = targetAddr.upper()
-    # Collect addresses
-    resultsGraph = await heuristics.clusterAddrs(targetAddr=targetAddr)
+    # Graph itself is loaded by page from /cluster, only check the address is known
+    with SEARCH_SECONDS.time(phase="lookup"):
+        clusterFound = bool(heuristics.dataHandler.depositIndex.getDeposits(targetAddr))
 
+    # Context can wait for Blockbook status, so it is not part of rendering time
+    context = await getContext()
     # Render page
-    return templates.TemplateResponse(
-        request = request,
-        name    = "result.html",
-        context = {
-            **(await getContext()),
-            "targetAddr"   : targetAddr,
-            "resultsGraph" : resultsGraph,
-            "loggedIn"     : request.session.get("loggedIn", False)
-        }
-    )
+    with SEARCH_SECONDS.time(phase="render"):
+        return templates.TemplateResponse(
+            request = request,
+            name    = "result.html",
+            context = {
+                **context,
+                "targetAddr"   : targetAddr,
+                "clusterFound" : clusterFound,
+                "loggedIn"     : request.session.get("loggedIn", False)
+            }
+        )
+
+# Get page of address's cluster as JSON, follow "nextCursor" to get rest of it
+@app.get("/cluster/{targetAddr}")
+async def getCluster(targetAddr: str, cursor: str = "", limit: int = CLUSTER_PAGE_LIMIT):
+    limit = max(1, min(limit, CLUSTER_PAGE_MAX))
+    try:
+        page = await heuristics.getClusterPage(targetAddr=targetAddr.upper(), cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not page:
+        raise HTTPException(status_code=404, detail="Address is unknown or not leaf or deposit")
+
+    return Response(heuristics.serializeClusterPage(page), media_type="application/json")
+
+# Cluster batch of addresses, results are streamed as NDJSON (one line per address)
+@app.post("/bulkSearch")
+async def bulkSearch(request: Request):
+    try:
+        data = await request.json()
+        targetAddrs = data.get("addresses", [])
+        assert isinstance(targetAddrs, list)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Expected JSON object with list of addresses")
+    if len(targetAddrs) > BULK_MAX_ADDRS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ADDRS} addresses per request")
+
+    return StreamingResponse(heuristics.bulkClusterAddrs(targetAddrs), media_type="application/x-ndjson")
+
+# Get transactions of given edge
+@app.get("/edgeTxs", response_class=JSONResponse)
+async def getEdgeTxs(src: str, dst: str):
+    if (txs := await heuristics.getEdgeTxs(srcAddr=src, dstAddr=dst)) is None:
+        raise HTTPException(status_code=400, detail="Invalid address")
+    return txs
 
 # Get JSON list of crypto exchanges
 @app.get("/exchList", response_class=JSONResponse)
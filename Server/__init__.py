@@ -5,5 +5,11 @@
 
 # Import all module properties
 from .Heuristics import HeuristicsClass
-from .Web_Server import app
 from .Session import SessionManager
+
+# Web app is imported on first access, so processes importing Server (e.g. refresh workers) don't start it
+def __getattr__(name):
+    if name == "app":
+        from .Web_Server import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")